@@ -7,5 +7,14 @@ app = Flask(__name__)
 app.config.from_pyfile('config.py')
 db = SQLAlchemy(app)
 
+# SQLite PRAGMAs and the read-only pool, see config.py.
+from engine import install_sqlite_tuning
+install_sqlite_tuning()
+
 # Import the views file for routing.
 import views
+
+# Opt-in SQL and timing instrumentation, see config.py.
+if app.config['INSTRUMENTATION']:
+    from instrumentation import instrument
+    instrument(app, db.engine)
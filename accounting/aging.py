@@ -0,0 +1,105 @@
+#!/user/bin/env python2.7
+
+import csv
+from collections import namedtuple
+
+from money import ZERO
+from portfolio import iter_policy_rows
+
+import logging
+
+"""
+#######################################################
+Accounts receivable aging. Applies each policy's
+payments to its invoices oldest first and buckets what
+is left unpaid by days past the due date.
+#######################################################
+"""
+
+# (column, most days past due), in order; the last bucket is open ended
+AGING_BUCKETS = [('current', 0),
+                 ('days_1_30', 30),
+                 ('days_31_60', 60),
+                 ('days_61_90', 90),
+                 ('days_over_90', None)]
+
+AGING_COLUMNS = ['policy_id'] + [name for name, days in AGING_BUCKETS] + ['credit', 'balance']
+
+AgingRow = namedtuple('AgingRow', AGING_COLUMNS)
+
+
+def _bucket(days_past_due):
+    for index, (name, days) in enumerate(AGING_BUCKETS):
+        if days is None or days_past_due <= days:
+            return index
+
+
+def age_policy(policy_id, invoices, payments, as_of):
+    """
+     Returns the AgingRow for one policy from its non-deleted invoices
+     billed and payments made on or before as_of. Payments are applied to
+     invoices in bill_date order; anything paid beyond them is credit.
+    """
+    credit = sum((payment.amount_paid for payment in payments), ZERO)
+    buckets = [ZERO] * len(AGING_BUCKETS)
+
+    for invoice in sorted(invoices, key=lambda invoice: invoice.bill_date):
+        applied = min(credit, invoice.amount_due)
+        credit -= applied
+        if invoice.amount_due > applied:
+            buckets[_bucket((as_of - invoice.due_date).days)] += invoice.amount_due - applied
+
+    return AgingRow(policy_id, *(buckets + [credit, sum(buckets) - credit]))
+
+
+def iter_aging(as_of, policy_ids=None, include_settled=False):
+    """
+     Yields an AgingRow per policy, in policy id order, streaming over the
+     invoice and payment tables so memory doesn't grow with the book.
+     Policies with nothing due and no credit are skipped unless
+     include_settled is set.
+    """
+    for policy_id, invoices, payments in iter_policy_rows(as_of, policy_ids):
+        row = age_policy(policy_id, invoices, payments, as_of)
+        if include_settled or row.balance or row.credit:
+            yield row
+
+
+def aging_totals(rows):
+    """
+     Adds up every bucket of the given AgingRows.
+    """
+    totals = dict((column, ZERO) for column in AGING_COLUMNS[1:])
+    policies = 0
+    for row in rows:
+        policies += 1
+        for column in AGING_COLUMNS[1:]:
+            totals[column] += getattr(row, column)
+    totals['policies'] = policies
+    return totals
+
+
+def iter_aging_csv(as_of, policy_ids=None):
+    """
+     Yields the aging report as CSV lines, header first.
+    """
+    yield ','.join(AGING_COLUMNS) + '\r\n'
+    for row in iter_aging(as_of, policy_ids):
+        yield ','.join(str(value) for value in row) + '\r\n'
+
+
+def write_aging_csv(as_of, output):
+    """
+     Writes the aging report to an open file and returns its totals.
+    """
+    writer = csv.writer(output)
+    writer.writerow(AGING_COLUMNS)
+
+    def written():
+        for row in iter_aging(as_of):
+            writer.writerow(row)
+            yield row
+
+    totals = aging_totals(written())
+    logging.info('Aging report for ' + str(as_of) + ': ' + str(totals['policies']) + ' policies.')
+    return totals
@@ -0,0 +1,257 @@
+#!/user/bin/env python2.7
+
+import csv
+from datetime import date
+from sqlalchemy import Integer, cast, func, select, type_coerce
+
+from accounting import db
+from aging import AGING_BUCKETS
+from models import Invoice, Payment, Policy
+from money import from_cents
+from tools import PolicyAccounting
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import logging
+
+"""
+#######################################################
+Optional NumPy kernels for portfolio analytics. Loads
+the invoice and payment columns into arrays with one
+read per table and answers balances, cancellations,
+pending cancellations and aging for every policy with
+sorted-array operations. Needs numpy installed.
+#######################################################
+"""
+
+# julianday() of 0001-01-01 at midnight is 1721425.5 and its ordinal is 1
+JULIAN_DAY_OFFSET = 1721424.5
+
+# room for every date ordinal up to date.max below each policy's keys
+KEY_SPAN = 1 << 22
+
+# the last day of each aging bucket but the open-ended one
+AGING_BOUNDS = [days for name, days in AGING_BUCKETS if days is not None]
+
+INVOICE_COLUMNS = ['policy_id', 'bill_date', 'due_date', 'cancel_date', 'amount_due']
+PAYMENT_COLUMNS = ['policy_id', 'transaction_date', 'amount_paid']
+
+ANALYTICS_COLUMNS = ['policy_id', 'balance', 'should_cancel', 'cancel_date', 'pending'] \
+    + [name for name, days in AGING_BUCKETS] + ['credit']
+
+
+def _ordinal(column):
+    return cast(func.julianday(column) - JULIAN_DAY_OFFSET, Integer)
+
+
+def _cents(column):
+    return type_coerce(column, Integer)
+
+
+def _read(bind, query, columns):
+    rows = bind.execute(query).fetchall()
+    if not rows:
+        return numpy.zeros((0, columns), dtype=numpy.int64)
+    # numpy reads plain tuples far faster than RowProxy objects
+    return numpy.array([tuple(row) for row in rows], dtype=numpy.int64)
+
+
+class PortfolioArrays(object):
+
+    """
+     Every policy id, non-deleted invoice and payment as int64 arrays,
+     with dates as ordinals and amounts in cents. The invoices and
+     payments are merged into one list of entries keyed by policy and
+     date, whose running total gives any policy's balance on any date
+     with two binary searches.
+    """
+    def __init__(self, policy_ids, invoices, payments):
+        self.policy_ids = policy_ids
+        self.invoices = invoices
+        self.payments = payments
+        self.invoice_index = numpy.searchsorted(policy_ids, invoices[:, 0])
+        self.payment_index = numpy.searchsorted(policy_ids, payments[:, 0])
+
+        keys = numpy.concatenate([self.invoice_index * KEY_SPAN + invoices[:, 1],
+                                  self.payment_index * KEY_SPAN + payments[:, 1]])
+        amounts = numpy.concatenate([invoices[:, 4], -payments[:, 2]])
+        order = numpy.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        self.running = numpy.concatenate([[0], numpy.cumsum(amounts[order])])
+
+    def balances_at(self, policy_index, ordinals):
+        """
+         Returns the balance in cents of each policy index on the matching
+         date ordinal.
+        """
+        policy_index = numpy.asarray(policy_index, dtype=numpy.int64)
+        end = numpy.searchsorted(self.keys, policy_index * KEY_SPAN + ordinals, side='right')
+        start = numpy.searchsorted(self.keys, policy_index * KEY_SPAN, side='left')
+        return self.running[end] - self.running[start]
+
+    def balances(self, as_of):
+        """
+         Returns every policy's balance in cents on as_of, in policy id
+         order, like PolicyAccounting.return_account_balance.
+        """
+        return self.balances_at(numpy.arange(len(self.policy_ids)), as_of.toordinal())
+
+    def cancellations(self, as_of):
+        """
+         Returns (should_cancel, cancel_date) arrays in policy id order.
+         A policy should have canceled if any invoice reached its cancel
+         date by as_of with a balance due then; cancel_date is the ordinal
+         of the earliest billed such invoice's cancel date, or 0. Matches
+         PolicyAccounting.evaluate_cancel.
+        """
+        invoices = self.invoices
+        due = numpy.flatnonzero(invoices[:, 3] <= as_of.toordinal())
+        breached = due[self.balances_at(self.invoice_index[due], invoices[due, 3]) != 0]
+
+        # the first breach of each policy by bill date, as evaluate_cancel walks them
+        breached = breached[numpy.lexsort((invoices[breached, 1], self.invoice_index[breached]))]
+        policies, first = numpy.unique(self.invoice_index[breached], return_index=True)
+
+        should_cancel = numpy.zeros(len(self.policy_ids), dtype=bool)
+        cancel_date = numpy.zeros(len(self.policy_ids), dtype=numpy.int64)
+        should_cancel[policies] = True
+        cancel_date[policies] = invoices[breached[first], 3]
+        return should_cancel, cancel_date
+
+    def pending(self, as_of):
+        """
+         Returns an array, in policy id order, of whether each policy has
+         an invoice past its due date but not its cancel date on as_of
+         with a balance due. Matches
+         PolicyAccounting.evaluate_cancellation_pending_due_to_non_pay.
+        """
+        ordinal = as_of.toordinal()
+        invoices = self.invoices
+        in_window = (invoices[:, 2] < ordinal) & (ordinal < invoices[:, 3])
+        flagged = numpy.zeros(len(self.policy_ids), dtype=bool)
+        flagged[self.invoice_index[in_window]] = True
+        return flagged & (self.balances(as_of) != 0)
+
+    def aging(self, as_of):
+        """
+         Returns a (policies, buckets + 1) array of cents in policy id
+         order: what is unpaid in each of the AGING_BUCKETS, then the
+         credit. Payments are applied to invoices oldest first, like
+         aging.age_policy.
+        """
+        ordinal = as_of.toordinal()
+        count = len(self.policy_ids)
+        billed = numpy.flatnonzero(self.invoices[:, 1] <= ordinal)
+        billed = billed[numpy.lexsort((self.invoices[billed, 1], self.invoice_index[billed]))]
+        index = self.invoice_index[billed]
+        amounts = self.invoices[billed, 4]
+
+        paid_rows = self.payments[:, 1] <= ordinal
+        paid = numpy.bincount(self.payment_index[paid_rows], weights=self.payments[paid_rows, 2],
+                              minlength=count).astype(numpy.int64)
+
+        # what each policy's earlier invoices took out of its payments
+        running = numpy.concatenate([[0], numpy.cumsum(amounts)])
+        before = running[:-1] - running[numpy.searchsorted(index, index, side='left')]
+        unpaid = amounts - numpy.clip(paid[index] - before, 0, amounts)
+
+        buckets = numpy.searchsorted(AGING_BOUNDS, ordinal - self.invoices[billed, 2], side='left')
+        aging = numpy.bincount(index * len(AGING_BUCKETS) + buckets, weights=unpaid,
+                               minlength=count * len(AGING_BUCKETS))
+        aging = numpy.rint(aging).astype(numpy.int64).reshape(count, len(AGING_BUCKETS))
+
+        total_billed = numpy.bincount(index, weights=amounts, minlength=count).astype(numpy.int64)
+        credit = numpy.maximum(paid - total_billed, 0)
+        return numpy.column_stack([aging, credit])
+
+
+def load_portfolio_arrays(bind=None):
+    """
+     Reads every policy id, non-deleted invoice and payment into a
+     PortfolioArrays, one query per table.
+    """
+    if numpy is None:
+        raise ImportError('accounting.analytics needs NumPy, pip install numpy')
+    bind = bind or db.engine
+    invoices = Invoice.__table__
+    payments = Payment.__table__
+
+    policy_ids = _read(bind, select([Policy.__table__.c.id]).order_by(Policy.__table__.c.id), 1)[:, 0]
+    invoice_rows = _read(bind, select([invoices.c.policy_id,
+                                       _ordinal(invoices.c.bill_date),
+                                       _ordinal(invoices.c.due_date),
+                                       _ordinal(invoices.c.cancel_date),
+                                       _cents(invoices.c.amount_due)])
+                               .where(invoices.c.deleted == False), len(INVOICE_COLUMNS))
+    payment_rows = _read(bind, select([payments.c.policy_id,
+                                       _ordinal(payments.c.transaction_date),
+                                       _cents(payments.c.amount_paid)]), len(PAYMENT_COLUMNS))
+    logging.info('Loaded ' + str(len(invoice_rows)) + ' invoices and ' + str(len(payment_rows))
+                 + ' payments for ' + str(len(policy_ids)) + ' policies.')
+    return PortfolioArrays(policy_ids, invoice_rows, payment_rows)
+
+
+def analyze(as_of, arrays=None):
+    """
+     Returns a dict of arrays in policy id order with every policy's
+     balance, whether it should have canceled and when, whether it is
+     pending cancellation, and its aging, all in cents, as of a date.
+    """
+    arrays = arrays or load_portfolio_arrays()
+    should_cancel, cancel_date = arrays.cancellations(as_of)
+    return {'policy_id': arrays.policy_ids,
+            'balance': arrays.balances(as_of),
+            'should_cancel': should_cancel,
+            'cancel_date': cancel_date,
+            'pending': arrays.pending(as_of),
+            'aging': arrays.aging(as_of)}
+
+
+def cross_check(as_of, policy_ids=None, arrays=None):
+    """
+     Compares analyze() with PolicyAccounting for the given policies, or
+     all of them. Returns a list of (policy_id, check, kernel value,
+     PolicyAccounting value) for every disagreement.
+    """
+    results = analyze(as_of, arrays)
+    rows = dict((policy_id, i) for i, policy_id in enumerate(results['policy_id'].tolist()))
+    mismatches = []
+    for policy_id in policy_ids or sorted(rows):
+        i = rows[policy_id]
+        pa = PolicyAccounting(policy_id, read_only=True)
+        cancel = pa.evaluate_cancel(as_of)
+        cancel_date = results['cancel_date'][i] and date.fromordinal(int(results['cancel_date'][i]))
+        checks = [('balance', from_cents(int(results['balance'][i])), pa.return_account_balance(as_of)),
+                  ('should_cancel', bool(results['should_cancel'][i]), cancel.should_cancel),
+                  ('cancel_date', cancel_date or None, cancel.invoice and cancel.invoice.cancel_date),
+                  ('pending', bool(results['pending'][i]),
+                   pa.evaluate_cancellation_pending_due_to_non_pay(as_of))]
+        for check, kernel, expected in checks:
+            if kernel != expected:
+                mismatches.append((policy_id, check, kernel, expected))
+
+    logging.info('Cross-checked ' + str(len(policy_ids or rows)) + ' policies, '
+                 + str(len(mismatches)) + ' mismatches.')
+    return mismatches
+
+
+def write_analytics_csv(as_of, output, arrays=None):
+    """
+     Writes a row of analyze() results per policy, amounts in dollars, to
+     an open file. Returns the number of policies written.
+    """
+    results = analyze(as_of, arrays)
+    writer = csv.writer(output)
+    writer.writerow(ANALYTICS_COLUMNS)
+    for i, policy_id in enumerate(results['policy_id'].tolist()):
+        cancel_date = int(results['cancel_date'][i])
+        writer.writerow([policy_id,
+                         from_cents(int(results['balance'][i])),
+                         int(results['should_cancel'][i]),
+                         cancel_date and date.fromordinal(cancel_date) or '',
+                         int(results['pending'][i])]
+                        + [from_cents(cents) for cents in results['aging'][i].tolist()])
+    return len(results['policy_id'])
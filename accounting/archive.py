@@ -0,0 +1,124 @@
+#!/user/bin/env python2.7
+
+import random
+import time
+from datetime import datetime
+from sqlalchemy import and_, func, select
+
+from accounting import db
+from models import ArchivedInvoice, Invoice, Policy
+from statements import statement_cache
+
+import logging
+
+"""
+#######################################################
+Compaction of the invoices table. Invoices marked
+deleted by a billing schedule change are moved to
+invoices_archive in short batches, so the queries on
+current invoices only see live rows.
+#######################################################
+"""
+
+ARCHIVE_BATCH_SIZE = 500
+
+# policies sampled when timing the invoice lookups
+LATENCY_SAMPLES = 200
+
+ARCHIVED_FIELDS = ['id', 'policy_id', 'bill_date', 'due_date', 'cancel_date', 'amount_due']
+
+
+def invoice_table_stats():
+    """
+     Returns the row counts of the invoices table, how many of those are
+     deleted, and the row count of the archive.
+    """
+    invoices = Invoice.__table__
+    count = select([func.count(invoices.c.id)])
+    return {'invoices': db.session.execute(count).scalar(),
+            'deleted': db.session.execute(count.where(invoices.c.deleted == True)).scalar(),
+            'archived': db.session.execute(select([func.count(ArchivedInvoice.__table__.c.id)])).scalar()}
+
+
+def time_invoice_queries(policy_ids, date_cursor):
+    """
+     Returns the mean and worst milliseconds of the current invoice lookup
+     that return_account_balances and evaluate_cancel make, run once for
+     each of the given policies.
+    """
+    invoices = Invoice.__table__
+    timings = []
+    for policy_id in policy_ids:
+        started = time.time()
+        db.session.execute(select([invoices.c.bill_date, invoices.c.amount_due])
+                           .where(and_(invoices.c.policy_id == policy_id,
+                                       invoices.c.bill_date <= date_cursor,
+                                       invoices.c.deleted == False))).fetchall()
+        timings.append((time.time() - started) * 1000.0)
+    if not timings:
+        return {'mean_ms': 0, 'max_ms': 0}
+    return {'mean_ms': round(sum(timings) / len(timings), 3),
+            'max_ms': round(max(timings), 3)}
+
+
+def _archive_batch(after_id, batch_size, today):
+    """
+     Moves up to batch_size deleted invoices with ids above after_id to
+     the archive in one transaction. Returns the archived rows.
+    """
+    invoices = Invoice.__table__
+    rows = db.session.execute(select([getattr(invoices.c, field) for field in ARCHIVED_FIELDS])
+                              .where(and_(invoices.c.id > after_id, invoices.c.deleted == True))
+                              .order_by(invoices.c.id)
+                              .limit(batch_size)).fetchall()
+    if not rows:
+        return rows
+
+    archived = []
+    for row in rows:
+        values = dict((field, row[field]) for field in ARCHIVED_FIELDS)
+        values['archived_date'] = today
+        archived.append(values)
+    db.session.execute(ArchivedInvoice.__table__.insert(), archived)
+    db.session.execute(invoices.delete().where(invoices.c.id.in_([row.id for row in rows])))
+    db.session.commit()
+    for policy_id in set(row.policy_id for row in rows):
+        statement_cache.invalidate(policy_id)
+    return rows
+
+
+def compact_invoices(batch_size=ARCHIVE_BATCH_SIZE, samples=LATENCY_SAMPLES, vacuum=False, seed=0):
+    """
+     Moves every deleted invoice to invoices_archive, committing after each
+     batch so no transaction holds the write lock for long. Reports the
+     table counts and the current invoice lookup timings before and after,
+     over the same seeded sample of policies. With vacuum, the freed pages
+     are returned to the filesystem afterwards.
+    """
+    started = time.time()
+    today = datetime.now().date()
+    policy_ids = [row[0] for row in db.session.execute(select([Policy.__table__.c.id]))]
+    policy_ids = random.Random(seed).sample(policy_ids, min(samples, len(policy_ids)))
+    report = {'before': dict(invoice_table_stats(), **time_invoice_queries(policy_ids, today))}
+
+    archived = batches = 0
+    last_id = 0
+    while True:
+        rows = _archive_batch(last_id, batch_size, today)
+        if not rows:
+            break
+        last_id = rows[-1].id
+        archived += len(rows)
+        batches += 1
+        logging.info('Archived ' + str(archived) + ' deleted invoices')
+
+    if vacuum:
+        db.session.remove()
+        db.engine.execute('VACUUM')
+
+    report['after'] = dict(invoice_table_stats(), **time_invoice_queries(policy_ids, today))
+    report['archived'] = archived
+    report['batches'] = batches
+    report['seconds'] = round(time.time() - started, 3)
+    logging.info('Invoice compaction: ' + str(report))
+    return report
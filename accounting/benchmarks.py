@@ -0,0 +1,468 @@
+#!/user/bin/env python2.7
+
+import csv
+import gc
+import os
+import random
+import resource
+import time
+from datetime import date, timedelta
+from decimal import Decimal, ROUND_05UP
+from multiprocessing import Pool
+from sqlalchemy import Column, Integer, MetaData, NUMERIC, Table, create_engine, func, select, type_coerce
+from sqlalchemy.orm import subqueryload
+
+from accounting import app, db
+from config import DEFAULT_DATABASE_URI
+from contacts import contact_resolver
+from engine import forget_read_engines
+from export import EXPORT_TABLES, write_export
+from generator import AGENT_SHARE, generate_book, reset_database
+from instrumentation import percentile
+from migrations import add_indexes, drop_indexes
+from money import Money, from_cents, to_cents
+from models import Invoice, Payment, Policy
+from portfolio import evaluate_portfolio_cancellations, return_portfolio_balances
+from schedules import billing_schedules
+from snapshot import load_snapshot, snapshot_size
+from sweep import _reset_connections
+from tools import PolicyAccounting
+
+import logging
+
+"""
+#######################################################
+Benchmarks that run against a separate, generated
+SQLite file so accounting.sqlite is never touched.
+#######################################################
+"""
+
+# generate_book averages a little under six invoices per policy
+INVOICES_PER_POLICY = 5.7
+
+# (contacts, policies) for each benchmark scale
+SCALES = [
+    (100, 1000),
+    (1000, 10000),
+    (10000, 100000),
+]
+
+# The filters PolicyAccounting, the views and the sweep use most.
+HOT_QUERIES = [
+    ('balance_invoices',
+     'SELECT amount_due FROM invoices '
+     'WHERE policy_id = :policy_id AND bill_date <= :date_cursor AND deleted = 0'),
+    ('balance_payments',
+     'SELECT amount_paid FROM payments '
+     'WHERE policy_id = :policy_id AND transaction_date <= :date_cursor'),
+    ('pending_cancel',
+     'SELECT id FROM invoices WHERE policy_id = :policy_id AND due_date < :date_cursor '
+     'AND cancel_date > :date_cursor AND deleted = 0 LIMIT 1'),
+    ('cancel_date_sweep',
+     'SELECT policy_id FROM invoices WHERE cancel_date = :date_cursor AND deleted = 0'),
+    ('contact_lookup',
+     'SELECT id FROM contacts WHERE name = :name AND role = :role'),
+]
+
+
+def _run_hot_queries(engine, policy_count, contact_count, repeat, seed):
+    """
+     Returns {query name: {'plan': [...], 'ms_per_query': ...}}. Every run
+     uses the same seeded parameters so before and after are comparable.
+    """
+    results = {}
+    for name, sql in HOT_QUERIES:
+        rng = random.Random(seed)
+        params = []
+        for i in range(repeat):
+            contact_id = rng.randint(1, contact_count)
+            agent = contact_id <= max(1, contact_count / AGENT_SHARE)
+            params.append({'policy_id': rng.randint(1, policy_count),
+                           'date_cursor': str(date(2014, 1, 1) + timedelta(days=rng.randint(0, 1000))),
+                           'name': ('Agent ' if agent else 'Insured ') + str(contact_id),
+                           'role': 'Agent' if agent else 'Named Insured'})
+
+        plan = [row['detail'] for row in engine.execute('EXPLAIN QUERY PLAN ' + sql, **params[0])]
+        started = time.time()
+        for param in params:
+            engine.execute(sql, **param).fetchall()
+        elapsed = time.time() - started
+        results[name] = {'plan': plan, 'ms_per_query': round(elapsed * 1000.0 / repeat, 3)}
+    return results
+
+
+def benchmark_indexes(path, invoice_count=1000000, repeat=200, seed=0):
+    """
+     Generates a book of about invoice_count invoices in a new SQLite file
+     at path, times the hot queries and shows their query plans without
+     the model indexes, then adds them the way the migration does and
+     runs the same queries again.
+    """
+    engine = create_engine('sqlite:///' + path)
+    reset_database(engine)
+    drop_indexes(engine)
+
+    policy_count = max(1, int(invoice_count / INVOICES_PER_POLICY))
+    contact_count = max(2, policy_count / 5)
+    logging.info('Generating about ' + str(invoice_count) + ' invoices in ' + path)
+    generate_book(contact_count, policy_count, seed, bind=engine)
+
+    before = _run_hot_queries(engine, policy_count, contact_count, repeat, seed)
+    started = time.time()
+    created = add_indexes(engine)
+    migration_seconds = time.time() - started
+    after = _run_hot_queries(engine, policy_count, contact_count, repeat, seed)
+
+    return {'invoices': engine.execute('SELECT count(*) FROM invoices').scalar(),
+            'policies': policy_count,
+            'indexes_created': created,
+            'migration_seconds': round(migration_seconds, 3),
+            'before': before,
+            'after': after}
+
+
+def _time(func, runs):
+    """
+     Calls func once per item in runs and returns the mean and worst
+     milliseconds per call.
+    """
+    timings = []
+    for run in runs:
+        started = time.time()
+        func(run)
+        timings.append((time.time() - started) * 1000.0)
+    return {'mean_ms': round(sum(timings) / len(timings), 3),
+            'max_ms': round(max(timings), 3),
+            'runs': len(timings)}
+
+
+def _benchmark_scale(contact_count, policy_count, samples, seed):
+    """
+     Regenerates the app's database at one scale and times every
+     PolicyAccounting operation, the portfolio functions and the page
+     routes. The reads share one seeded sample of policies and each
+     write route has its own.
+    """
+    reset_database()
+    db.session.remove()
+    started = time.time()
+    counts = generate_book(contact_count, policy_count, seed)
+    contact_resolver.clear()
+    generate_seconds = time.time() - started
+
+    rng = random.Random(seed)
+    date_cursor = date(2015, 6, 1)
+
+    def sample():
+        return [rng.randint(1, policy_count) for i in range(samples)]
+
+    # the write routes each get their own sample so one doesn't time
+    # another's leftovers
+    policy_ids = sample()
+    payment_ids, billing_ids, insured_ids = sample(), sample(), sample()
+    schedules = sorted(billing_schedules)
+    client = app.test_client()
+
+    def accounting(policy_id, read_only=True):
+        return PolicyAccounting(policy_id, read_only=read_only)
+
+    operations = {
+        'return_account_balance':
+            _time(lambda pid: accounting(pid).return_account_balance(date_cursor), policy_ids),
+        'evaluate_cancel':
+            _time(lambda pid: accounting(pid).evaluate_cancel(date_cursor), policy_ids),
+        'evaluate_cancellation_pending_due_to_non_pay':
+            _time(lambda pid: accounting(pid).evaluate_cancellation_pending_due_to_non_pay(date_cursor),
+                  policy_ids),
+        'make_invoices':
+            _time(lambda pid: accounting(pid, read_only=False).make_invoices(), policy_ids),
+        'return_portfolio_balances':
+            _time(lambda run: return_portfolio_balances(date_cursor), [None]),
+        'evaluate_portfolio_cancellations':
+            _time(lambda run: evaluate_portfolio_cancellations(date_cursor), [None]),
+    }
+    routes = {
+        '/':
+            _time(lambda pid: client.get('/'), policy_ids),
+        '/policy/':
+            _time(lambda pid: client.post('/policy/', data={'id': pid, 'date': str(date_cursor)}),
+                  policy_ids),
+        '/maintenance/':
+            _time(lambda pid: client.post('/maintenance/', data={'id': pid, 'date': str(date_cursor)}),
+                  policy_ids),
+        '/payment/':
+            _time(lambda pid: client.post('/payment/', data={'id': pid, 'payment_amount': '100.00'}),
+                  payment_ids),
+        '/billing/':
+            _time(lambda pid: client.post('/billing/', data={'id': pid, 'new_billing': rng.choice(schedules),
+                                                              'change_date': str(date_cursor)}),
+                  billing_ids),
+        '/insured/':
+            _time(lambda pid: client.post('/insured/', data={'id': pid, 'new_insured': 'Insured ' + str(pid)}),
+                  insured_ids),
+    }
+    db.session.remove()
+
+    return {'rows': counts,
+            'generate_seconds': round(generate_seconds, 3),
+            'operations': operations,
+            'routes': routes}
+
+
+def run_benchmarks(scales=None, samples=50, seed=0):
+    """
+     Times each PolicyAccounting operation and Flask route at every
+     (contacts, policies) scale. The app's database is regenerated for
+     each scale, so this refuses to run against accounting.sqlite; point
+     ACCOUNTING_DATABASE_URI at a scratch file first.
+    """
+    if app.config['SQLALCHEMY_DATABASE_URI'] == DEFAULT_DATABASE_URI:
+        raise ValueError('Refusing to overwrite accounting.sqlite, set ACCOUNTING_DATABASE_URI.')
+
+    results = {'seed': seed, 'samples': samples, 'scales': {}}
+    for contact_count, policy_count in scales or SCALES:
+        logging.info('Benchmarking ' + str(policy_count) + ' policies')
+        results['scales'][str(policy_count)] = _benchmark_scale(contact_count, policy_count, samples, seed)
+    return results
+
+
+def benchmark_money(rows=100000, repeat=5, seed=0):
+    """
+     Sums the same seeded amounts stored the old way, as NUMERIC dollars
+     read back as Decimals and rounded to the cent, and the new way, as
+     Money cents added up as integers and converted once. Both are timed
+     summing in Python over the selected rows and summing in SQL, in a
+     scratch in-memory database.
+    """
+    engine = create_engine('sqlite://')
+    metadata = MetaData()
+    numeric = Table('amounts_numeric', metadata, Column('amount', NUMERIC(), nullable=False))
+    money = Table('amounts_money', metadata, Column('amount', Money(), nullable=False))
+    metadata.create_all(engine)
+
+    # installments of premiums that don't always divide into whole cents
+    rng = random.Random(seed)
+    amounts = [Decimal(rng.randint(300, 5000)) / rng.choice([1, 2, 4, 12]) for i in range(rows)]
+    engine.execute(numeric.insert(), [{'amount': amount} for amount in amounts])
+    engine.execute(money.insert(), [{'amount': from_cents(to_cents(amount))} for amount in amounts])
+
+    cents = Decimal('.01')
+    before = {
+        'python_sum': _time(lambda run: sum((row[0] for row in engine.execute(select([numeric.c.amount]))),
+                                            Decimal(0)).quantize(cents, ROUND_05UP), range(repeat)),
+        'sql_sum': _time(lambda run: engine.execute(select([func.sum(numeric.c.amount)])).scalar()
+                                                    .quantize(cents, ROUND_05UP), range(repeat)),
+    }
+    after = {
+        'python_sum': _time(lambda run: from_cents(sum(row[0] for row in engine.execute(
+            select([type_coerce(money.c.amount, Integer)])))), range(repeat)),
+        'sql_sum': _time(lambda run: from_cents(engine.execute(
+            select([func.sum(money.c.amount, type_=Integer)])).scalar()), range(repeat)),
+    }
+    return {'rows': rows,
+            'totals': {'before': str(sum(amounts, Decimal(0)).quantize(cents, ROUND_05UP)),
+                       'after': str(from_cents(sum(to_cents(amount) for amount in amounts)))},
+            'before': before,
+            'after': after}
+
+
+def _resident_bytes():
+    # Linux only; the second field of statm is the resident set in pages
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def _measure_load(loader):
+    """
+     Runs in a fresh worker process so each loader starts from the same
+     heap. Returns the resident memory the loaded policies added and the
+     seconds it took.
+    """
+    gc.collect()
+    before = _resident_bytes()
+    started = time.time()
+    loaded = LOADERS[loader]()
+    seconds = time.time() - started
+    gc.collect()
+    return {'policies': len(loaded),
+            'seconds': round(seconds, 3),
+            'bytes': _resident_bytes() - before}
+
+
+def _load_orm():
+    return Policy.query.options(subqueryload('invoices'), subqueryload('payments')).all()
+
+
+LOADERS = {'orm': _load_orm, 'snapshot': load_snapshot}
+
+
+def benchmark_snapshot(date_cursor=date(2015, 6, 1)):
+    """
+     Compares the resident memory per policy of loading every policy with
+     its invoices and payments as ORM instances and as a snapshot, each
+     in its own process, and times evaluating the whole book from the
+     snapshot. Run it against a generated book.
+    """
+    results = {}
+    for loader in sorted(LOADERS):
+        pool = Pool(1, initializer=_reset_connections)
+        try:
+            results[loader] = pool.apply(_measure_load, (loader,))
+        finally:
+            pool.close()
+            pool.join()
+        results[loader]['bytes_per_policy'] = results[loader]['bytes'] / max(1, results[loader]['policies'])
+
+    snapshots = load_snapshot()
+    results['snapshot']['estimated_bytes_per_policy'] = snapshot_size(snapshots) / max(1, len(snapshots))
+    started = time.time()
+    for snapshot in snapshots.itervalues():
+        snapshot.return_account_balance(date_cursor)
+        snapshot.evaluate_cancel(date_cursor)
+        snapshot.evaluate_cancellation_pending_due_to_non_pay(date_cursor)
+    results['snapshot']['evaluate_seconds'] = round(time.time() - started, 3)
+    return results
+
+
+def _peak_resident_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _measure_export(args):
+    """
+     Runs in a fresh worker process. Writes the table to /dev/null, either
+     from every ORM instance loaded at once or through write_export, and
+     returns how far the peak resident memory rose and the seconds taken.
+    """
+    table, mode = args
+    gc.collect()
+    before = _peak_resident_bytes()
+    started = time.time()
+    with open(os.devnull, 'wb') as output:
+        if mode == 'orm':
+            model = {'invoices': Invoice, 'payments': Payment}[table]
+            columns = [column.name for column in EXPORT_TABLES[table].columns]
+            writer = csv.writer(output)
+            writer.writerow(columns)
+            instances = model.query.order_by(model.id).all()
+            for instance in instances:
+                writer.writerow([getattr(instance, column) for column in columns])
+            rows = len(instances)
+        else:
+            rows = write_export(table, output)['rows']
+    return {'rows': rows,
+            'seconds': round(time.time() - started, 3),
+            'peak_bytes': _peak_resident_bytes() - before}
+
+
+def benchmark_export(table='invoices'):
+    """
+     Compares the peak memory of exporting a table as ORM instances loaded
+     with all() and with the streaming export, each in its own process.
+     Run it against generated books of different sizes; the streaming
+     peak should not grow with the row count.
+    """
+    results = {}
+    for mode in ['orm', 'stream']:
+        pool = Pool(1, initializer=_reset_connections)
+        try:
+            results[mode] = pool.apply(_measure_export, ((table, mode),))
+        finally:
+            pool.close()
+            pool.join()
+    return results
+
+
+# what the app ran with before the SQLite settings existed
+SQLITE_DEFAULTS = {'SQLITE_JOURNAL_MODE': 'DELETE',
+                   'SQLITE_SYNCHRONOUS': 'FULL',
+                   'SQLITE_BUSY_TIMEOUT_MS': None,
+                   'SQLITE_CACHE_SIZE_KB': None,
+                   'SQLITE_MMAP_SIZE': None,
+                   'READ_POOL_SIZE': 0}
+
+
+def _apply_settings(settings):
+    app.config.update(settings)
+    db.session.remove()
+    db.engine.dispose()
+    forget_read_engines()
+    # switches the file's journal mode now, before other connections open
+    db.engine.execute('SELECT 1')
+
+
+def _concurrency_worker(args):
+    """
+     Runs in a worker process. Posts count payments or reads count
+     balance histories on seeded random policies through the test client
+     and returns the milliseconds each took and how many failed.
+    """
+    role, settings, count, policy_count, seed = args
+    _apply_settings(settings)
+    rng = random.Random(seed)
+    client = app.test_client()
+    timings = []
+    failed = 0
+    for i in range(count):
+        policy_id = rng.randint(1, policy_count)
+        started = time.time()
+        if role == 'payment':
+            response = client.post('/payment/', data={'id': policy_id, 'payment_amount': '1.00'})
+        else:
+            response = client.get('/api/policies/' + str(policy_id) + '/balances?dates=2015-03-01,2015-09-01')
+        timings.append((time.time() - started) * 1000.0)
+        if response.status_code != 200:
+            failed += 1
+    return {'role': role, 'timings': timings, 'failed': failed}
+
+
+def _run_concurrency(settings, writers, readers, payments, reads, policy_count, seed):
+    _apply_settings(settings)
+    db.session.remove()
+    jobs = [('payment', settings, payments, policy_count, seed + i) for i in range(writers)] \
+        + [('read', settings, reads, policy_count, seed + writers + i) for i in range(readers)]
+    pool = Pool(len(jobs), initializer=_reset_connections)
+    try:
+        started = time.time()
+        results = pool.map(_concurrency_worker, jobs, chunksize=1)
+        seconds = time.time() - started
+    finally:
+        pool.close()
+        pool.join()
+
+    summary = {'seconds': round(seconds, 3)}
+    for role in ['payment', 'read']:
+        timings = sorted(ms for result in results if result['role'] == role for ms in result['timings'])
+        failed = sum(result['failed'] for result in results if result['role'] == role)
+        summary[role] = {'requests': len(timings),
+                         'failed': failed,
+                         'p50_ms': round(percentile(timings, 50) or 0, 3),
+                         'p99_ms': round(percentile(timings, 99) or 0, 3)}
+    summary['payment']['per_second'] = round((summary['payment']['requests'] - summary['payment']['failed'])
+                                             / seconds, 1)
+    return summary
+
+
+def benchmark_concurrency(writers=4, readers=4, payments=200, reads=200, contact_count=1000,
+                          policy_count=10000, seed=0):
+    """
+     Regenerates the app's database and has writer processes post
+     payments while reader processes fetch balance histories, first with
+     SQLite's defaults and no read pool, then with the app's SQLite
+     settings. Reports payment throughput and failures and read latency.
+     Refuses to run against accounting.sqlite, like run_benchmarks.
+    """
+    if app.config['SQLALCHEMY_DATABASE_URI'] == DEFAULT_DATABASE_URI:
+        raise ValueError('Refusing to overwrite accounting.sqlite, set ACCOUNTING_DATABASE_URI.')
+    tuned = dict((key, app.config.get(key)) for key in SQLITE_DEFAULTS)
+
+    reset_database()
+    db.session.remove()
+    generate_book(contact_count, policy_count, seed)
+    results = {'writers': writers, 'readers': readers, 'policies': policy_count}
+    for name, settings in [('defaults', SQLITE_DEFAULTS), ('tuned', tuned)]:
+        logging.info('Concurrency benchmark with ' + name + ' settings')
+        results[name] = _run_concurrency(settings, writers, readers, payments, reads, policy_count, seed)
+    _apply_settings(tuned)
+    return results
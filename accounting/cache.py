@@ -0,0 +1,96 @@
+#!/user/bin/env python2.7
+
+import time
+from collections import OrderedDict
+
+"""
+#######################################################
+Small in-process caches with hit/miss counters.
+#######################################################
+"""
+
+
+class LRUCache(object):
+
+    """
+     A dict-like cache that holds at most maxsize entries, evicting the
+     least recently used one when it is full.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """
+         Returns the cached value and marks it as recently used, or
+         default if the key isn't cached.
+        """
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+         Caches a value, evicting the least recently used entry if needed.
+        """
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        """
+         Returns the counters as a dict so they can be logged or served.
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.entries),
+                'maxsize': self.maxsize}
+
+
+class TTLCache(LRUCache):
+
+    """
+     An LRUCache whose entries also expire ttl seconds after they were
+     cached. Expired entries are dropped when they are next looked up.
+    """
+    def __init__(self, maxsize, ttl, clock=time.time):
+        super(TTLCache, self).__init__(maxsize)
+        self.ttl = ttl
+        self.clock = clock
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        entry = super(TTLCache, self).get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires <= self.clock():
+            self.entries.pop(key)
+            self.hits -= 1
+            self.misses += 1
+            self.expirations += 1
+            return default
+        return value
+
+    def put(self, key, value):
+        super(TTLCache, self).put(key, (self.clock() + self.ttl, value))
+
+    def stats(self):
+        stats = super(TTLCache, self).stats()
+        stats['expirations'] = self.expirations
+        stats['ttl'] = self.ttl
+        return stats
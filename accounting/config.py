@@ -1,3 +1,27 @@
 import os
 
-SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.abspath("accounting.sqlite")
+DEFAULT_DATABASE_URI = 'sqlite:///' + os.path.abspath("accounting.sqlite")
+
+# Benchmarks and generated books point the app at another file with this.
+SQLALCHEMY_DATABASE_URI = os.environ.get('ACCOUNTING_DATABASE_URI', DEFAULT_DATABASE_URI)
+
+# Per-request SQL and timing instrumentation (accounting/instrumentation.py).
+# With it on, requests slower than PROFILE_THRESHOLD_MS get a cProfile dump
+# in PROFILE_DIR; a threshold of 0 turns profiling off.
+INSTRUMENTATION = os.environ.get('ACCOUNTING_INSTRUMENTATION') == '1'
+PROFILE_THRESHOLD_MS = float(os.environ.get('ACCOUNTING_PROFILE_THRESHOLD_MS', 0))
+PROFILE_DIR = os.environ.get('ACCOUNTING_PROFILE_DIR', os.path.abspath("profiles"))
+
+# SQLite settings applied to every new connection (accounting/engine.py).
+# WAL lets reads run alongside a write, synchronous NORMAL skips the fsync
+# on each commit that WAL makes unnecessary, and writers wait up to the
+# busy timeout for the lock instead of failing. None leaves SQLite's default.
+SQLITE_JOURNAL_MODE = os.environ.get('ACCOUNTING_SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.environ.get('ACCOUNTING_SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('ACCOUNTING_SQLITE_BUSY_TIMEOUT_MS', 10000))
+SQLITE_CACHE_SIZE_KB = int(os.environ.get('ACCOUNTING_SQLITE_CACHE_SIZE_KB', 16384))
+SQLITE_MMAP_SIZE = int(os.environ.get('ACCOUNTING_SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+
+# Connections kept open for the read-only routes; 0 sends them through the
+# same engine as the writes.
+READ_POOL_SIZE = int(os.environ.get('ACCOUNTING_READ_POOL_SIZE', 5))
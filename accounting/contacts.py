@@ -0,0 +1,187 @@
+#!/user/bin/env python2.7
+
+from collections import namedtuple
+from sqlalchemy import and_, event, select
+from sqlalchemy.orm import Session
+
+from accounting import db
+from models import Contact
+
+import logging
+
+"""
+#######################################################
+In-memory index of contacts by id and by (name, role),
+so resolving an agent or insured doesn't cost a query
+each time. Kept coherent through SQLAlchemy events.
+#######################################################
+"""
+
+LOOKUP_CHUNK_SIZE = 500
+
+ContactRef = namedtuple('ContactRef', ['id', 'name', 'role'])
+
+
+class ContactResolver(object):
+
+    """
+     Maps (name, role) to the first contact id with that name and role,
+     and contact ids to ContactRefs. Warmed with one query on first use.
+     Contacts inserted through the ORM are indexed as they are flushed;
+     a rollback after such an insert, or any bulk update or delete of
+     contacts, empties the index so it is rebuilt on next use.
+    """
+    def __init__(self):
+        self.by_key = {}
+        self.by_id = {}
+        self.warmed = False
+        self.uncommitted = False
+        self.queries = 0
+
+    def warm(self):
+        self.clear()
+        contacts = Contact.__table__
+        for row in db.session.execute(select([contacts.c.id, contacts.c.name, contacts.c.role])
+                                      .order_by(contacts.c.id)):
+            self._index(ContactRef(row.id, row.name, row.role))
+        self.queries += 1
+        self.warmed = True
+        logging.debug('Contact index warmed with ' + str(len(self.by_id)) + ' contacts.')
+
+    def clear(self):
+        self.by_key.clear()
+        self.by_id.clear()
+        self.warmed = False
+
+    def _index(self, contact):
+        self.by_id[contact.id] = contact
+        # keep the lowest id, like the first() queries this replaces
+        if self.by_key.get((contact.name, contact.role), contact.id) >= contact.id:
+            self.by_key[(contact.name, contact.role)] = contact.id
+
+    def _query(self, clause):
+        """
+         Falls back to the database for contacts another process may have
+         added since the index was warmed.
+        """
+        contacts = Contact.__table__
+        self.queries += 1
+        row = db.session.execute(select([contacts.c.id, contacts.c.name, contacts.c.role])
+                                 .where(clause)
+                                 .order_by(contacts.c.id)
+                                 .limit(1)).first()
+        if row is None:
+            return None
+        contact = ContactRef(row.id, row.name, row.role)
+        self._index(contact)
+        return contact
+
+    def find(self, name, role):
+        """
+         Returns the id of the first contact with this name and role, or
+         None if there isn't one.
+        """
+        if not self.warmed:
+            self.warm()
+        contact_id = self.by_key.get((name, role))
+        if contact_id is None:
+            contacts = Contact.__table__
+            contact = self._query(and_(contacts.c.name == name, contacts.c.role == role))
+            contact_id = contact and contact.id
+        return contact_id
+
+    def get(self, contact_id):
+        """
+         Returns the ContactRef for an id, or None if there isn't one.
+        """
+        if contact_id is None:
+            return None
+        if not self.warmed:
+            self.warm()
+        contact = self.by_id.get(contact_id)
+        if contact is None:
+            contact = self._query(Contact.__table__.c.id == contact_id)
+        return contact
+
+    def create(self, name, role):
+        """
+         Adds a contact and flushes it to get its id. The caller commits,
+         along with whatever it is creating the contact for.
+        """
+        logging.info('Adding new ' + role + ' ' + name + ' to db.')
+        contact = Contact(name, role)
+        db.session.add(contact)
+        db.session.flush()
+        return contact.id
+
+    def get_or_create(self, name, role):
+        """
+         Returns the id of the first contact with this name and role,
+         creating the contact if there isn't one.
+        """
+        return self.find(name, role) or self.create(name, role)
+
+    def get_or_create_many(self, keys):
+        """
+         Returns {(name, role): id} for every key, looking up the ones the
+         index doesn't have in one query per few hundred names and creating
+         whichever are still missing in a single flush.
+        """
+        if not self.warmed:
+            self.warm()
+        contacts = Contact.__table__
+        missing = sorted(set(key for key in keys if key not in self.by_key))
+        names = sorted(set(name for name, role in missing))
+        for start in range(0, len(names), LOOKUP_CHUNK_SIZE):
+            self.queries += 1
+            for row in db.session.execute(select([contacts.c.id, contacts.c.name, contacts.c.role])
+                                          .where(contacts.c.name.in_(names[start:start + LOOKUP_CHUNK_SIZE]))):
+                self._index(ContactRef(row.id, row.name, row.role))
+
+        created = [Contact(name, role) for name, role in missing if (name, role) not in self.by_key]
+        if created:
+            logging.info('Adding ' + str(len(created)) + ' new contacts to db.')
+            db.session.add_all(created)
+            # _contact_inserted indexes them as they flush
+            db.session.flush()
+        return dict((key, self.by_key[key]) for key in keys)
+
+    def stats(self):
+        return {'contacts': len(self.by_id), 'warmed': self.warmed, 'queries': self.queries}
+
+
+contact_resolver = ContactResolver()
+
+
+def _contact_inserted(mapper, connection, target):
+    if contact_resolver.warmed:
+        contact_resolver._index(ContactRef(target.id, target.name, target.role))
+        contact_resolver.uncommitted = True
+
+
+def _contact_changed(*args):
+    contact_resolver.clear()
+
+
+def _committed(session):
+    contact_resolver.uncommitted = False
+
+
+def _rolled_back(session):
+    if contact_resolver.uncommitted:
+        contact_resolver.uncommitted = False
+        contact_resolver.clear()
+
+
+def _bulk_changed(session, query, query_context, result):
+    if any(entity.get('type') is Contact for entity in query.column_descriptions):
+        contact_resolver.clear()
+
+
+event.listen(Contact, 'after_insert', _contact_inserted)
+event.listen(Contact, 'after_update', _contact_changed)
+event.listen(Contact, 'after_delete', _contact_changed)
+event.listen(Session, 'after_commit', _committed)
+event.listen(Session, 'after_rollback', _rolled_back)
+event.listen(Session, 'after_bulk_update', _bulk_changed)
+event.listen(Session, 'after_bulk_delete', _bulk_changed)
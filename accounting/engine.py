@@ -0,0 +1,141 @@
+#!/user/bin/env python2.7
+
+import sqlite3
+from functools import wraps
+from threading import Lock
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import Pool, QueuePool
+
+from accounting import app, db
+import instrumentation
+
+import logging
+
+"""
+#######################################################
+SQLite connection management. Every new connection gets
+the journal mode, busy timeout, synchronous level and
+cache PRAGMAs from config.py, and read-only routes use
+their own pool of query_only connections so they keep
+their page cache and don't queue behind payments.
+#######################################################
+"""
+
+# (config key, PRAGMA) in the order they are applied; the busy timeout
+# goes first so switching the journal mode waits out other connections
+SQLITE_PRAGMAS = [('SQLITE_BUSY_TIMEOUT_MS', 'busy_timeout'),
+                  ('SQLITE_JOURNAL_MODE', 'journal_mode'),
+                  ('SQLITE_SYNCHRONOUS', 'synchronous'),
+                  ('SQLITE_CACHE_SIZE_KB', 'cache_size'),
+                  ('SQLITE_MMAP_SIZE', 'mmap_size')]
+
+read_engines = {}
+read_engines_lock = Lock()
+
+
+def sqlite_pragmas(config):
+    """
+     Returns the PRAGMA statements for the settings in config, leaving
+     out any that are None so SQLite's default applies.
+    """
+    statements = []
+    for key, pragma in SQLITE_PRAGMAS:
+        value = config.get(key)
+        if value is None:
+            continue
+        if key == 'SQLITE_CACHE_SIZE_KB':
+            # a negative cache_size is in KiB rather than pages
+            value = -int(value)
+        statements.append('PRAGMA ' + pragma + ' = ' + str(value))
+    return statements
+
+
+def _execute_all(dbapi_connection, statements):
+    cursor = dbapi_connection.cursor()
+    try:
+        for statement in statements:
+            cursor.execute(statement)
+    finally:
+        cursor.close()
+
+
+def _tune_connection(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        _execute_all(dbapi_connection, sqlite_pragmas(app.config))
+
+
+def _read_only_connection(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        _execute_all(dbapi_connection, ['PRAGMA query_only = ON'])
+
+
+def install_sqlite_tuning():
+    """
+     Applies the SQLite settings to every connection any engine opens
+     from now on, the app's and the ones batch jobs create for scratch
+     files alike.
+    """
+    event.listen(Pool, 'connect', _tune_connection)
+    logging.info('SQLite tuning installed: ' + '; '.join(sqlite_pragmas(app.config)))
+
+
+def read_engine():
+    """
+     Returns the engine for read-only routes on the app's database: a
+     pool of READ_POOL_SIZE query_only connections, created on first use.
+     Returns db.engine itself when READ_POOL_SIZE is 0 or the database is
+     in memory, where a second engine would see a different database.
+    """
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    url = make_url(uri)
+    if not app.config.get('READ_POOL_SIZE') or \
+            (url.drivername.startswith('sqlite') and url.database in (None, '', ':memory:')):
+        return db.engine
+
+    with read_engines_lock:
+        engine = read_engines.get(uri)
+        if engine is None:
+            connect_args = {}
+            if url.drivername.startswith('sqlite'):
+                # the pool hands each connection to one thread at a time
+                connect_args['check_same_thread'] = False
+            engine = create_engine(uri, poolclass=QueuePool, pool_size=app.config['READ_POOL_SIZE'],
+                                   connect_args=connect_args)
+            event.listen(engine, 'connect', _read_only_connection)
+            read_engines[uri] = engine
+    if instrumentation.instrumentation is not None:
+        instrumentation.instrumentation.watch(engine)
+    return engine
+
+
+def forget_read_engines():
+    """
+     Drops the read pools without closing their connections, for forked
+     workers that must not touch the parent's.
+    """
+    with read_engines_lock:
+        read_engines.clear()
+
+
+def use_read_session():
+    """
+     Replaces the current db.session with one on the read engine until it
+     is next removed, which Flask-SQLAlchemy does when the request ends.
+    """
+    engine = read_engine()
+    db.session.remove()
+    if engine is not db.engine:
+        db.session.registry.set(Session(bind=engine, autoflush=False))
+
+
+def read_only_route(view):
+    """
+     Runs a view that only reads on the read pool.
+    """
+    @wraps(view)
+    def read_only_view(*args, **kwargs):
+        use_read_session()
+        return view(*args, **kwargs)
+    return read_only_view
@@ -0,0 +1,165 @@
+#!/user/bin/env python2.7
+
+import csv
+import json
+from cStringIO import StringIO
+from datetime import date
+from decimal import Decimal
+from sqlalchemy import and_, func, select
+
+from accounting import db
+from models import Invoice, Payment
+
+import logging
+
+"""
+#######################################################
+Streaming exports of the invoices and payments tables
+for the finance warehouse. Rows are read from one
+cursor a batch at a time, without ORM objects, and
+written as CSV or newline-delimited JSON as they
+arrive, so memory stays flat however large the table.
+#######################################################
+"""
+
+EXPORT_BATCH_SIZE = 1000
+
+EXPORT_FORMATS = ['csv', 'ndjson']
+
+EXPORT_TABLES = {'invoices': Invoice.__table__,
+                 'payments': Payment.__table__}
+
+# the column a date watermark applies to
+EXPORT_DATE_COLUMNS = {'invoices': 'bill_date',
+                       'payments': 'transaction_date'}
+
+
+class ExportError(Exception):
+    pass
+
+
+def _check_export(name, format='csv'):
+    if name not in EXPORT_TABLES:
+        raise ExportError('Unknown table ' + name + '.')
+    if format not in EXPORT_FORMATS:
+        raise ExportError('Format must be one of ' + ', '.join(EXPORT_FORMATS) + '.')
+
+
+def _export_filter(name, since_id=None, since_date=None, until_id=None):
+    table = EXPORT_TABLES[name]
+    clauses = []
+    if since_id is not None:
+        clauses.append(table.c.id > since_id)
+    if until_id is not None:
+        clauses.append(table.c.id <= until_id)
+    if since_date is not None:
+        clauses.append(table.c[EXPORT_DATE_COLUMNS[name]] >= since_date)
+    return and_(*clauses)
+
+
+def export_watermark(name, since_id=None, since_date=None):
+    """
+     Returns the highest id in the table above since_id, or since_id (0
+     without one) if there is none. since_date only narrows the rows, so
+     an export that matches nothing still moves the watermark past the
+     ids it looked at. Passing it as until_id fixes the rows of an export
+     while it streams, and as since_id the next export starts where this
+     one ended.
+
+     The watermark only follows new rows. Invoices deleted by a billing
+     change keep their ids and archived ones leave the table, so the
+     warehouse needs a periodic full export, without since_id, to pick
+     those up.
+    """
+    _check_export(name)
+    table = EXPORT_TABLES[name]
+    watermark = db.session.execute(select([func.max(table.c.id)])
+                                   .where(_export_filter(name, since_id))).scalar()
+    if watermark is None:
+        return since_id or 0
+    return watermark
+
+
+def iter_export_batches(name, since_id=None, since_date=None, until_id=None, batch_size=EXPORT_BATCH_SIZE):
+    """
+     Yields lists of up to batch_size rows of the table in id order, all
+     of them or only those with ids above since_id, ids up to until_id and
+     dates on or after since_date. The rows come from a single streaming
+     cursor, a server-side one where the driver has them.
+    """
+    _check_export(name)
+    table = EXPORT_TABLES[name]
+    query = select([table])\
+        .where(_export_filter(name, since_id, since_date, until_id))\
+        .order_by(table.c.id)\
+        .execution_options(stream_results=True)
+    result = db.session.execute(query)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        result.close()
+
+
+def _json_value(value):
+    if isinstance(value, (date, Decimal)):
+        return str(value)
+    return value
+
+
+def _csv_value(value):
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def _format_header(columns, format):
+    if format != 'csv':
+        return ''
+    chunk = StringIO()
+    csv.writer(chunk).writerow(columns)
+    return chunk.getvalue()
+
+
+def _format_rows(columns, rows, format):
+    if format == 'csv':
+        chunk = StringIO()
+        csv.writer(chunk).writerows([_csv_value(value) for value in row] for row in rows)
+        return chunk.getvalue()
+    return ''.join(json.dumps(dict(zip(columns, [_json_value(value) for value in row])), sort_keys=True) + '\n'
+                   for row in rows)
+
+
+def iter_export(name, format='csv', since_id=None, since_date=None, until_id=None,
+                batch_size=EXPORT_BATCH_SIZE):
+    """
+     Yields the table export as text, one chunk per batch of rows, with a
+     header line first for CSV. Amounts are in dollars and dates are
+     yyyy-mm-dd in both formats.
+    """
+    _check_export(name, format)
+    columns = [column.name for column in EXPORT_TABLES[name].columns]
+    yield _format_header(columns, format)
+    for rows in iter_export_batches(name, since_id, since_date, until_id, batch_size):
+        yield _format_rows(columns, rows, format)
+
+
+def write_export(name, output, format='csv', since_id=None, since_date=None,
+                 batch_size=EXPORT_BATCH_SIZE):
+    """
+     Writes the table export to an open file. Returns the number of rows
+     written and the watermark to pass as since_id next time.
+    """
+    _check_export(name, format)
+    watermark = export_watermark(name, since_id, since_date)
+    columns = [column.name for column in EXPORT_TABLES[name].columns]
+    output.write(_format_header(columns, format))
+    exported = 0
+    for rows in iter_export_batches(name, since_id, since_date, watermark, batch_size):
+        output.write(_format_rows(columns, rows, format))
+        exported += len(rows)
+    logging.info('Exported ' + str(exported) + ' ' + name + ' up to id ' + str(watermark) + '.')
+    return {'table': name, 'rows': exported, 'watermark': watermark}
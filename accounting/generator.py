@@ -0,0 +1,165 @@
+#!/user/bin/env python2.7
+
+import random
+from collections import namedtuple
+from datetime import date, timedelta
+from decimal import Decimal
+
+from accounting import db
+from ledger import ledger_rows
+from migrations import stamp_schema_version
+from models import Contact, Invoice, LedgerEntry, Payment, Policy
+from money import from_cents, split_cents, to_cents
+from schedules import billing_schedules, invoice_schedule
+
+import logging
+
+"""
+#######################################################
+Seeded generator for large synthetic books of business.
+The same arguments always produce the same rows, so
+benchmark results can be compared between commits.
+#######################################################
+"""
+
+POLICY_BATCH_SIZE = 2000
+
+# roughly one agent for every 20 named insureds
+AGENT_SHARE = 20
+
+GeneratedInvoice = namedtuple('GeneratedInvoice', ['bill_date', 'amount_due'])
+GeneratedPayment = namedtuple('GeneratedPayment', ['transaction_date', 'amount_paid'])
+
+
+def reset_database(bind=None):
+    """
+     Drops and recreates every table on the given engine, defaulting to
+     the app's database.
+    """
+    bind = bind or db.engine
+    db.metadata.drop_all(bind=bind)
+    db.metadata.create_all(bind=bind)
+    stamp_schema_version(bind)
+
+
+def _insert(conn, table, rows):
+    if rows:
+        conn.execute(table.insert(), rows)
+
+
+def _generate_policy(rng, policy_id, agent_count, contact_count, start_date, as_of):
+    """
+     Returns the (policy, invoices, payments, ledger) rows for one policy.
+     About a fifth of the policies changed billing schedule once, leaving
+     a deleted set of invoices behind. Most invoices are paid by the
+     insured before the due date, some by the agent during the pending
+     cancellation window, and the rest not at all.
+    """
+    schedules = sorted(billing_schedules)
+    effective_date = start_date + timedelta(days=rng.randint(0, 729))
+    premium = Decimal(rng.randint(300, 5000))
+    schedule = rng.choice(schedules)
+    agent = rng.randint(1, agent_count)
+    insured = rng.randint(agent_count + 1, contact_count)
+
+    policy = {'id': policy_id,
+              'policy_number': 'Policy ' + str(policy_id),
+              'effective_date': effective_date,
+              'status': 'Active',
+              'billing_schedule': schedule,
+              'annual_premium': premium,
+              'named_insured': insured,
+              'agent': agent}
+
+    layouts = [schedule]
+    if rng.random() < 0.2:
+        layouts.insert(0, rng.choice(schedules))
+
+    invoices = []
+    payments = []
+    current_invoices = []
+    current_payments = []
+    for i, layout in enumerate(layouts):
+        deleted = i < len(layouts) - 1
+        amounts = split_cents(to_cents(premium), billing_schedules[layout])
+        for (bill_date, due_date, cancel_date), amount in zip(invoice_schedule(layout, effective_date), amounts):
+            amount = from_cents(amount)
+            invoices.append({'policy_id': policy_id,
+                             'bill_date': bill_date,
+                             'due_date': due_date,
+                             'cancel_date': cancel_date,
+                             'amount_due': amount,
+                             'deleted': deleted})
+            if deleted:
+                continue
+            current_invoices.append(GeneratedInvoice(bill_date, amount))
+
+            chance = rng.random()
+            if chance < 0.85:
+                payer = insured
+                paid_on = bill_date + timedelta(days=rng.randint(0, (due_date - bill_date).days))
+            elif chance < 0.92:
+                payer = agent
+                paid_on = due_date + timedelta(days=rng.randint(1, (cancel_date - due_date).days - 1))
+            else:
+                continue
+            if paid_on > as_of:
+                continue
+            payments.append({'policy_id': policy_id,
+                             'contact_id': payer,
+                             'amount_paid': amount,
+                             'transaction_date': paid_on})
+            current_payments.append(GeneratedPayment(paid_on, amount))
+
+    return policy, invoices, payments, ledger_rows(policy_id, current_invoices, current_payments)
+
+
+def generate_book(contact_count, policy_count, seed=0, bind=None,
+                  start_date=date(2014, 1, 1), as_of=date(2016, 1, 1)):
+    """
+     Writes contact_count contacts and policy_count policies, with their
+     invoices, payments and ledger rows, into empty tables using
+     executemany inserts. Policies start within two years of start_date
+     and no payment is dated after as_of. Returns the row counts.
+    """
+    bind = bind or db.engine
+    rng = random.Random(seed)
+    contact_count = max(2, contact_count)
+    agent_count = max(1, contact_count / AGENT_SHARE)
+
+    conn = bind.connect()
+    counts = {'contacts': contact_count, 'policies': policy_count,
+              'invoices': 0, 'payments': 0, 'ledger': 0}
+
+    trans = conn.begin()
+    contacts = []
+    for contact_id in range(1, contact_count + 1):
+        if contact_id <= agent_count:
+            contacts.append({'id': contact_id, 'name': 'Agent ' + str(contact_id), 'role': 'Agent'})
+        else:
+            contacts.append({'id': contact_id, 'name': 'Insured ' + str(contact_id), 'role': 'Named Insured'})
+    _insert(conn, Contact.__table__, contacts)
+    trans.commit()
+
+    for start in range(1, policy_count + 1, POLICY_BATCH_SIZE):
+        policies, invoices, payments, ledger = [], [], [], []
+        for policy_id in range(start, min(start + POLICY_BATCH_SIZE, policy_count + 1)):
+            rows = _generate_policy(rng, policy_id, agent_count, contact_count, start_date, as_of)
+            policies.append(rows[0])
+            invoices.extend(rows[1])
+            payments.extend(rows[2])
+            ledger.extend(rows[3])
+
+        trans = conn.begin()
+        _insert(conn, Policy.__table__, policies)
+        _insert(conn, Invoice.__table__, invoices)
+        _insert(conn, Payment.__table__, payments)
+        _insert(conn, LedgerEntry.__table__, ledger)
+        trans.commit()
+        counts['invoices'] += len(invoices)
+        counts['payments'] += len(payments)
+        counts['ledger'] += len(ledger)
+        logging.info('Generated ' + str(min(start + POLICY_BATCH_SIZE - 1, policy_count)) + ' policies')
+
+    conn.close()
+    return counts
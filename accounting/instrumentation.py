@@ -0,0 +1,192 @@
+#!/user/bin/env python2.7
+
+import cProfile
+import heapq
+import json
+import math
+import os
+import time
+from collections import deque
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+import logging
+
+"""
+#######################################################
+Opt-in request instrumentation. Counts and times the
+SQL each request runs, adds the totals to the response
+headers, keeps recent samples per endpoint for /_stats
+and can dump cProfile output for slow requests.
+#######################################################
+"""
+
+# recent requests kept per endpoint for the percentiles
+SAMPLE_SIZE = 1000
+
+# slowest statements kept per request and overall
+SLOW_STATEMENTS = 5
+
+PERCENTILES = [50, 90, 99]
+
+
+def percentile(sorted_values, percent):
+    """
+     Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(rank, 0)]
+
+
+class RequestStats(object):
+
+    """
+     What one request spent: wall time, statement count, SQL time and
+     its slowest statements.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.queries = 0
+        self.sql_ms = 0.0
+        self.slowest = []
+        self.profile = None
+
+    def add_statement(self, statement, ms):
+        self.queries += 1
+        self.sql_ms += ms
+        entry = (ms, statement[:200])
+        if len(self.slowest) < SLOW_STATEMENTS:
+            heapq.heappush(self.slowest, entry)
+        else:
+            heapq.heappushpop(self.slowest, entry)
+
+
+class Instrumentation(object):
+
+    """
+     Hooks an app's requests and an engine's statements together. Only
+     one instance should be installed per process, since engine
+     listeners can't be removed.
+    """
+    def __init__(self, threshold_ms=0, profile_dir=None):
+        self.threshold_ms = threshold_ms
+        self.profile_dir = profile_dir
+        self.samples = {}
+        self.slowest = []
+        self.profiles_written = 0
+        self.engines = set()
+
+    def install(self, app, engine):
+        self.app = app
+        self.watch(engine)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.add_url_rule('/_stats', '_stats', self.stats_view)
+
+    def watch(self, engine):
+        """
+         Counts the statements of another engine in the requests too, such
+         as the read pool's. Watching an engine twice does nothing.
+        """
+        if engine in self.engines:
+            return
+        self.engines.add(engine)
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            context._instrumentation_started = time.time()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, '_instrumentation_started', None)
+        stats = has_request_context() and getattr(g, 'request_stats', None)
+        if started is not None and stats:
+            stats.add_statement(statement, (time.time() - started) * 1000.0)
+
+    def before_request(self):
+        g.request_stats = RequestStats()
+        if self.threshold_ms:
+            g.request_stats.profile = cProfile.Profile()
+            g.request_stats.profile.enable()
+
+    def after_request(self, response):
+        stats = getattr(g, 'request_stats', None)
+        if stats is None:
+            return response
+        if stats.profile:
+            stats.profile.disable()
+        wall_ms = (time.time() - stats.started) * 1000.0
+
+        response.headers['X-SQL-Queries'] = str(stats.queries)
+        response.headers['X-SQL-Time-Ms'] = '%.3f' % stats.sql_ms
+        response.headers['X-Request-Time-Ms'] = '%.3f' % wall_ms
+
+        endpoint = request.endpoint or 'unknown'
+        if endpoint != '_stats':
+            self.record(endpoint, wall_ms, stats)
+        if stats.profile and wall_ms > self.threshold_ms:
+            self.dump_profile(endpoint, stats.profile)
+        return response
+
+    def record(self, endpoint, wall_ms, stats):
+        samples = self.samples.setdefault(endpoint, deque(maxlen=SAMPLE_SIZE))
+        samples.append((wall_ms, stats.sql_ms, stats.queries))
+        for ms, statement in stats.slowest:
+            entry = (ms, endpoint, statement)
+            if len(self.slowest) < SLOW_STATEMENTS:
+                heapq.heappush(self.slowest, entry)
+            else:
+                heapq.heappushpop(self.slowest, entry)
+
+    def dump_profile(self, endpoint, profile):
+        if not os.path.isdir(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        path = os.path.join(self.profile_dir, '%s-%d.prof' % (endpoint, time.time() * 1000))
+        profile.dump_stats(path)
+        self.profiles_written += 1
+        logging.info('Wrote profile of slow ' + endpoint + ' request to ' + path)
+
+    def summary(self):
+        """
+         Returns per-endpoint percentiles of wall time, SQL time and query
+         count over the recent samples, and the slowest statements seen.
+        """
+        endpoints = {}
+        for endpoint, samples in self.samples.items():
+            summary = {'requests': len(samples)}
+            for index, name in enumerate(['wall_ms', 'sql_ms', 'queries']):
+                values = sorted(sample[index] for sample in samples)
+                summary[name] = dict(('p' + str(percent), round(percentile(values, percent), 3))
+                                     for percent in PERCENTILES)
+                summary[name]['max'] = round(values[-1], 3)
+            endpoints[endpoint] = summary
+
+        slowest = [{'ms': round(ms, 3), 'endpoint': endpoint, 'statement': statement}
+                   for ms, endpoint, statement in sorted(self.slowest, reverse=True)]
+        return {'endpoints': endpoints,
+                'slowest_statements': slowest,
+                'profiles_written': self.profiles_written}
+
+    def stats_view(self):
+        return self.app.response_class(json.dumps(self.summary(), indent=2),
+                                       mimetype='application/json')
+
+
+instrumentation = None
+
+
+def instrument(app, engine):
+    """
+     Installs the instrumentation once, configured from the app's
+     PROFILE_THRESHOLD_MS and PROFILE_DIR, and returns it.
+    """
+    global instrumentation
+    if instrumentation is None:
+        instrumentation = Instrumentation(app.config.get('PROFILE_THRESHOLD_MS', 0),
+                                          app.config.get('PROFILE_DIR'))
+        instrumentation.install(app, engine)
+        logging.info('Request instrumentation installed.')
+    return instrumentation
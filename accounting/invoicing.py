@@ -0,0 +1,81 @@
+#!/user/bin/env python2.7
+
+from collections import namedtuple
+
+from accounting import db
+from ledger import refresh_ledger
+from models import Invoice
+from money import from_cents, split_cents, to_cents
+from schedules import billing_schedules, invoice_schedule, schedule_cache
+from statements import statement_cache
+
+import logging
+
+"""
+#######################################################
+Set-based invoicing for many policies at once. Produces
+the same rows as PolicyAccounting.make_invoices.
+#######################################################
+"""
+
+INVOICE_CHUNK_SIZE = 500
+
+InvoiceSpec = namedtuple('InvoiceSpec', ['id', 'billing_schedule', 'effective_date', 'annual_premium'])
+
+
+def build_invoice_rows(policy):
+    """
+     Returns the invoice rows, as dicts for a core insert, that
+     make_invoices would create for the given policy. Works with a Policy
+     or anything else that has id, billing_schedule, effective_date and
+     annual_premium.
+    """
+    amounts = split_cents(to_cents(policy.annual_premium), billing_schedules[policy.billing_schedule])
+
+    rows = []
+    for (bill_date, due_date, cancel_date), amount in zip(invoice_schedule(policy.billing_schedule,
+                                                                           policy.effective_date), amounts):
+        rows.append({'policy_id': policy.id,
+                     'bill_date': bill_date,
+                     'due_date': due_date,
+                     'cancel_date': cancel_date,
+                     'amount_due': from_cents(amount),
+                     'deleted': False})
+    return rows
+
+
+def make_invoices_bulk(policies, chunk_size=INVOICE_CHUNK_SIZE):
+    """
+     Deletes and recreates all invoices for every given policy. Each chunk
+     of policies is one UPDATE marking the old invoices deleted and one
+     executemany INSERT of the new ones, committed together. Returns the
+     number of invoices created.
+    """
+    # copy the fields up front, since each commit expires ORM instances
+    policies = [InvoiceSpec(policy.id, policy.billing_schedule,
+                            policy.effective_date, policy.annual_premium)
+                for policy in policies]
+    created = 0
+
+    for start in range(0, len(policies), chunk_size):
+        chunk = policies[start:start + chunk_size]
+        rows = []
+        for policy in chunk:
+            rows.extend(build_invoice_rows(policy))
+        policy_ids = [policy.id for policy in chunk]
+
+        logging.debug('Marking current invoices as deleted for ' + str(len(policy_ids)) + ' policies')
+        db.session.execute(Invoice.__table__.update()
+                                            .where(Invoice.policy_id.in_(policy_ids))
+                                            .values(deleted=True))
+        if rows:
+            db.session.execute(Invoice.__table__.insert(), rows)
+        refresh_ledger(policy_ids)
+        db.session.commit()
+        for policy_id in policy_ids:
+            statement_cache.invalidate(policy_id)
+        created += len(rows)
+
+    logging.info('Created ' + str(created) + ' invoices for ' + str(len(policies)) + ' policies.')
+    logging.info('Invoice schedule cache: ' + str(schedule_cache.stats()))
+    return created
@@ -0,0 +1,209 @@
+#!/user/bin/env python2.7
+
+from datetime import date
+from operator import itemgetter
+from sqlalchemy import and_, bindparam, select
+
+from accounting import db
+from models import LedgerEntry, Policy
+from money import from_cents, to_cents
+from portfolio import POLICY_ID_CHUNK_SIZE, iter_policy_rows
+from timeline import BalanceTimeline
+
+import logging
+
+"""
+#######################################################
+The materialized running-balance ledger. Every invoice
+and payment write adds a row holding the change and
+the balance after it, so the balance on a date is the
+latest row on or before that date.
+#######################################################
+"""
+
+
+def stored_amount(amount):
+    """
+     Returns an amount the way the ORM reads it back from a Money
+     column, so running balances add up like the summed rows do.
+    """
+    return from_cents(to_cents(amount))
+
+
+def record_entries(policy_id, entries):
+    """
+     Adds (entry_date, delta) rows to a policy's ledger and carries the
+     deltas forward into any rows dated after them. Deltas are in dollars;
+     the ledger keeps cents. Runs in the current transaction; the caller
+     commits along with the invoice or payment.
+    """
+    entries = sorted([(entry_date, to_cents(delta)) for entry_date, delta in entries],
+                     key=itemgetter(0))
+    if not entries:
+        return
+    ledger = LedgerEntry.__table__
+    first_date = entries[0][0]
+
+    opening = db.session.execute(
+        select([ledger.c.running_balance])
+        .where(and_(ledger.c.policy_id == policy_id, ledger.c.entry_date < first_date))
+        .order_by(ledger.c.entry_date.desc(), ledger.c.id.desc())
+        .limit(1)).scalar()
+    later = db.session.execute(
+        select([ledger.c.id, ledger.c.entry_date, ledger.c.delta])
+        .where(and_(ledger.c.policy_id == policy_id, ledger.c.entry_date >= first_date))
+        .order_by(ledger.c.entry_date, ledger.c.id)).fetchall()
+
+    # existing rows on a date stay ahead of the new ones, which get higher ids
+    running = opening or 0
+    updates = []
+    inserts = []
+    i = j = 0
+    while i < len(later) or j < len(entries):
+        if j == len(entries) or (i < len(later) and later[i].entry_date <= entries[j][0]):
+            running += later[i].delta
+            updates.append({'entry_id': later[i].id, 'running': running})
+            i += 1
+        else:
+            running += entries[j][1]
+            inserts.append({'policy_id': policy_id,
+                            'entry_date': entries[j][0],
+                            'delta': entries[j][1],
+                            'running_balance': running})
+            j += 1
+
+    if updates:
+        db.session.execute(ledger.update()
+                                 .where(ledger.c.id == bindparam('entry_id'))
+                                 .values(running_balance=bindparam('running')),
+                           updates)
+    db.session.execute(ledger.insert(), inserts)
+    logging.debug('Recorded ' + str(len(inserts)) + ' ledger entries for policy ' + str(policy_id)
+                  + ', carried forward into ' + str(len(updates)))
+
+
+def ledger_balance(policy_id, date_cursor):
+    """
+     Returns the balance on a date from the latest ledger row on or
+     before it, in dollars.
+    """
+    ledger = LedgerEntry.__table__
+    running = db.session.execute(
+        select([ledger.c.running_balance])
+        .where(and_(ledger.c.policy_id == policy_id, ledger.c.entry_date <= date_cursor))
+        .order_by(ledger.c.entry_date.desc(), ledger.c.id.desc())
+        .limit(1)).scalar()
+    return from_cents(running or 0)
+
+
+def ledger_rows(policy_id, invoices, payments):
+    """
+     Returns the ledger rows, as dicts for a core insert, for a policy's
+     non-deleted invoices and its payments.
+    """
+    entries = [(invoice.bill_date, to_cents(invoice.amount_due)) for invoice in invoices]
+    entries.extend((payment.transaction_date, -to_cents(payment.amount_paid)) for payment in payments)
+    entries.sort(key=itemgetter(0))
+
+    rows = []
+    running = 0
+    for entry_date, delta in entries:
+        running += delta
+        rows.append({'policy_id': policy_id,
+                     'entry_date': entry_date,
+                     'delta': delta,
+                     'running_balance': running})
+    return rows
+
+
+def refresh_ledger(policy_ids):
+    """
+     Regenerates the ledger rows of the given policies from their
+     invoices and payments inside the current transaction. Used by the
+     set-based writers, where this is cheaper than carrying each row
+     forward one at a time.
+    """
+    return replace_ledger(list(iter_policy_rows(date.max, policy_ids)))
+
+
+def replace_ledger(histories):
+    """
+     Replaces the ledger rows of each policy in a list of (policy_id,
+     invoices, payments) histories that the caller already has in memory,
+     inside the current transaction. Returns the number of rows written.
+    """
+    ledger = LedgerEntry.__table__
+    policy_ids = [policy_id for policy_id, invoices, payments in histories]
+    rows = []
+    for policy_id, invoices, payments in histories:
+        rows.extend(ledger_rows(policy_id, invoices, payments))
+
+    for start in range(0, len(policy_ids), POLICY_ID_CHUNK_SIZE):
+        db.session.execute(ledger.delete().where(
+            ledger.c.policy_id.in_(policy_ids[start:start + POLICY_ID_CHUNK_SIZE])))
+    if rows:
+        db.session.execute(ledger.insert(), rows)
+    return len(rows)
+
+
+def _all_policy_ids():
+    return [row[0] for row in db.session.execute(select([Policy.id]).order_by(Policy.id))]
+
+
+def rebuild_ledger(policy_ids=None):
+    """
+     Regenerates the ledger from the invoices and payments tables for
+     every policy, or only the given ones, committing once per chunk of
+     policies. Returns the number of ledger rows written.
+    """
+    if policy_ids is None:
+        db.session.execute(LedgerEntry.__table__.delete())
+        policy_ids = _all_policy_ids()
+    else:
+        policy_ids = sorted(set(policy_ids))
+
+    written = 0
+    for start in range(0, len(policy_ids), POLICY_ID_CHUNK_SIZE):
+        written += refresh_ledger(policy_ids[start:start + POLICY_ID_CHUNK_SIZE])
+        db.session.commit()
+
+    logging.info('Rebuilt ledger with ' + str(written) + ' rows for ' + str(len(policy_ids)) + ' policies.')
+    return written
+
+
+def verify_ledger(policy_ids=None):
+    """
+     Compares the ledger against balances summed from the invoices and
+     payments on every date either of them has an entry. Returns a list
+     of (policy_id, date, ledger balance, expected balance) mismatches.
+    """
+    ledger = LedgerEntry.__table__
+    if policy_ids is None:
+        policy_ids = _all_policy_ids()
+    else:
+        policy_ids = sorted(set(policy_ids))
+
+    mismatches = []
+    for start in range(0, len(policy_ids), POLICY_ID_CHUNK_SIZE):
+        chunk = policy_ids[start:start + POLICY_ID_CHUNK_SIZE]
+        balances = {}
+        for row in db.session.execute(select([ledger])
+                                      .where(ledger.c.policy_id.in_(chunk))
+                                      .order_by(ledger.c.policy_id, ledger.c.entry_date, ledger.c.id)):
+            # later rows on the same date overwrite earlier ones
+            balances.setdefault(row.policy_id, {})[row.entry_date] = row.running_balance
+
+        for policy_id, invoices, payments in list(iter_policy_rows(date.max, chunk)):
+            timeline = BalanceTimeline(invoices, payments)
+            by_date = balances.get(policy_id, {})
+            dates = sorted(set(timeline.dates) | set(by_date))
+            running = 0
+            for entry_date in dates:
+                running = by_date.get(entry_date, running)
+                expected = timeline.balance_at(entry_date)
+                if from_cents(running) != expected:
+                    mismatches.append((policy_id, entry_date, from_cents(running), expected))
+
+    logging.info('Verified ledger for ' + str(len(policy_ids)) + ' policies, '
+                 + str(len(mismatches)) + ' mismatches.')
+    return mismatches
@@ -0,0 +1,166 @@
+#!/user/bin/env python2.7
+
+from accounting import db
+from models import ArchivedInvoice
+from money import split_cents
+
+import logging
+
+"""
+#######################################################
+In-place schema migrations for existing accounting.sqlite
+files. The schema version is kept in SQLite's
+user_version pragma and each step runs once.
+#######################################################
+"""
+
+
+def schema_version(bind=None):
+    bind = bind or db.engine
+    return bind.execute('PRAGMA user_version').scalar()
+
+
+def stamp_schema_version(bind=None, version=None):
+    """
+     Records the schema as migrated up to the given version, or the
+     latest one. build_or_refresh_db calls this after create_all.
+    """
+    bind = bind or db.engine
+    if version is None:
+        version = len(MIGRATIONS)
+    bind.execute('PRAGMA user_version = ' + str(int(version)))
+
+
+def add_indexes(bind=None):
+    """
+     Creates any table or index declared on the models that the database
+     doesn't have yet, without rebuilding the existing tables, then
+     refreshes the query planner's statistics. Returns the names of the
+     indexes that were created.
+    """
+    bind = bind or db.engine
+    db.metadata.create_all(bind=bind)
+    existing = set(row[0] for row in bind.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))
+
+    created = []
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing:
+                logging.info('Creating index ' + index.name)
+                index.create(bind=bind)
+                created.append(index.name)
+    bind.execute('ANALYZE')
+    return created
+
+
+def drop_indexes(bind=None):
+    """
+     Drops every index declared on the models. Only used to benchmark
+     the database the way it was before add_indexes.
+    """
+    bind = bind or db.engine
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            bind.execute('DROP INDEX IF EXISTS ' + index.name)
+
+
+def add_invoice_archive(bind=None):
+    """
+     Creates the invoices_archive table that compact_invoices moves
+     deleted invoices to.
+    """
+    bind = bind or db.engine
+    ArchivedInvoice.__table__.create(bind=bind, checkfirst=True)
+
+
+# (table, column) of every amount that add_invoice_archive's schema still
+# stored as NUMERIC dollars
+MONEY_COLUMNS = [('policies', 'annual_premium'),
+                 ('invoices', 'amount_due'),
+                 ('invoices_archive', 'amount_due'),
+                 ('payments', 'amount_paid'),
+                 ('ledger', 'delta')]
+
+
+# each ledger row's balance is the sum of its policy's deltas up to and
+# including it, in entry_date then id order
+RUNNING_BALANCE_SQL = ('UPDATE ledger SET running_balance = '
+                       '(SELECT sum(earlier.delta) FROM ledger earlier '
+                       'WHERE earlier.policy_id = ledger.policy_id AND (earlier.entry_date < ledger.entry_date '
+                       'OR (earlier.entry_date = ledger.entry_date AND earlier.id <= ledger.id)))')
+
+
+def _resplit_installments(bind, totals):
+    """
+     Spreads each policy's total over its live invoices with split_cents,
+     where rounding the installments one by one lost or gained cents.
+    """
+    for policy_id, total in totals:
+        rows = bind.execute('SELECT id, amount_due FROM invoices WHERE policy_id = ? AND deleted = 0 '
+                            'ORDER BY bill_date, id', policy_id).fetchall()
+        if sum(row[1] for row in rows) == total:
+            continue
+        for row, cents in zip(rows, split_cents(total, len(rows))):
+            bind.execute('UPDATE invoices SET amount_due = ? WHERE id = ?', cents, row[0])
+        logging.info('Re-split the installments of policy ' + str(policy_id) + '.')
+
+
+def convert_money_to_cents(bind=None):
+    """
+     Rewrites every stored dollar amount as whole cents, rounding half a
+     cent away from zero, then recomputes the ledger's running balances
+     from the converted deltas. The old columns are declared NUMERIC,
+     which keeps integers as they are, so the tables aren't rebuilt.
+
+     Old installments were unrounded shares of the premium, so a policy's
+     live invoices are re-split from their rounded total and still add
+     up to it; fill_ledger then rebuilds the ledger from them.
+    """
+    bind = bind or db.engine
+    totals = bind.execute('SELECT policy_id, CAST(ROUND(SUM(amount_due) * 100) AS INTEGER) FROM invoices '
+                          'WHERE deleted = 0 GROUP BY policy_id').fetchall()
+    for table, column in MONEY_COLUMNS:
+        bind.execute('UPDATE ' + table + ' SET ' + column + ' = CAST(ROUND(' + column + ' * 100) AS INTEGER)')
+    _resplit_installments(bind, totals)
+    bind.execute(RUNNING_BALANCE_SQL)
+
+
+def fill_ledger(bind=None):
+    """
+     Regenerates the ledger from the invoices and payments tables, as
+     rebuild_ledger does, in SQL so it works on any bind. Databases from
+     before the ledger were migrated with it empty, which reads as a zero
+     balance for every policy. Invoices are inserted ahead of payments so
+     they come first on a shared date, like ledger_rows orders them.
+    """
+    bind = bind or db.engine
+    bind.execute('DELETE FROM ledger')
+    bind.execute('INSERT INTO ledger (policy_id, entry_date, delta, running_balance) '
+                 'SELECT policy_id, bill_date, amount_due, 0 FROM invoices WHERE deleted = 0 '
+                 'ORDER BY policy_id, bill_date, id')
+    bind.execute('INSERT INTO ledger (policy_id, entry_date, delta, running_balance) '
+                 'SELECT policy_id, transaction_date, -amount_paid, 0 FROM payments '
+                 'ORDER BY policy_id, transaction_date, id')
+    bind.execute(RUNNING_BALANCE_SQL)
+    logging.info('Filled the ledger with ' + str(bind.execute('SELECT count(*) FROM ledger').scalar())
+                 + ' rows.')
+
+
+MIGRATIONS = [add_indexes, add_invoice_archive, convert_money_to_cents, fill_ledger]
+
+
+def migrate(bind=None):
+    """
+     Runs every migration newer than the database's schema version.
+     Returns the list of migrations that ran.
+    """
+    bind = bind or db.engine
+    version = schema_version(bind)
+    ran = []
+    for number, migration in enumerate(MIGRATIONS, 1):
+        if number > version:
+            logging.info('Running migration ' + str(number) + ': ' + migration.__name__)
+            migration(bind)
+            stamp_schema_version(bind, number)
+            ran.append(migration.__name__)
+    return ran
@@ -1,4 +1,5 @@
 from accounting import db
+from money import Money
 # from sqlalchemy.ext.declarative import declarative_base
 #
 # DeclarativeBase = declarative_base()
@@ -15,7 +16,7 @@ class Policy(db.Model):
     effective_date = db.Column(u'effective_date', db.DATE(), nullable=False)
     status = db.Column(u'status', db.Enum(u'Active', u'Canceled', u'Expired'), default=u'Active', nullable=False)
     billing_schedule = db.Column(u'billing_schedule', db.Enum(u'Annual', u'Two-Pay', u'Quarterly', u'Monthly'), default=u'Annual', nullable=False)
-    annual_premium = db.Column(u'annual_premium', db.NUMERIC(), nullable=False)
+    annual_premium = db.Column(u'annual_premium', Money(), nullable=False)
     named_insured = db.Column(u'named_insured', db.INTEGER(), db.ForeignKey('contacts.id'))
     agent = db.Column(u'agent', db.INTEGER(), db.ForeignKey('contacts.id'))
     canceled_date = db.Column(u'canceled_date', db.DATE())
@@ -27,12 +28,17 @@ class Policy(db.Model):
         self.annual_premium = annual_premium
 
     invoices = db.relation('Invoice', primaryjoin="Invoice.policy_id==Policy.id")
+    archived_invoices = db.relation('ArchivedInvoice', primaryjoin="ArchivedInvoice.policy_id==Policy.id",
+                                    viewonly=True)
+    payments = db.relation('Payment', primaryjoin="Payment.policy_id==Policy.id", viewonly=True)
+    insured_contact = db.relation('Contact', primaryjoin="Contact.id==Policy.named_insured", viewonly=True)
+    agent_contact = db.relation('Contact', primaryjoin="Contact.id==Policy.agent", viewonly=True)
 
 
 class Contact(db.Model):
     __tablename__ = 'contacts'
 
-    __table_args__ = {}
+    __table_args__ = (db.Index('ix_contacts_name_role', 'name', 'role'),)
 
     # column definitions
     id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
@@ -47,7 +53,12 @@ class Contact(db.Model):
 class Invoice(db.Model):
     __tablename__ = 'invoices'
 
-    __table_args__ = {}
+    # balance lookups are covered by the first index without touching the table
+    __table_args__ = (db.Index('ix_invoices_policy_id_deleted_bill_date',
+                               'policy_id', 'deleted', 'bill_date', 'amount_due'),
+                      db.Index('ix_invoices_policy_id_due_date_cancel_date',
+                               'policy_id', 'due_date', 'cancel_date'),
+                      db.Index('ix_invoices_cancel_date', 'cancel_date'))
 
     # column definitions
     id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
@@ -55,7 +66,7 @@ class Invoice(db.Model):
     bill_date = db.Column(u'bill_date', db.DATE(), nullable=False)
     due_date = db.Column(u'due_date', db.DATE(), nullable=False)
     cancel_date = db.Column(u'cancel_date', db.DATE(), nullable=False)
-    amount_due = db.Column(u'amount_due', db.NUMERIC(), nullable=False)
+    amount_due = db.Column(u'amount_due', Money(), nullable=False)
     deleted = db.Column(u'deleted', db.Boolean, default=False, server_default='0', nullable=False)
 
     def __init__(self, policy_id, bill_date, due_date, cancel_date, amount_due):
@@ -66,16 +77,33 @@ class Invoice(db.Model):
         self.amount_due = amount_due
 
 
+class ArchivedInvoice(db.Model):
+    __tablename__ = 'invoices_archive'
+
+    __table_args__ = (db.Index('ix_invoices_archive_policy_id_bill_date', 'policy_id', 'bill_date'),)
+
+    # deleted invoices moved out of invoices by archive.compact_invoices,
+    # keeping their original ids
+    id = db.Column(u'id', db.INTEGER(), primary_key=True, autoincrement=False, nullable=False)
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
+    bill_date = db.Column(u'bill_date', db.DATE(), nullable=False)
+    due_date = db.Column(u'due_date', db.DATE(), nullable=False)
+    cancel_date = db.Column(u'cancel_date', db.DATE(), nullable=False)
+    amount_due = db.Column(u'amount_due', Money(), nullable=False)
+    archived_date = db.Column(u'archived_date', db.DATE(), nullable=False)
+
+
 class Payment(db.Model):
     __tablename__ = 'payments'
 
-    __table_args__ = {}
+    __table_args__ = (db.Index('ix_payments_policy_id_transaction_date',
+                               'policy_id', 'transaction_date', 'amount_paid'),)
 
     # column definitions
     id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
     policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
     contact_id = db.Column(u'contact_id', db.INTEGER(), db.ForeignKey('contacts.id'), nullable=False)
-    amount_paid = db.Column(u'amount_paid', db.NUMERIC(), nullable=False)
+    amount_paid = db.Column(u'amount_paid', Money(), nullable=False)
     transaction_date = db.Column(u'transaction_date', db.DATE(), nullable=False)
 
     def __init__(self, policy_id, contact_id, amount_paid, transaction_date):
@@ -83,3 +111,25 @@ class Payment(db.Model):
         self.contact_id = contact_id
         self.amount_paid = amount_paid
         self.transaction_date = transaction_date
+
+    contact = db.relation('Contact', primaryjoin="Contact.id==Payment.contact_id", viewonly=True)
+
+
+class LedgerEntry(db.Model):
+    __tablename__ = 'ledger'
+
+    __table_args__ = (db.Index('ix_ledger_policy_id_entry_date', 'policy_id', 'entry_date', 'id'),)
+
+    # column definitions
+    id = db.Column(u'id', db.INTEGER(), primary_key=True, nullable=False)
+    policy_id = db.Column(u'policy_id', db.INTEGER(), db.ForeignKey('policies.id'), nullable=False)
+    entry_date = db.Column(u'entry_date', db.DATE(), nullable=False)
+    # whole cents, so running balances are integer sums
+    delta = db.Column(u'delta', db.INTEGER(), nullable=False)
+    running_balance = db.Column(u'running_balance', db.INTEGER(), nullable=False)
+
+    def __init__(self, policy_id, entry_date, delta, running_balance):
+        self.policy_id = policy_id
+        self.entry_date = entry_date
+        self.delta = delta
+        self.running_balance = running_balance
@@ -0,0 +1,82 @@
+#!/user/bin/env python2.7
+
+from decimal import Decimal, ROUND_HALF_UP
+from sqlalchemy.types import Integer, TypeDecorator
+
+"""
+#######################################################
+Money as whole cents. Amounts are stored as integer
+cents, added up as integers where totals are computed,
+and turned into two-place Decimals when they are read
+back for display.
+#######################################################
+"""
+
+ONE = Decimal(1)
+ZERO = Decimal('0.00')
+
+
+def to_dollars(amount):
+    """
+     Returns a dollar amount (int, Decimal, float or string) as a Decimal,
+     taking a float at its shortest repr rather than its binary value.
+    """
+    if isinstance(amount, float):
+        amount = repr(amount)
+    return Decimal(amount)
+
+
+def to_cents(amount):
+    """
+     Returns a dollar amount (int, Decimal, float or string) as a whole
+     number of cents, rounding half a cent away from zero.
+    """
+    if isinstance(amount, (int, long)):
+        return amount * 100
+    return int(to_dollars(amount).scaleb(2).quantize(ONE, ROUND_HALF_UP))
+
+
+def from_cents(cents):
+    """
+     Returns a number of cents as a Decimal in dollars with two places.
+    """
+    return Decimal(cents).scaleb(-2)
+
+
+def is_whole_cents(amount):
+    """
+     Returns True if a Decimal amount is finite and has no fraction of a
+     cent, so storing it as cents doesn't change it.
+    """
+    return amount.is_finite() and amount == amount.quantize(Decimal('0.01'))
+
+
+def split_cents(cents, parts):
+    """
+     Splits an amount in cents into parts that differ by at most a cent
+     and add up to it exactly, larger parts first.
+    """
+    share, remainder = divmod(cents, parts)
+    return [share + 1] * remainder + [share] * (parts - remainder)
+
+
+class Money(TypeDecorator):
+
+    """
+     A column of integer cents that takes and gives dollar amounts.
+     Amounts with a fraction of a cent are refused rather than rounded;
+     code that computes amounts rounds them with to_cents first.
+    """
+    impl = Integer
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not isinstance(value, (int, long)) and not is_whole_cents(to_dollars(value)):
+            raise ValueError('Amount ' + str(value) + ' is not a whole number of cents.')
+        return to_cents(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return from_cents(value)
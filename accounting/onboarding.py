@@ -0,0 +1,137 @@
+#!/user/bin/env python2.7
+
+import time
+from collections import namedtuple
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from accounting import db
+from contacts import contact_resolver
+from invoicing import build_invoice_rows
+from ledger import ledger_rows, stored_amount
+from models import Invoice, LedgerEntry, Policy
+from money import is_whole_cents
+from schedules import billing_schedules
+
+import logging
+
+"""
+#######################################################
+Bulk policy onboarding, for moving a whole book over
+from another carrier. Writes the same rows as
+PolicyAccounting.create_new_policy, one transaction
+per chunk of policies instead of several per policy.
+#######################################################
+"""
+
+ONBOARD_CHUNK_SIZE = 1000
+
+PolicySpec = namedtuple('PolicySpec', ['policy_number', 'billing_schedule', 'named_insured',
+                                       'agent', 'annual_premium', 'effective_date'])
+LedgerInvoice = namedtuple('LedgerInvoice', ['bill_date', 'amount_due'])
+
+
+def _effective_date(spec):
+    """
+     Returns the spec's effective date as a date, parsing yyyy-mm-dd
+     strings, or None if it has none. Raises ValueError if it doesn't parse.
+    """
+    if not spec.effective_date or isinstance(spec.effective_date, date):
+        return spec.effective_date or None
+    return datetime.strptime(spec.effective_date.strip(), '%Y-%m-%d').date()
+
+
+def _check_spec(spec):
+    """
+     Returns the reason a spec can't be onboarded, or None.
+    """
+    if spec.billing_schedule not in billing_schedules:
+        return 'Unknown billing schedule'
+    if not spec.policy_number or not spec.named_insured or not spec.agent:
+        return 'Missing policy number, insured or agent'
+    try:
+        premium = Decimal(str(spec.annual_premium).strip())
+        # NaN can't be compared, so it is ruled out before the sign
+        if not is_whole_cents(premium) or premium <= 0:
+            return 'Invalid annual premium'
+    except (InvalidOperation, TypeError):
+        return 'Invalid annual premium'
+    try:
+        _effective_date(spec)
+    except (ValueError, AttributeError):
+        return 'Invalid effective date'
+    return None
+
+
+def _onboard_chunk(specs, today):
+    """
+     Creates the contacts, policies, invoices and ledger rows for one
+     chunk of checked specs and commits them together. Returns the
+     number of invoices written.
+    """
+    keys = set()
+    for spec in specs:
+        keys.add((spec.agent, 'Agent'))
+        keys.add((spec.named_insured, 'Named Insured'))
+    contact_ids = contact_resolver.get_or_create_many(keys)
+
+    policies = []
+    for spec in specs:
+        policy = Policy(spec.policy_number, spec.effective_date or today, spec.annual_premium)
+        policy.billing_schedule = spec.billing_schedule
+        policy.agent = contact_ids[(spec.agent, 'Agent')]
+        policy.named_insured = contact_ids[(spec.named_insured, 'Named Insured')]
+        policies.append(policy)
+    db.session.add_all(policies)
+    db.session.flush()
+
+    invoices = []
+    ledger = []
+    for policy in policies:
+        rows = build_invoice_rows(policy)
+        invoices.extend(rows)
+        # amounts as the ledger stores them, like record_entries
+        ledger.extend(ledger_rows(policy.id, [LedgerInvoice(row['bill_date'], stored_amount(row['amount_due']))
+                                              for row in rows], []))
+    if invoices:
+        db.session.execute(Invoice.__table__.insert(), invoices)
+        db.session.execute(LedgerEntry.__table__.insert(), ledger)
+    db.session.commit()
+    return len(invoices)
+
+
+def onboard_policies(specs, chunk_size=ONBOARD_CHUNK_SIZE):
+    """
+     Creates a policy, with its contacts, invoices and ledger, for each
+     PolicySpec in an iterable of any length. Yields a progress report
+     after each committed chunk with running totals. The report lists the
+     chunk's rejected specs with their reasons, and rejected_count counts
+     all of them so far; nothing is written for a rejected spec.
+    """
+    started = time.time()
+    today = datetime.now().date()
+    progress = {'policies': 0, 'invoices': 0, 'rejected_count': 0}
+    specs = iter(specs)
+
+    while True:
+        chunk = list(islice(specs, chunk_size))
+        if not chunk:
+            break
+        accepted = []
+        rejected = []
+        for spec in chunk:
+            reason = _check_spec(spec)
+            if reason:
+                rejected.append((spec.policy_number, reason))
+            else:
+                accepted.append(spec._replace(effective_date=_effective_date(spec)))
+
+        if accepted:
+            progress['invoices'] += _onboard_chunk(accepted, today)
+            progress['policies'] += len(accepted)
+        progress['rejected_count'] += len(rejected)
+        progress['seconds'] = round(time.time() - started, 3)
+        progress['policies_per_second'] = round(progress['policies'] / max(progress['seconds'], 0.001), 1)
+        logging.info('Onboarded ' + str(progress['policies']) + ' policies')
+        yield dict(progress, rejected=rejected)
@@ -0,0 +1,202 @@
+#!/user/bin/env python2.7
+
+import csv
+import time
+from collections import namedtuple
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from sqlalchemy import select
+
+from accounting import db
+from ledger import replace_ledger, stored_amount
+from models import Contact, Payment, Policy
+from money import is_whole_cents
+from portfolio import iter_policy_rows
+from statements import statement_cache
+from timeline import evaluate_pending_from_rows
+
+import logging
+
+"""
+#######################################################
+Bulk payment import for lockbox and bank files. Reads
+a CSV of policy_number, payer, amount and date rows and
+applies the same rules as PolicyAccounting.make_payment
+a chunk of rows at a time.
+#######################################################
+"""
+
+IMPORT_CHUNK_SIZE = 1000
+
+IMPORT_FIELDS = ['policy_number', 'payer', 'amount', 'date']
+
+PolicyRef = namedtuple('PolicyRef', ['id', 'named_insured', 'agent'])
+ImportedPayment = namedtuple('ImportedPayment', ['transaction_date', 'amount_paid'])
+
+
+class ImportRejected(Exception):
+    pass
+
+
+def _load_policies():
+    """
+     Returns {policy_number: PolicyRef}. Policy numbers that appear more
+     than once map to None, since a payment can't be matched to them.
+    """
+    policies = {}
+    for row in db.session.execute(select([Policy.id, Policy.policy_number,
+                                          Policy.named_insured, Policy.agent])):
+        if row.policy_number in policies:
+            policies[row.policy_number] = None
+        else:
+            policies[row.policy_number] = PolicyRef(row.id, row.named_insured, row.agent)
+    return policies
+
+
+def _load_contacts():
+    """
+     Returns ({contact_id: (name, role)}, {lowercased name: [contact ids]}).
+    """
+    by_id = {}
+    by_name = {}
+    for row in db.session.execute(select([Contact.id, Contact.name, Contact.role])):
+        by_id[row.id] = (row.name, row.role)
+        by_name.setdefault(row.name.strip().lower(), []).append(row.id)
+    return by_id, by_name
+
+
+def _resolve_payer(payer, policy, contacts_by_id, contacts_by_name):
+    """
+     Matches the payer to the policy's agent or named insured first, then
+     to any contact with exactly that name.
+    """
+    name = payer.strip().lower()
+    for contact_id in (policy.agent, policy.named_insured):
+        if contact_id in contacts_by_id and contacts_by_id[contact_id][0].strip().lower() == name:
+            return contact_id
+    matches = contacts_by_name.get(name, [])
+    if len(matches) != 1:
+        raise ImportRejected('Unknown payer' if not matches else 'Ambiguous payer')
+    return matches[0]
+
+
+def _parse_row(row, policies, contacts_by_id, contacts_by_name):
+    """
+     Returns (policy_id, contact_id, amount, transaction_date) for a CSV
+     row, or raises ImportRejected with the reason it can't be used.
+    """
+    if row.get('policy_number') is None or row.get('date') is None:
+        raise ImportRejected('Missing columns')
+    policy_number = row['policy_number'].strip()
+    if policy_number not in policies:
+        raise ImportRejected('Unknown policy')
+    policy = policies[policy_number]
+    if policy is None:
+        raise ImportRejected('Ambiguous policy number')
+
+    try:
+        amount = Decimal(row['amount'].strip())
+        # NaN can't be compared, so it is ruled out before the sign
+        if not is_whole_cents(amount) or amount <= 0:
+            raise ImportRejected('Invalid amount')
+    except (InvalidOperation, AttributeError):
+        raise ImportRejected('Invalid amount')
+
+    try:
+        transaction_date = datetime.strptime(row['date'].strip(), '%Y-%m-%d').date()
+    except ValueError:
+        raise ImportRejected('Invalid date')
+
+    contact_id = _resolve_payer(row.get('payer') or '', policy, contacts_by_id, contacts_by_name)
+    return policy.id, contact_id, amount, transaction_date
+
+
+def _import_chunk(rows, policies, contacts_by_id, contacts_by_name, reject):
+    """
+     Validates, checks and inserts one chunk of (line, row) pairs in one
+     transaction. Returns the number of payments inserted.
+    """
+    parsed = []
+    for line, row in rows:
+        try:
+            parsed.append((line, row) + _parse_row(row, policies, contacts_by_id, contacts_by_name))
+        except ImportRejected as e:
+            reject(line, row, str(e))
+
+    policy_ids = sorted(set(values[2] for values in parsed))
+    histories = {}
+    for policy_id, invoices, payments in list(iter_policy_rows(date.max, policy_ids)):
+        histories[policy_id] = (invoices, list(payments))
+
+    # rows are applied in file order, so earlier payments in the file
+    # count towards the balance later rows are checked against
+    accepted = []
+    for line, row, policy_id, contact_id, amount, transaction_date in parsed:
+        invoices, payments = histories[policy_id]
+        if contacts_by_id[contact_id][1] != 'Agent' \
+                and evaluate_pending_from_rows(invoices, payments, transaction_date):
+            reject(line, row, 'Cancellation pending, payment must come from the agent')
+            continue
+        payments.append(ImportedPayment(transaction_date, stored_amount(amount)))
+        accepted.append({'policy_id': policy_id,
+                         'contact_id': contact_id,
+                         'amount_paid': amount,
+                         'transaction_date': transaction_date})
+
+    if accepted:
+        db.session.execute(Payment.__table__.insert(), accepted)
+        # the histories already include the new payments, so the ledger
+        # is rebuilt from them rather than read back from the database
+        touched = sorted(set(payment['policy_id'] for payment in accepted))
+        replace_ledger([(policy_id,) + histories[policy_id] for policy_id in touched])
+        db.session.commit()
+        for policy_id in touched:
+            statement_cache.invalidate(policy_id)
+    return len(accepted)
+
+
+def import_payments(path, rejects_path=None, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+     Streams the CSV at path, with a header row naming the IMPORT_FIELDS,
+     inserting the accepted payments one committed chunk at a time.
+     Rejected rows are written to rejects_path with their line number and
+     reason. Returns a report with the counts and the throughput.
+    """
+    started = time.time()
+    policies = _load_policies()
+    contacts_by_id, contacts_by_name = _load_contacts()
+    report = {'rows': 0, 'accepted': 0, 'rejected': 0, 'reasons': {}}
+
+    rejects_file = rejects_path and open(rejects_path, 'wb')
+    rejects_writer = rejects_file and csv.writer(rejects_file)
+    if rejects_writer:
+        rejects_writer.writerow(['line'] + IMPORT_FIELDS + ['reason'])
+
+    def reject(line, row, reason):
+        report['rejected'] += 1
+        report['reasons'][reason] = report['reasons'].get(reason, 0) + 1
+        if rejects_writer:
+            rejects_writer.writerow([line] + [row.get(field) for field in IMPORT_FIELDS] + [reason])
+
+    try:
+        with open(path, 'rb') as source:
+            # the header is line 1
+            numbered = enumerate(csv.DictReader(source), 2)
+            while True:
+                rows = list(islice(numbered, chunk_size))
+                if not rows:
+                    break
+                report['rows'] += len(rows)
+                report['accepted'] += _import_chunk(rows, policies, contacts_by_id,
+                                                    contacts_by_name, reject)
+                logging.info('Imported ' + str(report['accepted']) + ' of '
+                             + str(report['rows']) + ' payment rows')
+    finally:
+        if rejects_file:
+            rejects_file.close()
+
+    report['seconds'] = round(time.time() - started, 3)
+    report['rows_per_second'] = round(report['rows'] / max(report['seconds'], 0.001), 1)
+    logging.info('Payment import: ' + str(report))
+    return report
@@ -0,0 +1,189 @@
+#!/user/bin/env python2.7
+
+from datetime import datetime
+from itertools import groupby
+from operator import attrgetter
+from sqlalchemy import Integer, and_, case, func, select, type_coerce, union_all
+
+from accounting import db
+from models import Invoice, Payment, Policy
+from money import from_cents
+from timeline import evaluate_cancel_from_rows
+
+import logging
+
+"""
+#######################################################
+Portfolio-wide accounting that works on many policies
+at once instead of one PolicyAccounting at a time.
+#######################################################
+"""
+
+# SQLite refuses statements with more than 999 bound parameters, and each
+# id in a chunk is bound three times.
+POLICY_ID_CHUNK_SIZE = 250
+
+
+def _amount_units(column):
+    # Money columns hold whole cents, which SQLite sums exactly as integers
+    return type_coerce(column, Integer)
+
+
+def _units_to_balance(units):
+    return from_cents(units or 0)
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _balance_query(date_cursors, policy_ids=None):
+    """
+     Builds one grouped query returning a row per policy with a summed
+     column per date. Invoices are added and payments are subtracted in
+     a single UNION ALL so both tables are scanned only once.
+    """
+    last_date = max(date_cursors)
+    invoices = select([Invoice.policy_id.label('policy_id'),
+                       Invoice.bill_date.label('entry_date'),
+                       _amount_units(Invoice.__table__.c.amount_due).label('units')])\
+        .where(and_(Invoice.deleted == 0, Invoice.bill_date <= last_date))
+    payments = select([Payment.policy_id.label('policy_id'),
+                       Payment.transaction_date.label('entry_date'),
+                       (-_amount_units(Payment.__table__.c.amount_paid)).label('units')])\
+        .where(Payment.transaction_date <= last_date)
+    if policy_ids is not None:
+        invoices = invoices.where(Invoice.policy_id.in_(policy_ids))
+        payments = payments.where(Payment.policy_id.in_(policy_ids))
+    entries = union_all(invoices, payments).alias('entries')
+
+    columns = [Policy.id]
+    for date_cursor in date_cursors:
+        columns.append(func.sum(case([(entries.c.entry_date <= date_cursor,
+                                       entries.c.units)],
+                                     else_=0),
+                                type_=Integer))
+
+    query = select(columns)\
+        .select_from(Policy.__table__.outerjoin(entries, entries.c.policy_id == Policy.id))\
+        .group_by(Policy.id)
+    if policy_ids is not None:
+        query = query.where(Policy.id.in_(policy_ids))
+    return query
+
+
+def return_portfolio_balance_history(date_cursors, policy_ids=None):
+    """
+     Returns {date: {policy_id: balance}} for every given date. Covers
+     every policy unless a list of policy ids is passed. Each chunk of
+     policies is a single SQL statement no matter how many dates are asked for.
+    """
+    date_cursors = sorted(set(date_cursors))
+    history = dict((date_cursor, {}) for date_cursor in date_cursors)
+    if not date_cursors:
+        return history
+
+    if policy_ids is None:
+        id_chunks = [None]
+    else:
+        id_chunks = _chunks(sorted(set(policy_ids)), POLICY_ID_CHUNK_SIZE)
+
+    for id_chunk in id_chunks:
+        rows = db.session.execute(_balance_query(date_cursors, id_chunk))
+        for row in rows:
+            for date_cursor, units in zip(date_cursors, row[1:]):
+                history[date_cursor][row[0]] = _units_to_balance(units)
+
+    logging.info('Computed portfolio balances for ' + str(len(date_cursors)) + ' date(s).')
+    return history
+
+
+def return_portfolio_balances(date_cursor=None, policy_ids=None):
+    """
+     Returns {policy_id: balance} on a specified date for every policy,
+     or only the given policy ids. Defaults to today's date if nothing is
+     specified. Matches PolicyAccounting.return_account_balance per policy.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+
+    return return_portfolio_balance_history([date_cursor], policy_ids)[date_cursor]
+
+
+def _merge_policy_rows(policy_ids, invoice_rows, payment_rows):
+    """
+     Walks policy ids alongside invoice and payment rows that are all
+     sorted by policy id, yielding (policy_id, invoices, payments).
+    """
+    invoice_groups = groupby(invoice_rows, attrgetter('policy_id'))
+    payment_groups = groupby(payment_rows, attrgetter('policy_id'))
+    next_invoices = next(invoice_groups, None)
+    next_payments = next(payment_groups, None)
+
+    for policy_id in policy_ids:
+        invoices = []
+        while next_invoices is not None and next_invoices[0] <= policy_id:
+            if next_invoices[0] == policy_id:
+                invoices = list(next_invoices[1])
+            next_invoices = next(invoice_groups, None)
+
+        payments = []
+        while next_payments is not None and next_payments[0] <= policy_id:
+            if next_payments[0] == policy_id:
+                payments = list(next_payments[1])
+            next_payments = next(payment_groups, None)
+
+        yield policy_id, invoices, payments
+
+
+def iter_policy_rows(date_cursor, policy_ids=None):
+    """
+     Yields (policy_id, invoices, payments) for every policy, or only the
+     given policy ids, with the non-deleted invoices billed and the
+     payments made on or before date_cursor. Uses three queries per chunk
+     of policies rather than three per policy.
+    """
+    invoices = Invoice.__table__
+    payments = Payment.__table__
+
+    if policy_ids is None:
+        id_chunks = [None]
+    else:
+        id_chunks = _chunks(sorted(set(policy_ids)), POLICY_ID_CHUNK_SIZE)
+
+    for id_chunk in id_chunks:
+        policy_query = select([Policy.id]).order_by(Policy.id)
+        invoice_query = select([invoices])\
+            .where(and_(invoices.c.deleted == 0, invoices.c.bill_date <= date_cursor))\
+            .order_by(invoices.c.policy_id, invoices.c.bill_date)
+        payment_query = select([payments])\
+            .where(payments.c.transaction_date <= date_cursor)\
+            .order_by(payments.c.policy_id)
+        if id_chunk is not None:
+            policy_query = policy_query.where(Policy.id.in_(id_chunk))
+            invoice_query = invoice_query.where(invoices.c.policy_id.in_(id_chunk))
+            payment_query = payment_query.where(payments.c.policy_id.in_(id_chunk))
+
+        policy_ids_in_chunk = [row[0] for row in db.session.execute(policy_query)]
+        for policy_rows in _merge_policy_rows(policy_ids_in_chunk,
+                                              db.session.execute(invoice_query),
+                                              db.session.execute(payment_query)):
+            yield policy_rows
+
+
+def evaluate_portfolio_cancellations(date_cursor=None, policy_ids=None):
+    """
+     Returns {policy_id: CancellationResult} for every policy, or only the
+     given policy ids, as of a specified date. Defaults to today's date if
+     nothing is specified. Matches PolicyAccounting.evaluate_cancel per policy.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+
+    results = {}
+    for policy_id, invoices, payments in iter_policy_rows(date_cursor, policy_ids):
+        results[policy_id] = evaluate_cancel_from_rows(invoices, payments, date_cursor)
+
+    logging.info('Evaluated cancellation for ' + str(len(results)) + ' policies.')
+    return results
@@ -0,0 +1,69 @@
+#!/user/bin/env python2.7
+
+from sqlalchemy import and_, func, select
+from sqlalchemy.orm import joinedload, subqueryload, subqueryload_all
+
+from accounting import db
+from models import Contact, Invoice, Payment, Policy
+
+"""
+#######################################################
+Read-side loaders that fetch a policy together with
+everything a page needs in a fixed number of queries.
+#######################################################
+"""
+
+
+def load_policy_detail(policy_id):
+    """
+     Returns the policy with its insured, agent, invoices, archived
+     invoices, payments and each payment's contact already loaded, or
+     None if it doesn't exist. Always five queries, however long the
+     policy's history is.
+    """
+    return Policy.query.options(joinedload('insured_contact'),
+                                joinedload('agent_contact'),
+                                subqueryload('invoices'),
+                                subqueryload('archived_invoices'),
+                                subqueryload_all('payments.contact'))\
+                       .filter_by(id=policy_id)\
+                       .first()
+
+
+def load_statement_version(policy_id):
+    """
+     Returns the columns that change whenever a policy's statement does:
+     the policy's own columns the statement shows, the names of its
+     insured, agent and payers, and the newest invoice and payment ids,
+     in one query without loading the invoices or payments. Returns None
+     if the policy doesn't exist.
+    """
+    invoices = Invoice.__table__
+    payments = Payment.__table__
+    policies = Policy.__table__
+    contacts = Contact.__table__
+    latest_invoice = select([func.max(invoices.c.id)])\
+        .where(invoices.c.policy_id == policies.c.id).as_scalar()
+    latest_payment = select([func.max(payments.c.id)])\
+        .where(payments.c.policy_id == policies.c.id).as_scalar()
+    insured_name = select([contacts.c.name])\
+        .where(contacts.c.id == policies.c.named_insured).as_scalar()
+    agent_name = select([contacts.c.name])\
+        .where(contacts.c.id == policies.c.agent).as_scalar()
+    payer_names = select([func.group_concat(contacts.c.name)])\
+        .where(and_(payments.c.policy_id == policies.c.id, contacts.c.id == payments.c.contact_id)).as_scalar()
+
+    return db.session.execute(select([policies.c.status,
+                                      policies.c.canceled_date,
+                                      policies.c.cancel_reason,
+                                      policies.c.effective_date,
+                                      policies.c.named_insured,
+                                      policies.c.agent,
+                                      policies.c.annual_premium,
+                                      policies.c.billing_schedule,
+                                      insured_name,
+                                      agent_name,
+                                      payer_names,
+                                      latest_invoice,
+                                      latest_payment])
+                              .where(policies.c.id == policy_id)).first()
@@ -0,0 +1,46 @@
+#!/user/bin/env python2.7
+
+from dateutil.relativedelta import relativedelta
+
+from cache import LRUCache
+
+"""
+#######################################################
+Invoice date layouts for each billing schedule. Every
+policy with the same schedule and effective date gets
+the same dates, so the layouts are cached.
+#######################################################
+"""
+
+SCHEDULE_CACHE_SIZE = 4096
+
+billing_schedules = {'Annual': 1, 'Two-Pay': 2, 'Quarterly': 4, 'Monthly': 12}
+
+# Bill date offsets from the effective date, worked out once per schedule.
+# Due and cancel dates are offset from the bill date so month-end dates
+# come out the same as adding to each bill date.
+bill_offsets = {}
+for schedule, required_invoices in billing_schedules.items():
+    bill_offsets[schedule] = [relativedelta(months=i * (12 / required_invoices))
+                              for i in range(required_invoices)]
+due_offset = relativedelta(months=1)
+cancel_offset = relativedelta(months=1, days=14)
+
+schedule_cache = LRUCache(SCHEDULE_CACHE_SIZE)
+
+
+def invoice_schedule(billing_schedule, effective_date):
+    """
+     Returns a tuple of (bill_date, due_date, cancel_date) for each invoice
+     of a year on the given schedule starting at effective_date.
+    """
+    key = (billing_schedule, effective_date)
+    schedule = schedule_cache.get(key)
+    if schedule is None:
+        dates = []
+        for bill_offset in bill_offsets[billing_schedule]:
+            bill_date = effective_date + bill_offset
+            dates.append((bill_date, bill_date + due_offset, bill_date + cancel_offset))
+        schedule = tuple(dates)
+        schedule_cache.put(key, schedule)
+    return schedule
@@ -0,0 +1,182 @@
+#!/user/bin/env python2.7
+
+import sys
+from datetime import datetime
+from sqlalchemy import select
+
+from accounting import db
+from models import Invoice, Payment, Policy
+from portfolio import POLICY_ID_CHUNK_SIZE
+from timeline import BalanceTimeline, evaluate_cancel_from_rows, evaluate_pending_from_rows
+
+import logging
+
+"""
+#######################################################
+Read-only policy snapshots for batch jobs that touch
+every policy. Loads only the columns the accounting
+rules use, with core queries, into __slots__ records
+with no ORM state, and shares the date and amount
+objects that repeat across the book.
+#######################################################
+"""
+
+
+class InvoiceRecord(object):
+
+    __slots__ = ('id', 'bill_date', 'due_date', 'cancel_date', 'amount_due')
+
+    def __init__(self, id, bill_date, due_date, cancel_date, amount_due):
+        self.id = id
+        self.bill_date = bill_date
+        self.due_date = due_date
+        self.cancel_date = cancel_date
+        self.amount_due = amount_due
+
+
+class PaymentRecord(object):
+
+    __slots__ = ('id', 'contact_id', 'transaction_date', 'amount_paid')
+
+    def __init__(self, id, contact_id, transaction_date, amount_paid):
+        self.id = id
+        self.contact_id = contact_id
+        self.transaction_date = transaction_date
+        self.amount_paid = amount_paid
+
+
+class PolicySnapshot(object):
+
+    """
+     One policy with its non-deleted invoices and its payments, answering
+     the same balance and cancellation questions as PolicyAccounting
+     without touching the database.
+    """
+    __slots__ = ('id', 'policy_number', 'status', 'billing_schedule', 'named_insured', 'agent',
+                 'invoices', 'payments')
+
+    def __init__(self, id, policy_number, status, billing_schedule, named_insured, agent):
+        self.id = id
+        self.policy_number = policy_number
+        self.status = status
+        self.billing_schedule = billing_schedule
+        self.named_insured = named_insured
+        self.agent = agent
+        self.invoices = ()
+        self.payments = ()
+
+    def return_account_balance(self, date_cursor=None):
+        """
+         Returns the account balance on a date, or today.
+        """
+        if not date_cursor:
+            date_cursor = datetime.now().date()
+        return BalanceTimeline(self.invoices, self.payments).balance_at(date_cursor)
+
+    def evaluate_cancellation_pending_due_to_non_pay(self, date_cursor=None):
+        """
+         Returns True if an invoice is past its due date but not its cancel
+         date with a balance due on a date, or today.
+        """
+        if not date_cursor:
+            date_cursor = datetime.now().date()
+        return evaluate_pending_from_rows(self.invoices, self.payments, date_cursor)
+
+    def evaluate_cancel(self, date_cursor=None):
+        """
+         Returns the CancellationResult PolicyAccounting.evaluate_cancel
+         would on a date, or today.
+        """
+        if not date_cursor:
+            date_cursor = datetime.now().date()
+        invoices = [invoice for invoice in self.invoices if invoice.bill_date <= date_cursor]
+        payments = [payment for payment in self.payments if payment.transaction_date <= date_cursor]
+        return evaluate_cancel_from_rows(invoices, payments, date_cursor)
+
+
+def _load_chunk(snapshots, policy_ids, shared):
+    """
+     Adds the snapshots of the given policies, or every policy if
+     policy_ids is None, to the snapshots dict.
+    """
+    policies = Policy.__table__
+    invoices = Invoice.__table__
+    payments = Payment.__table__
+    policy_query = select([policies.c.id, policies.c.policy_number, policies.c.status,
+                           policies.c.billing_schedule, policies.c.named_insured, policies.c.agent])
+    invoice_query = select([invoices.c.id, invoices.c.policy_id, invoices.c.bill_date,
+                            invoices.c.due_date, invoices.c.cancel_date, invoices.c.amount_due])\
+        .where(invoices.c.deleted == False)\
+        .order_by(invoices.c.policy_id, invoices.c.bill_date, invoices.c.id)
+    payment_query = select([payments.c.id, payments.c.policy_id, payments.c.contact_id,
+                            payments.c.transaction_date, payments.c.amount_paid])\
+        .order_by(payments.c.policy_id, payments.c.transaction_date, payments.c.id)
+    if policy_ids is not None:
+        policy_query = policy_query.where(policies.c.id.in_(policy_ids))
+        invoice_query = invoice_query.where(invoices.c.policy_id.in_(policy_ids))
+        payment_query = payment_query.where(payments.c.policy_id.in_(policy_ids))
+
+    for row in db.session.execute(policy_query):
+        snapshots[row.id] = PolicySnapshot(row.id, row.policy_number, shared(row.status),
+                                           shared(row.billing_schedule), row.named_insured, row.agent)
+
+    grouped = {}
+    for row in db.session.execute(invoice_query):
+        grouped.setdefault(row.policy_id, []).append(
+            InvoiceRecord(row.id, shared(row.bill_date), shared(row.due_date),
+                          shared(row.cancel_date), shared(row.amount_due)))
+    for policy_id, records in grouped.iteritems():
+        if policy_id in snapshots:
+            snapshots[policy_id].invoices = tuple(records)
+
+    grouped = {}
+    for row in db.session.execute(payment_query):
+        grouped.setdefault(row.policy_id, []).append(
+            PaymentRecord(row.id, row.contact_id, shared(row.transaction_date), shared(row.amount_paid)))
+    for policy_id, records in grouped.iteritems():
+        if policy_id in snapshots:
+            snapshots[policy_id].payments = tuple(records)
+
+
+def load_snapshot(policy_ids=None):
+    """
+     Returns {policy_id: PolicySnapshot} for every policy, or only the
+     given ones, in three queries per chunk of policies. Equal dates,
+     amounts and statuses are loaded as one shared object each.
+    """
+    values = {}
+
+    def shared(value):
+        return values.setdefault(value, value)
+
+    snapshots = {}
+    if policy_ids is None:
+        _load_chunk(snapshots, None, shared)
+    else:
+        policy_ids = sorted(set(policy_ids))
+        for start in range(0, len(policy_ids), POLICY_ID_CHUNK_SIZE):
+            _load_chunk(snapshots, policy_ids[start:start + POLICY_ID_CHUNK_SIZE], shared)
+
+    logging.info('Loaded snapshots of ' + str(len(snapshots)) + ' policies sharing '
+                 + str(len(values)) + ' values.')
+    return snapshots
+
+
+def snapshot_size(snapshots):
+    """
+     Returns the bytes held by the snapshots, their records and the
+     containers holding them, counting each shared value once.
+    """
+    size = sys.getsizeof(snapshots)
+    seen = set()
+    for snapshot in snapshots.itervalues():
+        size += sys.getsizeof(snapshot) + sys.getsizeof(snapshot.policy_number)
+        size += sys.getsizeof(snapshot.invoices) + sys.getsizeof(snapshot.payments)
+        for record in snapshot.invoices + snapshot.payments:
+            size += sys.getsizeof(record)
+            for name in record.__slots__:
+                value = getattr(record, name)
+                if id(value) not in seen:
+                    seen.add(id(value))
+                    size += sys.getsizeof(value)
+    return size
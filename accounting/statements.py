@@ -0,0 +1,187 @@
+#!/user/bin/env python2.7
+
+import hashlib
+from collections import OrderedDict
+from decimal import Decimal, ROUND_05UP
+from sqlalchemy import event
+
+from cache import TTLCache
+from models import Contact, Policy
+from queries import load_policy_detail, load_statement_version
+from timeline import BalanceTimeline, monthly_dates
+
+import logging
+
+"""
+#######################################################
+The policy statement shared by the policy page and the
+JSON API, the cache that keeps recently viewed ones,
+and the ETag that lets API clients skip refetching a
+statement that hasn't changed.
+#######################################################
+"""
+
+STATEMENT_CACHE_SIZE = 10000
+
+# Seconds a cached statement is trusted. PolicyAccounting invalidates
+# the policies it writes to, so this only bounds how long writes made by
+# other processes (the sweep, manage.py jobs) can go unseen.
+STATEMENT_CACHE_TTL = 300
+
+
+def _money(amount):
+    return str(Decimal(amount).quantize(Decimal('.01'), ROUND_05UP))
+
+
+def _invoice_json(invoice):
+    return {'id': invoice.id,
+            'bill_date': str(invoice.bill_date),
+            'due_date': str(invoice.due_date),
+            'cancel_date': str(invoice.cancel_date),
+            'amount_due': _money(invoice.amount_due)}
+
+
+def _payment_json(payment):
+    return {'id': payment.id,
+            'contact_id': payment.contact_id,
+            'contact_name': payment.contact.name,
+            'transaction_date': str(payment.transaction_date),
+            'amount_paid': _money(payment.amount_paid)}
+
+
+def build_statement(policy, date_cursor):
+    """
+     Returns the statement for a policy loaded by load_policy_detail as
+     of the given date, as a dict of plain JSON values that both the
+     template and the API can use.
+    """
+    current_invoices = [invoice for invoice in policy.invoices
+                        if not invoice.deleted and invoice.bill_date <= date_cursor]
+    # deleted invoices not yet moved to the archive by compact_invoices
+    deleted_invoices = [invoice for invoice in policy.invoices + policy.archived_invoices
+                        if getattr(invoice, 'deleted', True) and invoice.bill_date <= date_cursor]
+    deleted_invoices.sort(key=lambda invoice: (invoice.bill_date, invoice.id))
+    payments = policy.payments
+    timeline = BalanceTimeline(current_invoices, payments)
+    balance = timeline.balance_at(date_cursor)
+    history_dates = monthly_dates(policy.effective_date, date_cursor)
+
+    return {'policy_id': policy.id,
+            'date': str(date_cursor),
+            'balance': str(balance),
+            'balance_history': [{'date': str(history_date), 'balance': str(history_balance)}
+                                for history_date, history_balance
+                                in zip(history_dates, timeline.balances_at(history_dates))],
+            'current_invoices': [_invoice_json(invoice) for invoice in current_invoices],
+            'deleted_invoices': [_invoice_json(invoice) for invoice in deleted_invoices],
+            'payments': [_payment_json(payment) for payment in payments],
+            'policy_name': policy.policy_number,
+            'billing': policy.billing_schedule,
+            'effective_date': str(policy.effective_date),
+            'status': policy.status,
+            'annual_premium': _money(policy.annual_premium),
+            'named_insured': policy.insured_contact.name,
+            'agent_name': policy.agent_contact.name,
+            'canceled_date': policy.canceled_date and str(policy.canceled_date),
+            'cancel_reason': policy.cancel_reason}
+
+
+class StatementCache(object):
+
+    """
+     Built statements keyed on (policy_id, date). Invalidating a policy
+     gives it a new generation, which is part of every key, so all of its
+     dates miss at once without a scan; the orphaned entries are never
+     used again and are the first to be evicted.
+
+     Generations come from one counter and only the most recently
+     invalidated maxsize policies keep theirs. The rest share a floor
+     that is raised to every generation evicted, so a policy that loses
+     its generation can never fall back to a key it had before.
+    """
+    def __init__(self, maxsize=STATEMENT_CACHE_SIZE, ttl=STATEMENT_CACHE_TTL):
+        self.cache = TTLCache(maxsize, ttl)
+        self.maxsize = maxsize
+        self.generations = OrderedDict()
+        self.generation = 0
+        self.floor = 0
+        self.invalidations = 0
+
+    def _key(self, policy_id, date_cursor):
+        return (int(policy_id), date_cursor, self.generations.get(int(policy_id), self.floor))
+
+    def get(self, policy_id, date_cursor):
+        return self.cache.get(self._key(policy_id, date_cursor))
+
+    def put(self, policy_id, date_cursor, statement):
+        self.cache.put(self._key(policy_id, date_cursor), statement)
+
+    def invalidate(self, policy_id):
+        """
+         Drops every cached date of a policy. Called after each write.
+        """
+        policy_id = int(policy_id)
+        self.generation += 1
+        self.generations.pop(policy_id, None)
+        self.generations[policy_id] = self.generation
+        while len(self.generations) > self.maxsize:
+            self.floor = self.generations.popitem(last=False)[1]
+        self.invalidations += 1
+
+    def clear(self):
+        self.cache.clear()
+        self.generations.clear()
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats['invalidations'] = self.invalidations
+        return stats
+
+
+statement_cache = StatementCache()
+
+
+def _policy_changed(mapper, connection, target):
+    statement_cache.invalidate(target.id)
+
+
+def _contact_changed(mapper, connection, target):
+    # any policy's statement can show a contact's name
+    statement_cache.clear()
+
+
+# agent reassignments and contact renames made through the ORM
+event.listen(Policy, 'after_update', _policy_changed)
+event.listen(Contact, 'after_update', _contact_changed)
+
+
+def load_statement(policy_id, date_cursor):
+    """
+     Returns the policy's statement on the given date from the cache,
+     building and caching it on a miss. Returns None if the policy
+     doesn't exist.
+    """
+    statement = statement_cache.get(policy_id, date_cursor)
+    if statement is None:
+        policy = load_policy_detail(policy_id)
+        if not policy:
+            return None
+        statement = build_statement(policy, date_cursor)
+        statement_cache.put(policy_id, date_cursor, statement)
+        logging.debug('Cached statement for policy ' + str(policy_id) + ' on ' + str(date_cursor))
+    return statement
+
+
+def statement_etag(policy_id, date_cursor):
+    """
+     Returns a strong ETag for the policy's statement on the given date,
+     or None if the policy doesn't exist. Invoices and payments are only
+     ever added (a billing change deletes the old invoices by adding new
+     ones), so the newest ids stand in for their contents; the policy's
+     columns and the contacts' names are compared as they are.
+    """
+    version = load_statement_version(policy_id)
+    if version is None:
+        return None
+    key = repr((policy_id, str(date_cursor)) + tuple(str(value) for value in version))
+    return hashlib.sha1(key).hexdigest()
@@ -26,6 +26,8 @@ function validate_and_submit_payment() {
         function(result) {
             $( "#submit_success" ).text(result);
             $( "#payment_amount").val("")
+        }).fail(function(response) {
+            $( "#submit_error" ).text(response.responseText);
         });
 }
 
@@ -33,10 +35,14 @@ function submit_billing() {
     $.post($SCRIPT_ROOT + "/billing/",
         {
             id: $( "#id" ).val(),
-            new_billing: $( "#new_billing").val()
+            new_billing: $( "#new_billing").val(),
+            change_date: $( "#change_date").val()
         },
         function(result) {
+            $( "#submit_error" ).text("");
             $( "#submit_success" ).text(result);
+        }).fail(function(response) {
+            $( "#submit_error" ).text(response.responseText);
         });
 }
 
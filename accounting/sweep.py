@@ -0,0 +1,114 @@
+#!/user/bin/env python2.7
+
+from datetime import datetime
+from multiprocessing import Pool, cpu_count
+from sqlalchemy import and_, select
+
+from accounting import db
+from engine import forget_read_engines
+from models import Policy
+from portfolio import iter_policy_rows
+from timeline import evaluate_cancel_from_rows, evaluate_pending_from_rows
+from tools import PolicyAccounting
+
+import logging
+
+"""
+#######################################################
+Nightly cancellation sweep. Splits the active policies
+into shards by id and evaluates each shard in its own
+worker process.
+#######################################################
+"""
+
+CANCEL_REASON = 'Non-payment'
+
+
+def _reset_connections():
+    """
+     Forked workers must not share the parent's SQLite connections, so
+     the inherited session is dropped without being closed.
+    """
+    db.session.registry.clear()
+    db.engine.dispose()
+    forget_read_engines()
+
+
+def sweep_shard(args):
+    """
+     Evaluates cancellation and pending cancellation for every active
+     policy whose id falls in the given shard (and in only_ids, if it is
+     not None). Cancels the policies that should have canceled if
+     apply_cancellations is set. Returns a partial report for run_sweep
+     to merge.
+    """
+    date_cursor, shard, shard_count, apply_cancellations, only_ids = args
+    query = select([Policy.id]).where(and_(Policy.status == 'Active',
+                                           Policy.id % shard_count == shard))
+    if only_ids is not None:
+        query = query.where(Policy.id.in_(only_ids))
+    policy_ids = [row[0] for row in db.session.execute(query)]
+
+    report = {'evaluated': 0, 'should_cancel': [], 'pending': [], 'canceled': []}
+    cancel_dates = {}
+    for policy_id, invoices, payments in iter_policy_rows(date_cursor, policy_ids):
+        report['evaluated'] += 1
+        result = evaluate_cancel_from_rows(invoices, payments, date_cursor)
+        if result.should_cancel:
+            report['should_cancel'].append(policy_id)
+            cancel_dates[policy_id] = result.invoice.cancel_date
+        elif evaluate_pending_from_rows(invoices, payments, date_cursor):
+            report['pending'].append(policy_id)
+
+    # cancel_policy commits, so wait until the shard's cursors are drained
+    if apply_cancellations:
+        for policy_id in report['should_cancel']:
+            pa = PolicyAccounting(policy_id)
+            if pa.cancel_policy(CANCEL_REASON, cancel_dates[policy_id]):
+                report['canceled'].append(policy_id)
+
+    logging.info('Shard ' + str(shard) + ' evaluated ' + str(report['evaluated']) + ' policies.')
+    return report
+
+
+def run_sweep(date_cursor=None, workers=None, apply_cancellations=False, policy_ids=None):
+    """
+     Sweeps every active policy (or only the given policy ids) as of the
+     given date, or today, across a pool of worker processes and merges
+     their results into one report.
+    """
+    if not date_cursor:
+        date_cursor = datetime.now().date()
+    if not workers:
+        workers = cpu_count()
+
+    shards = [(date_cursor, shard, workers, apply_cancellations, policy_ids)
+              for shard in range(workers)]
+    started = datetime.now()
+    if workers == 1:
+        partials = [sweep_shard(shards[0])]
+    else:
+        pool = Pool(workers, initializer=_reset_connections)
+        try:
+            partials = pool.map(sweep_shard, shards)
+        finally:
+            pool.close()
+            pool.join()
+
+    report = {'date': str(date_cursor),
+              'workers': workers,
+              'evaluated': 0,
+              'should_cancel': [],
+              'pending': [],
+              'canceled': []}
+    for partial in partials:
+        report['evaluated'] += partial['evaluated']
+        for key in ['should_cancel', 'pending', 'canceled']:
+            report[key].extend(partial[key])
+    for key in ['should_cancel', 'pending', 'canceled']:
+        report[key].sort()
+    report['seconds'] = (datetime.now() - started).total_seconds()
+
+    logging.info('Sweep evaluated ' + str(report['evaluated']) + ' policies in '
+                 + str(report['seconds']) + ' seconds.')
+    return report
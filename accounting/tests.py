@@ -1,12 +1,44 @@
 #!/user/bin/env python2.7
 
+import csv
+import json
+import os
+import shutil
+import tempfile
 import unittest
+from cStringIO import StringIO
 from datetime import date, datetime
+from decimal import Decimal
 from dateutil.relativedelta import relativedelta
+from flask import Flask
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError, StatementError
 
-from accounting import db
-from models import Contact, Invoice, Payment, Policy
+from accounting import app, db
+from models import ArchivedInvoice, Contact, Invoice, LedgerEntry, Payment, Policy
 from tools import PolicyAccounting
+from queries import load_policy_detail
+from statements import StatementCache, load_statement, statement_cache
+from invoicing import make_invoices_bulk
+from schedules import invoice_schedule, schedule_cache
+from aging import AgingRow, aging_totals, iter_aging
+from analytics import analyze, cross_check, load_portfolio_arrays, numpy
+from archive import compact_invoices
+from cache import LRUCache, TTLCache
+from contacts import contact_resolver
+from engine import read_engine, sqlite_pragmas
+from ledger import rebuild_ledger, verify_ledger
+from export import ExportError, export_watermark, iter_export, write_export
+from generator import generate_book, reset_database
+from instrumentation import Instrumentation, percentile
+from onboarding import PolicySpec, onboard_policies
+from payment_import import import_payments
+from migrations import MIGRATIONS, convert_money_to_cents, drop_indexes, migrate, schema_version
+from money import from_cents, split_cents, to_cents
+from snapshot import InvoiceRecord, load_snapshot
+from sweep import run_sweep
+from portfolio import evaluate_portfolio_cancellations, return_portfolio_balance_history, \
+    return_portfolio_balances
 
 """
 #######################################################
@@ -42,6 +74,7 @@ class TestBillingSchedules(unittest.TestCase):
         pass
 
     def tearDown(self):
+        LedgerEntry.query.filter_by(policy_id=self.policy.id).delete()
         for invoice in self.policy.invoices:
             db.session.delete(invoice)
         db.session.commit()
@@ -114,6 +147,7 @@ class TestReturnAccountBalance(unittest.TestCase):
         self.payments = []
 
     def tearDown(self):
+        LedgerEntry.query.filter_by(policy_id=self.policy.id).delete()
         for invoice in self.policy.invoices:
             db.session.delete(invoice)
         for payment in self.payments:
@@ -146,6 +180,17 @@ class TestReturnAccountBalance(unittest.TestCase):
                                              date_cursor=invoices[1].bill_date))
         self.assertEquals(pa.return_account_balance(date_cursor=invoices[1].bill_date), 0)
 
+    def test_balances_at_many_dates_match_single_lookups(self):
+        self.policy.billing_schedule = "Monthly"
+        pa = PolicyAccounting(self.policy.id)
+        self.payments.append(pa.make_payment(amount=250, contact_id=self.policy.named_insured,
+                                             date_cursor=date(2015, 1, 20)))
+        dates = [date(2014, 12, 31)] + [date(2015, 1, 1) + relativedelta(days=10 * i) for i in range(40)]
+        balances = pa.return_account_balances(reversed(dates))
+        self.assertEquals([balance_date for balance_date, balance in balances], dates)
+        for balance_date, balance in balances:
+            self.assertEquals(balance, pa.return_account_balance(balance_date))
+
 
 class TestCancellations(unittest.TestCase):
 
@@ -174,6 +219,7 @@ class TestCancellations(unittest.TestCase):
         self.payments = []
 
     def tearDown(self):
+        LedgerEntry.query.filter_by(policy_id=self.policy.id).delete()
         for invoice in self.policy.invoices:
             db.session.delete(invoice)
         for payment in self.payments:
@@ -248,6 +294,7 @@ class TestChangedBillingCycles(unittest.TestCase):
         self.payments = []
 
     def tearDown(self):
+        LedgerEntry.query.filter_by(policy_id=self.policy.id).delete()
         for invoice in self.policy.invoices:
             db.session.delete(invoice)
         for payment in self.payments:
@@ -275,6 +322,49 @@ class TestChangedBillingCycles(unittest.TestCase):
         pa.change_billing_schedule('Monthly')
         self.assertEquals(pa.return_account_balance(date(2015, 1, 2)), 100)
 
+    def test_change_billing_cycle_mid_term_keeps_billed_invoices(self):
+        self.policy.billing_schedule = 'Quarterly'
+        pa = PolicyAccounting(self.policy.id)
+        kept = [invoice.id for invoice in self.policy.invoices if invoice.bill_date < date(2015, 4, 15)]
+        pa.change_billing_schedule('Monthly', date(2015, 4, 15))
+
+        invoices = Invoice.query.filter_by(policy_id=self.policy.id).order_by(Invoice.bill_date).all()
+        current = [invoice for invoice in invoices if not invoice.deleted]
+        self.assertEquals(len(invoices), 12)
+        self.assertEquals([invoice.id for invoice in current[:2]], kept)
+        # 600 billed by January and April, the other 600 over May to December
+        self.assertEquals([invoice.bill_date.month for invoice in current[2:]], range(5, 13))
+        self.assertEquals(set(invoice.amount_due for invoice in current[2:]), set([75]))
+        self.assertEquals(pa.return_account_balance(date(2015, 5, 2)), 675)
+        self.assertEquals(pa.return_account_balance(date(2015, 12, 2)), 1200)
+        self.assertEquals(verify_ledger([self.policy.id]), [])
+
+    def test_change_billing_cycle_on_a_bill_date(self):
+        self.policy.billing_schedule = 'Quarterly'
+        pa = PolicyAccounting(self.policy.id)
+        kept = [invoice.id for invoice in self.policy.invoices if invoice.bill_date <= date(2015, 4, 1)]
+        pa.change_billing_schedule('Monthly', date(2015, 4, 1))
+
+        current = Invoice.query.filter_by(policy_id=self.policy.id, deleted=False)\
+                               .order_by(Invoice.bill_date).all()
+        # the April invoice was already billed on the change date, so it stays
+        self.assertEquals([invoice.id for invoice in current[:2]], kept)
+        self.assertEquals([(invoice.bill_date.month, invoice.amount_due) for invoice in current[2:]],
+                          [(month, 75) for month in range(5, 13)])
+        self.assertEquals(Invoice.query.filter_by(policy_id=self.policy.id, deleted=True).count(), 2)
+        self.assertEquals(verify_ledger([self.policy.id]), [])
+
+    def test_change_billing_cycle_mid_term_past_last_bill_date(self):
+        self.policy.billing_schedule = 'Two-Pay'
+        pa = PolicyAccounting(self.policy.id)
+        pa.change_billing_schedule('Annual', date(2015, 3, 1))
+
+        current = Invoice.query.filter_by(policy_id=self.policy.id, deleted=False)\
+                               .order_by(Invoice.bill_date).all()
+        self.assertEquals([(invoice.bill_date, invoice.amount_due) for invoice in current],
+                          [(date(2015, 1, 1), 600), (date(2015, 3, 1), 600)])
+        self.assertEquals(current[1].due_date, date(2015, 4, 1))
+
 
 class TestMiscFunctions(unittest.TestCase):
 
@@ -303,14 +393,1322 @@ class TestMiscFunctions(unittest.TestCase):
         self.payments = []
 
     def tearDown(self):
+        LedgerEntry.query.filter_by(policy_id=self.policy.id).delete()
         for invoice in self.policy.invoices:
             db.session.delete(invoice)
         for payment in self.payments:
             db.session.delete(payment)
         db.session.commit()
 
+    def test_read_only_construction_does_not_make_invoices(self):
+        pa = PolicyAccounting(self.policy.id, read_only=True)
+        self.assertEquals(pa.policy, self.policy)
+        self.assertFalse(self.policy.invoices)
+
+    def test_read_only_construction_with_missing_policy(self):
+        pa = PolicyAccounting(-1, read_only=True)
+        self.assertEquals(pa.policy, None)
+
+    def test_construction_from_loaded_policy(self):
+        self.policy.billing_schedule = 'Annual'
+        pa = PolicyAccounting(self.policy)
+        self.assertEquals(pa.policy, self.policy)
+        self.assertEquals(len(self.policy.invoices), 1)
+
     def test_make_payment(self):
         self.policy.billing_schedule = 'Monthly'
         pa = PolicyAccounting(self.policy.id)
         self.payments.append(pa.make_payment(100, self.policy.named_insured, date(2015, 1, 10)))
         self.assertEquals(pa.return_account_balance(date(2015, 1, 10)), 0)
+
+    def test_make_payment_refuses_fractions_of_a_cent(self):
+        pa = PolicyAccounting(self.policy.id)
+        self.assertFalse(pa.make_payment('0.004', self.policy.named_insured, date(2015, 1, 10)))
+        self.assertFalse(pa.make_payment('ten', self.policy.named_insured, date(2015, 1, 10)))
+        self.assertEquals(Payment.query.filter_by(policy_id=self.policy.id).count(), 0)
+
+
+class TestPortfolioBalances(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test Policy', date(2015, 1, 1), 1600)
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        db.session.add(cls.policy)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.delete(cls.policy)
+        db.session.commit()
+
+    def setUp(self):
+        self.payments = []
+
+    def tearDown(self):
+        LedgerEntry.query.filter_by(policy_id=self.policy.id).delete()
+        for invoice in self.policy.invoices:
+            db.session.delete(invoice)
+        for payment in self.payments:
+            db.session.delete(payment)
+        db.session.commit()
+
+    def test_portfolio_balance_matches_policy_balance(self):
+        self.policy.billing_schedule = 'Monthly'
+        pa = PolicyAccounting(self.policy.id)
+        self.payments.append(pa.make_payment(150, self.policy.agent, date(2015, 2, 7)))
+        for date_cursor in [date(2014, 12, 31), date(2015, 2, 7), date(2016, 1, 1)]:
+            balances = return_portfolio_balances(date_cursor, [self.policy.id])
+            self.assertEquals(balances, {self.policy.id: pa.return_account_balance(date_cursor)})
+
+    def test_portfolio_balance_history_covers_every_policy(self):
+        self.policy.billing_schedule = 'Quarterly'
+        PolicyAccounting(self.policy.id)
+        dates = [date(2015, 1, 1), date(2015, 6, 1)]
+        history = return_portfolio_balance_history(dates)
+        for policy in Policy.query.all():
+            pa = PolicyAccounting(policy, read_only=True)
+            for date_cursor in dates:
+                self.assertEquals(history[date_cursor][policy.id],
+                                  pa.return_account_balance(date_cursor))
+
+
+class TestEvaluateCancel(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        cls.policy.billing_schedule = 'Quarterly'
+        db.session.add(cls.policy)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.delete(cls.policy)
+        db.session.commit()
+
+    def setUp(self):
+        self.payments = []
+
+    def tearDown(self):
+        LedgerEntry.query.filter_by(policy_id=self.policy.id).delete()
+        for invoice in self.policy.invoices:
+            db.session.delete(invoice)
+        for payment in self.payments:
+            db.session.delete(payment)
+        db.session.commit()
+
+    def test_should_not_cancel_before_cancel_date(self):
+        pa = PolicyAccounting(self.policy.id)
+        result = pa.evaluate_cancel(date(2015, 2, 14))
+        self.assertFalse(result.should_cancel)
+        self.assertEquals(result.balance, 300)
+
+    def test_should_cancel_on_first_unpaid_cancel_date(self):
+        pa = PolicyAccounting(self.policy.id)
+        self.payments.append(pa.make_payment(300, self.policy.agent, date(2015, 1, 15)))
+        result = pa.evaluate_cancel(date(2015, 12, 31))
+        self.assertTrue(result.should_cancel)
+        self.assertEquals(result.invoice.bill_date, date(2015, 4, 1))
+        self.assertEquals(result.balance, 300)
+
+    def test_portfolio_cancellations_match_policy_evaluation(self):
+        pa = PolicyAccounting(self.policy.id)
+        self.payments.append(pa.make_payment(300, self.policy.agent, date(2015, 1, 15)))
+        date_cursor = date(2015, 6, 1)
+        results = evaluate_portfolio_cancellations(date_cursor)
+        for policy in Policy.query.all():
+            expected = PolicyAccounting(policy, read_only=True).evaluate_cancel(date_cursor)
+            self.assertEquals(results[policy.id].should_cancel, expected.should_cancel)
+            self.assertEquals(results[policy.id].balance, expected.balance)
+
+
+class TestCancellationSweep(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        cls.policy.billing_schedule = 'Quarterly'
+        db.session.add(cls.policy)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.delete(cls.policy)
+        db.session.commit()
+
+    def tearDown(self):
+        LedgerEntry.query.filter_by(policy_id=self.policy.id).delete()
+        for invoice in self.policy.invoices:
+            db.session.delete(invoice)
+        self.policy.status = 'Active'
+        self.policy.canceled_date = None
+        self.policy.cancel_reason = None
+        db.session.commit()
+
+    def test_sweep_finds_pending_policy(self):
+        PolicyAccounting(self.policy.id)
+        report = run_sweep(date(2015, 2, 7), workers=2)
+        self.assertTrue(self.policy.id in report['pending'])
+        self.assertFalse(self.policy.id in report['should_cancel'])
+
+    def test_sweep_cancels_policy(self):
+        PolicyAccounting(self.policy.id)
+        report = run_sweep(date(2015, 3, 1), workers=1, apply_cancellations=True,
+                           policy_ids=[self.policy.id])
+        self.assertTrue(self.policy.id in report['should_cancel'])
+        self.assertTrue(self.policy.id in report['canceled'])
+        db.session.refresh(self.policy)
+        self.assertEquals(self.policy.status, 'Canceled')
+        self.assertEquals(self.policy.canceled_date, date(2015, 2, 15))
+
+
+class TestPolicyDetail(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        cls.policy.billing_schedule = 'Monthly'
+        db.session.add(cls.policy)
+        db.session.commit()
+        # the app removes the session after each request, detaching these
+        cls.ids = (cls.policy.id, cls.test_insured.id, cls.test_agent.id)
+
+        # event.remove doesn't support engines yet, so the listener stays
+        # registered and only records while a test is counting.
+        cls.statements = None
+        event.listen(db.engine, 'before_cursor_execute', cls.count_statement)
+        if read_engine() is not db.engine:
+            # the read-only routes query through their own pool
+            event.listen(read_engine(), 'before_cursor_execute', cls.count_statement)
+
+    @classmethod
+    def tearDownClass(cls):
+        policy_id, insured_id, agent_id = cls.ids
+        Policy.query.filter_by(id=policy_id).delete()
+        Contact.query.filter(Contact.id.in_([insured_id, agent_id])).delete(synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def count_statement(cls, conn, cursor, statement, parameters, context, executemany):
+        if cls.statements is not None:
+            cls.statements.append(statement)
+
+    def setUp(self):
+        statement_cache.clear()
+        self.policy = Policy.query.get(self.ids[0])
+
+    def tearDown(self):
+        policy_id = self.ids[0]
+        LedgerEntry.query.filter_by(policy_id=policy_id).delete()
+        Invoice.query.filter_by(policy_id=policy_id).delete()
+        Payment.query.filter_by(policy_id=policy_id).delete()
+        db.session.commit()
+
+    def test_policy_detail_query_count_does_not_grow_with_payments(self):
+        pa = PolicyAccounting(self.policy.id)
+        for month in range(1, 7):
+            pa.make_payment(100, self.policy.agent, date(2015, month, 1))
+        policy_id = self.policy.id
+        db.session.expire_all()
+
+        TestPolicyDetail.statements = []
+        try:
+            policy = load_policy_detail(policy_id)
+            names = [payment.contact.name for payment in policy.payments]
+            invoices = len(policy.invoices)
+            insured = policy.insured_contact.name
+            agent = policy.agent_contact.name
+            statements = TestPolicyDetail.statements
+        finally:
+            TestPolicyDetail.statements = None
+
+        self.assertEquals(len(statements), 5)
+        self.assertEquals(names, ['Test Agent'] * 6)
+        self.assertEquals(invoices, 12)
+        self.assertEquals((insured, agent), ('Test Insured', 'Test Agent'))
+
+    def test_policy_view_balance(self):
+        pa = PolicyAccounting(self.policy.id)
+        pa.make_payment(100, self.policy.agent, date(2015, 1, 1))
+        response = app.test_client().post('/policy/', data={'id': self.policy.id,
+                                                             'date': '2015-03-01'})
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('$200.00' in response.data)
+
+    def test_statement_api(self):
+        pa = PolicyAccounting(self.policy.id)
+        pa.make_payment(100, self.policy.agent, date(2015, 1, 1))
+        url = '/api/policies/' + str(self.policy.id) + '/statement?date=2015-03-01'
+        response = app.test_client().get(url)
+        self.assertEquals(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEquals(data['balance'], '200.00')
+        self.assertEquals(len(data['current_invoices']), 3)
+        self.assertEquals(data['payments'][0]['contact_name'], 'Test Agent')
+        self.assertEquals(data['named_insured'], 'Test Insured')
+
+    def test_statement_api_conditional_requests(self):
+        client = app.test_client()
+        url = '/api/policies/' + str(self.policy.id) + '/statement?date=2015-03-01'
+        etag = client.get(url).headers['ETag']
+
+        TestPolicyDetail.statements = []
+        try:
+            response = client.get(url, headers={'If-None-Match': etag})
+            statements = TestPolicyDetail.statements
+        finally:
+            TestPolicyDetail.statements = None
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(len(statements), 1)
+
+        pa = PolicyAccounting(self.policy.id)
+        pa.make_payment(100, self.policy.agent, date(2015, 1, 1))
+        response = client.get(url, headers={'If-None-Match': etag})
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEquals(response.headers['ETag'], etag)
+
+    def test_etag_follows_agent_and_contact_names(self):
+        client = app.test_client()
+        url = '/api/policies/' + str(self.policy.id) + '/statement?date=2015-03-01'
+        etag = client.get(url).headers['ETag']
+
+        other_agent = Contact('Other Agent', 'Agent')
+        db.session.add(other_agent)
+        db.session.commit()
+        # the app removes the session after each request, detaching it
+        agent_id = other_agent.id
+        try:
+            Policy.query.get(self.ids[0]).agent = agent_id
+            db.session.commit()
+            response = client.get(url, headers={'If-None-Match': etag})
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals(json.loads(response.data)['agent_name'], 'Other Agent')
+            etag = response.headers['ETag']
+
+            Contact.query.get(agent_id).name = 'Renamed Agent'
+            db.session.commit()
+            response = client.get(url, headers={'If-None-Match': etag})
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals(json.loads(response.data)['agent_name'], 'Renamed Agent')
+        finally:
+            Policy.query.get(self.ids[0]).agent = self.ids[2]
+            Contact.query.filter_by(id=agent_id).delete()
+            db.session.commit()
+
+    def test_statement_cache_invalidated_by_payment(self):
+        pa = PolicyAccounting(self.policy.id)
+        client = app.test_client()
+        url = '/api/policies/' + str(self.policy.id) + '/statement?date=2015-03-01'
+        self.assertEquals(json.loads(client.get(url).data)['balance'], '300.00')
+        hits = statement_cache.cache.hits
+        self.assertEquals(json.loads(client.get(url).data)['balance'], '300.00')
+        self.assertEquals(statement_cache.cache.hits, hits + 1)
+
+        invalidations = statement_cache.invalidations
+        pa.make_payment(100, self.ids[2], date(2015, 1, 1))
+        self.assertEquals(json.loads(client.get(url).data)['balance'], '200.00')
+        stats = json.loads(client.get('/api/statement-cache').data)
+        self.assertEquals(stats['invalidations'], invalidations + 1)
+
+    def test_statement_cache_generations_are_bounded(self):
+        cache = StatementCache(maxsize=2)
+        cache.put(1, date(2015, 1, 1), 'stale')
+        cache.invalidate(1)
+        cache.put(1, date(2015, 1, 1), 'fresh')
+        cache.invalidate(2)
+        cache.invalidate(3)
+        self.assertEquals(len(cache.generations), 2)
+        self.assertNotIn(1, cache.generations)
+        self.assertEquals(cache.get(1, date(2015, 1, 1)), 'fresh')
+
+    def test_balance_history(self):
+        pa = PolicyAccounting(self.policy.id)
+        pa.make_payment(100, self.ids[2], date(2015, 1, 1))
+        client = app.test_client()
+        url = '/api/policies/' + str(self.policy.id) + '/balances?start=2015-01-01&end=2015-04-15'
+        balances = json.loads(client.get(url).data)['balances']
+        self.assertEquals([row['balance'] for row in balances], ['0.00', '100.00', '200.00', '300.00'])
+
+        url = '/api/policies/' + str(self.policy.id) + '/balances?dates=2015-02-15,2015-01-15'
+        balances = json.loads(client.get(url).data)['balances']
+        self.assertEquals(balances, [{'date': '2015-01-15', 'balance': '0.00'},
+                                     {'date': '2015-02-15', 'balance': '100.00'}])
+
+        response = client.post('/policy/', data={'id': self.policy.id, 'date': '2015-03-01'})
+        self.assertTrue('Balance History' in response.data)
+
+    def test_statement_api_errors(self):
+        client = app.test_client()
+        self.assertEquals(client.get('/api/policies/0/statement').status_code, 404)
+        url = '/api/policies/' + str(self.policy.id) + '/statement?date=March'
+        self.assertEquals(client.get(url).status_code, 400)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        # hooks can't be taken off an app or engine, so these get their own
+        self.app = Flask('instrumented')
+        self.engine = create_engine('sqlite://')
+        self.read_engine = create_engine('sqlite://')
+
+        @self.app.route('/policy/', methods=['POST'])
+        def policy():
+            self.engine.execute('SELECT 1')
+            self.read_engine.execute('SELECT 2')
+            return 'Policy'
+
+        @self.app.route('/maintenance/', methods=['POST'])
+        def maintenance():
+            self.engine.execute('SELECT 1')
+            return 'Maintenance'
+
+        self.instrumentation = Instrumentation()
+        self.instrumentation.install(self.app, self.engine)
+        self.client = self.app.test_client()
+
+    def test_headers_and_stats(self):
+        response = self.client.post('/policy/', data={'id': 3, 'date': '2015-03-01'})
+        self.assertEquals(response.headers['X-SQL-Queries'], '1')
+        self.assertTrue(float(response.headers['X-Request-Time-Ms'])
+                        >= float(response.headers['X-SQL-Time-Ms']))
+
+        stats = json.loads(self.client.get('/_stats').data)
+        self.assertEquals(stats['endpoints']['policy']['requests'], 1)
+        self.assertTrue('p90' in stats['endpoints']['policy']['sql_ms'])
+        self.assertTrue(stats['slowest_statements'])
+        self.assertFalse('_stats' in stats['endpoints'])
+
+    def test_slow_requests_are_profiled(self):
+        profile_dir = tempfile.mkdtemp()
+        self.instrumentation.threshold_ms, self.instrumentation.profile_dir = 0.001, profile_dir
+        try:
+            self.client.post('/maintenance/', data={'id': 3, 'date': '2015-03-01'})
+        finally:
+            self.instrumentation.threshold_ms = 0
+        profiles = os.listdir(profile_dir)
+        shutil.rmtree(profile_dir)
+        self.assertEquals(len(profiles), 1)
+        self.assertTrue(profiles[0].startswith('maintenance-'))
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEquals([percentile(values, p) for p in (50, 90, 99, 100)], [50, 90, 99, 100])
+        self.assertEquals(percentile([7], 50), 7)
+
+    def test_watched_engines_are_counted(self):
+        self.instrumentation.watch(self.read_engine)
+        self.instrumentation.watch(self.read_engine)
+        response = self.client.post('/policy/', data={'id': 3, 'date': '2015-03-01'})
+        self.assertEquals(response.headers['X-SQL-Queries'], '2')
+
+
+class TestBulkInvoicing(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policies = []
+        for schedule in ['Annual', 'Two-Pay', 'Quarterly', 'Monthly']:
+            for effective_date in [date(2015, 1, 1), date(2015, 1, 31)]:
+                policy = Policy('Test Policy', effective_date, 1000)
+                policy.billing_schedule = schedule
+                policy.named_insured = cls.test_insured.id
+                policy.agent = cls.test_agent.id
+                db.session.add(policy)
+                cls.policies.append(policy)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        for policy in cls.policies:
+            db.session.delete(policy)
+        db.session.commit()
+
+    def tearDown(self):
+        for policy in self.policies:
+            LedgerEntry.query.filter_by(policy_id=policy.id).delete()
+            for invoice in policy.invoices:
+                db.session.delete(invoice)
+        db.session.commit()
+
+    def invoice_rows(self, policy):
+        return [(invoice.bill_date, invoice.due_date, invoice.cancel_date,
+                 invoice.amount_due, invoice.deleted)
+                for invoice in Invoice.query.filter_by(policy_id=policy.id)
+                                            .order_by(Invoice.id).all()]
+
+    def test_bulk_invoices_match_make_invoices(self):
+        for policy in self.policies:
+            PolicyAccounting(policy.id)
+        expected = [self.invoice_rows(policy) for policy in self.policies]
+        for policy in self.policies:
+            for invoice in policy.invoices:
+                db.session.delete(invoice)
+        db.session.commit()
+
+        self.assertEquals(make_invoices_bulk(self.policies, chunk_size=3), 38)
+        self.assertEquals([self.invoice_rows(policy) for policy in self.policies], expected)
+
+    def test_bulk_invoices_mark_previous_invoices_deleted(self):
+        make_invoices_bulk(self.policies)
+        make_invoices_bulk(self.policies)
+        for policy in self.policies:
+            rows = self.invoice_rows(policy)
+            required = PolicyAccounting.billing_schedules[policy.billing_schedule]
+            self.assertEquals(len(rows), required * 2)
+            self.assertTrue(all(row[4] for row in rows[:required]))
+            self.assertFalse(any(row[4] for row in rows[required:]))
+
+
+class TestInvoiceScheduleCache(unittest.TestCase):
+
+    def setUp(self):
+        schedule_cache.clear()
+
+    def test_schedule_dates(self):
+        schedule = invoice_schedule('Quarterly', date(2015, 1, 31))
+        self.assertEquals(schedule[1], (date(2015, 4, 30), date(2015, 5, 30), date(2015, 6, 13)))
+        self.assertEquals(len(invoice_schedule('Monthly', date(2015, 1, 1))), 12)
+
+    def test_repeated_schedule_is_a_cache_hit(self):
+        hits = schedule_cache.hits
+        first = invoice_schedule('Monthly', date(2015, 1, 1))
+        self.assertTrue(invoice_schedule('Monthly', date(2015, 1, 1)) is first)
+        self.assertEquals(schedule_cache.hits, hits + 1)
+
+    def test_lru_cache_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.stats(), {'hits': 2, 'misses': 1, 'evictions': 1,
+                                          'size': 2, 'maxsize': 2})
+
+    def test_ttl_cache_expires_entries(self):
+        now = [100]
+        cache = TTLCache(10, 30, clock=lambda: now[0])
+        cache.put('a', 1)
+        now[0] = 129
+        self.assertEquals(cache.get('a'), 1)
+        now[0] = 130
+        self.assertEquals(cache.get('a'), None)
+        stats = cache.stats()
+        self.assertEquals((stats['hits'], stats['misses'], stats['expirations'], stats['size']), (1, 1, 1, 0))
+
+
+class TestLedger(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test Policy', date(2015, 1, 1), 1600)
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        cls.policy.billing_schedule = 'Quarterly'
+        db.session.add(cls.policy)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.delete(cls.policy)
+        db.session.commit()
+
+    def setUp(self):
+        self.policy.billing_schedule = 'Quarterly'
+        self.payments = []
+
+    def tearDown(self):
+        LedgerEntry.query.filter_by(policy_id=self.policy.id).delete()
+        for invoice in self.policy.invoices:
+            db.session.delete(invoice)
+        for payment in self.payments:
+            db.session.delete(payment)
+        db.session.commit()
+
+    def test_backdated_payment_is_carried_forward(self):
+        pa = PolicyAccounting(self.policy.id)
+        self.payments.append(pa.make_payment(400, self.policy.agent, date(2015, 6, 1)))
+        self.payments.append(pa.make_payment(400, self.policy.agent, date(2015, 1, 15)))
+        self.assertEquals(pa.return_account_balance(date(2015, 1, 15)), 0)
+        self.assertEquals(pa.return_account_balance(date(2015, 6, 1)), 0)
+        self.assertEquals(pa.return_account_balance(date(2015, 12, 31)), 800)
+        self.assertEquals(verify_ledger([self.policy.id]), [])
+
+    def test_billing_change_reverses_old_invoices(self):
+        pa = PolicyAccounting(self.policy.id)
+        pa.change_billing_schedule('Monthly')
+        # the four odd cents of 1600 / 12 go on the first four invoices
+        self.assertEquals(pa.return_account_balance(date(2015, 1, 2)), Decimal('133.34'))
+        self.assertEquals(pa.return_account_balance(date(2016, 1, 1)), Decimal('1600.00'))
+        self.assertEquals(verify_ledger([self.policy.id]), [])
+
+    def test_rebuild_ledger(self):
+        pa = PolicyAccounting(self.policy.id)
+        self.payments.append(pa.make_payment(400, self.policy.agent, date(2015, 1, 15)))
+        LedgerEntry.query.filter_by(policy_id=self.policy.id).delete()
+        db.session.commit()
+        self.assertNotEquals(verify_ledger([self.policy.id]), [])
+
+        self.assertEquals(rebuild_ledger([self.policy.id]), 5)
+        self.assertEquals(verify_ledger([self.policy.id]), [])
+        self.assertEquals(pa.return_account_balance(date(2015, 4, 1)), 400)
+
+
+class TestContactResolver(unittest.TestCase):
+
+    def setUp(self):
+        contact_resolver.warm()
+        self.policy_ids = []
+
+    def tearDown(self):
+        for policy_id in self.policy_ids:
+            LedgerEntry.query.filter_by(policy_id=policy_id).delete()
+            Invoice.query.filter_by(policy_id=policy_id).delete()
+            Policy.query.filter_by(id=policy_id).delete()
+        Contact.query.filter(Contact.name.in_(['Resolver Agent', 'Resolver Insured']))\
+                     .delete(synchronize_session=False)
+        db.session.commit()
+
+    def test_existing_contacts_resolve_without_queries(self):
+        queries = contact_resolver.queries
+        self.assertEquals(contact_resolver.find('John Doe', 'Agent'), 1)
+        self.assertEquals(contact_resolver.find('John Doe', 'Named Insured'), 2)
+        self.assertEquals(contact_resolver.get(3).name, 'Bob Smith')
+        self.assertEquals(contact_resolver.queries, queries)
+
+    def test_new_policy_creates_and_indexes_contacts(self):
+        pa = PolicyAccounting.create_new_policy('Resolver Policy', 'Annual', 'Resolver Insured',
+                                                'Resolver Agent', 500, date(2015, 1, 1))
+        self.policy_ids.append(pa.policy.id)
+        queries = contact_resolver.queries
+        self.assertEquals(contact_resolver.find('Resolver Agent', 'Agent'), pa.policy.agent)
+        self.assertEquals(contact_resolver.get(pa.policy.named_insured).name, 'Resolver Insured')
+
+        pa = PolicyAccounting.create_new_policy('Resolver Policy 2', 'Annual', 'Resolver Insured',
+                                                'Resolver Agent', 500, date(2015, 1, 1))
+        self.policy_ids.append(pa.policy.id)
+        self.assertEquals(Contact.query.filter_by(name='Resolver Agent').count(), 1)
+        self.assertEquals(contact_resolver.queries, queries)
+
+    def test_rollback_and_bulk_delete_clear_the_index(self):
+        contact_resolver.create('Resolver Agent', 'Agent')
+        self.assertTrue(contact_resolver.find('Resolver Agent', 'Agent'))
+        db.session.rollback()
+        self.assertFalse(contact_resolver.warmed)
+        self.assertEquals(contact_resolver.find('Resolver Agent', 'Agent'), None)
+
+        contact_resolver.create('Resolver Agent', 'Agent')
+        db.session.commit()
+        Contact.query.filter_by(name='Resolver Agent').delete()
+        self.assertFalse(contact_resolver.warmed)
+
+
+class TestOnboarding(unittest.TestCase):
+
+    def setUp(self):
+        self.policy_ids = []
+
+    def tearDown(self):
+        for policy_id in self.policy_ids:
+            LedgerEntry.query.filter_by(policy_id=policy_id).delete()
+            Invoice.query.filter_by(policy_id=policy_id).delete()
+            Policy.query.filter_by(id=policy_id).delete()
+        Contact.query.filter(Contact.name.in_(['Onboard Agent', 'Onboard Insured', 'Onboard Other']))\
+                     .delete(synchronize_session=False)
+        db.session.commit()
+
+    def rows(self, policy_id):
+        invoices = [(i.bill_date, i.due_date, i.cancel_date, i.amount_due, i.deleted)
+                    for i in Invoice.query.filter_by(policy_id=policy_id).order_by(Invoice.bill_date)]
+        ledger = [(l.entry_date, l.delta, l.running_balance)
+                  for l in LedgerEntry.query.filter_by(policy_id=policy_id).order_by(LedgerEntry.id)]
+        policy = Policy.query.get(policy_id)
+        return (policy.effective_date, policy.status, policy.billing_schedule, policy.annual_premium,
+                policy.named_insured, policy.agent, invoices, ledger)
+
+    def test_same_rows_as_create_new_policy(self):
+        pa = PolicyAccounting.create_new_policy('Onboard Single', 'Monthly', 'Onboard Insured',
+                                                'Onboard Agent', 1000, date(2015, 1, 31))
+        self.policy_ids.append(pa.policy.id)
+
+        specs = [PolicySpec('Onboard Bulk', 'Monthly', 'Onboard Insured', 'Onboard Agent',
+                            1000, date(2015, 1, 31)),
+                 PolicySpec('Onboard Other', 'Two-Pay', 'Onboard Other', 'Onboard Agent',
+                            500, date(2015, 2, 1)),
+                 PolicySpec('Onboard Bad', 'Weekly', 'Onboard Other', 'Onboard Agent',
+                            500, date(2015, 2, 1))]
+        progress = list(onboard_policies(specs, chunk_size=2))
+        self.assertEquals(len(progress), 2)
+        self.assertEquals((progress[-1]['policies'], progress[-1]['invoices']), (2, 14))
+        self.assertEquals([report['rejected'] for report in progress],
+                          [[], [('Onboard Bad', 'Unknown billing schedule')]])
+        self.assertEquals(progress[-1]['rejected_count'], 1)
+
+        bulk = Policy.query.filter_by(policy_number='Onboard Bulk').one()
+        other = Policy.query.filter_by(policy_number='Onboard Other').one()
+        self.policy_ids.extend([bulk.id, other.id])
+        self.assertEquals(self.rows(bulk.id), self.rows(pa.policy.id))
+        self.assertEquals(Contact.query.filter_by(name='Onboard Agent').count(), 1)
+        self.assertEquals(verify_ledger([bulk.id, other.id]), [])
+
+    def test_bad_premiums_and_dates_are_rejected(self):
+        specs = [PolicySpec('Onboard ' + premium, 'Annual', 'Onboard Insured', 'Onboard Agent', premium, '')
+                 for premium in ['0', '-100', 'NaN', 'Infinity', '100.001', 'lots']]
+        specs.append(PolicySpec('Onboard Late', 'Annual', 'Onboard Insured', 'Onboard Agent', '100', '2015-13-01'))
+        specs.append(PolicySpec('Onboard Good', 'Annual', 'Onboard Insured', 'Onboard Agent', '100', '2015-03-01'))
+        progress = list(onboard_policies(specs, chunk_size=3))
+        self.assertEquals(progress[-1]['policies'], 1)
+        self.assertEquals([reason for report in progress for number, reason in report['rejected']],
+                          ['Invalid annual premium'] * 6 + ['Invalid effective date'])
+        self.assertEquals([report['rejected_count'] for report in progress], [3, 6, 7])
+
+        good = Policy.query.filter_by(policy_number='Onboard Good').one()
+        self.policy_ids.append(good.id)
+        self.assertEquals((good.effective_date, good.annual_premium), (date(2015, 3, 1), Decimal('100.00')))
+
+
+class TestAging(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        cls.policy.billing_schedule = 'Monthly'
+        db.session.add(cls.policy)
+        db.session.commit()
+        # the app removes the session after each request, detaching these
+        cls.ids = (cls.policy.id, cls.test_insured.id, cls.test_agent.id)
+
+    @classmethod
+    def tearDownClass(cls):
+        policy_id, insured_id, agent_id = cls.ids
+        Policy.query.filter_by(id=policy_id).delete()
+        Contact.query.filter(Contact.id.in_([insured_id, agent_id])).delete(synchronize_session=False)
+        db.session.commit()
+
+    def setUp(self):
+        self.policy = Policy.query.get(self.ids[0])
+        self.pa = PolicyAccounting(self.policy)
+
+    def tearDown(self):
+        policy_id = self.ids[0]
+        LedgerEntry.query.filter_by(policy_id=policy_id).delete()
+        Invoice.query.filter_by(policy_id=policy_id).delete()
+        Payment.query.filter_by(policy_id=policy_id).delete()
+        db.session.commit()
+
+    def test_payments_apply_to_oldest_invoices(self):
+        self.pa.make_payment(150, self.policy.agent, date(2015, 1, 15))
+        rows = list(iter_aging(date(2015, 4, 15), [self.policy.id]))
+        self.assertEquals(rows, [AgingRow(self.policy.id, Decimal('100.00'), Decimal('100.00'),
+                                          Decimal('50.00'), Decimal('0.00'), Decimal('0.00'),
+                                          Decimal('0.00'), Decimal('250.00'))])
+        self.assertEquals(rows[0].balance, self.pa.return_account_balance(date(2015, 4, 15)))
+
+    def test_overpayment_is_credit(self):
+        self.pa.make_payment(250, self.policy.agent, date(2015, 1, 15))
+        row = list(iter_aging(date(2015, 1, 20), [self.policy.id]))[0]
+        self.assertEquals((row.current, row.credit, row.balance),
+                          (Decimal('0.00'), Decimal('150.00'), Decimal('-150.00')))
+
+    def test_totals_and_route(self):
+        totals = aging_totals(iter_aging(date(2015, 6, 1), [self.policy.id]))
+        self.assertEquals((totals['policies'], totals['days_over_90']), (1, Decimal('200.00')))
+
+        response = app.test_client().get('/reports/aging?date=2015-06-01')
+        lines = response.data.splitlines()
+        self.assertEquals(lines[0].split(',')[1], 'current')
+        self.assertTrue(str(self.policy.id) + ',200.00,0.00,100.00,100.00,200.00,0.00,600.00' in lines)
+
+
+class TestEngine(unittest.TestCase):
+
+    statements = None
+
+    def tearDown(self):
+        db.session.remove()
+
+    def test_pragmas_applied(self):
+        pragma = lambda name: db.engine.execute('PRAGMA ' + name).scalar()
+        self.assertEquals(pragma('journal_mode'), 'wal')
+        self.assertEquals(pragma('synchronous'), 1)
+        self.assertEquals(pragma('busy_timeout'), app.config['SQLITE_BUSY_TIMEOUT_MS'])
+        self.assertEquals(pragma('cache_size'), -app.config['SQLITE_CACHE_SIZE_KB'])
+        self.assertEquals(pragma('query_only'), 0)
+
+    def test_none_keeps_default(self):
+        self.assertEquals(sqlite_pragmas({'SQLITE_JOURNAL_MODE': 'WAL', 'SQLITE_CACHE_SIZE_KB': 1024,
+                                          'SQLITE_SYNCHRONOUS': None}),
+                          ['PRAGMA journal_mode = WAL', 'PRAGMA cache_size = -1024'])
+
+    def test_read_engine_is_query_only(self):
+        engine = read_engine()
+        self.assertFalse(engine is db.engine)
+        self.assertTrue(engine is read_engine())
+        self.assertEquals(engine.execute('PRAGMA query_only').scalar(), 1)
+        self.assertEquals(engine.execute('SELECT count(*) FROM policies').scalar(), Policy.query.count())
+        self.assertRaises(OperationalError, engine.execute, "UPDATE policies SET cancel_reason = 'x'")
+
+    def record_statement(self, conn, cursor, statement, parameters, context, executemany):
+        if self.statements is not None:
+            self.statements.append(statement)
+
+    def test_read_routes_use_read_engine(self):
+        # event.remove doesn't support engines yet, so the listener stays
+        # on the shared read engine and stops recording when the test ends
+        self.statements = []
+        event.listen(read_engine(), 'before_cursor_execute', self.record_statement)
+        try:
+            policy_id = Policy.query.first().id
+            db.session.remove()
+            response = app.test_client().get('/api/policies/' + str(policy_id) + '/balances?dates=2015-06-01')
+            self.assertEquals(response.status_code, 200)
+            self.assertTrue(self.statements)
+        finally:
+            self.statements = None
+
+    def test_without_read_pool(self):
+        pool_size = app.config['READ_POOL_SIZE']
+        app.config['READ_POOL_SIZE'] = 0
+        try:
+            self.assertTrue(read_engine() is db.engine)
+        finally:
+            app.config['READ_POOL_SIZE'] = pool_size
+
+
+class TestExport(unittest.TestCase):
+
+    def tearDown(self):
+        # don't leave the loaded invoices in the session for later requests
+        db.session.remove()
+
+    def export(self, table, format='csv', **kwargs):
+        output = StringIO()
+        report = write_export(table, output, format, batch_size=4, **kwargs)
+        return report, output.getvalue()
+
+    def test_csv_matches_table(self):
+        report, text = self.export('invoices')
+        rows = list(csv.DictReader(StringIO(text)))
+        invoices = Invoice.query.order_by(Invoice.id).all()
+        self.assertEquals(report['rows'], len(invoices))
+        self.assertEquals(report['watermark'], invoices[-1].id)
+        self.assertEquals([(int(row['id']), row['bill_date'], Decimal(row['amount_due']), int(row['deleted']))
+                           for row in rows],
+                          [(invoice.id, str(invoice.bill_date), invoice.amount_due, int(invoice.deleted))
+                           for invoice in invoices])
+
+    def test_ndjson_matches_table(self):
+        report, text = self.export('payments', 'ndjson')
+        rows = [json.loads(line) for line in text.splitlines()]
+        payments = Payment.query.order_by(Payment.id).all()
+        self.assertEquals([(row['id'], row['transaction_date'], row['amount_paid']) for row in rows],
+                          [(payment.id, str(payment.transaction_date), str(payment.amount_paid))
+                           for payment in payments])
+
+    def test_incremental_exports(self):
+        ids = [invoice.id for invoice in Invoice.query.order_by(Invoice.id)]
+        report, text = self.export('invoices', 'ndjson', since_id=ids[-3])
+        self.assertEquals([json.loads(line)['id'] for line in text.splitlines()], ids[-2:])
+        self.assertEquals(report['watermark'], ids[-1])
+
+        report, text = self.export('invoices', 'ndjson', since_id=report['watermark'])
+        self.assertEquals((report['rows'], report['watermark'], text), (0, ids[-1], ''))
+
+        report, text = self.export('invoices', 'ndjson', since_date=date(2015, 11, 1))
+        self.assertEquals([json.loads(line)['id'] for line in text.splitlines()],
+                          [invoice.id for invoice in Invoice.query.filter(Invoice.bill_date >= date(2015, 11, 1))
+                                                                  .order_by(Invoice.id)])
+
+    def test_watermark_passes_unmatched_dates(self):
+        last_id = Invoice.query.order_by(Invoice.id.desc()).first().id
+        report, text = self.export('invoices', 'ndjson', since_date=date(2100, 1, 1))
+        self.assertEquals((report['rows'], report['watermark'], text), (0, last_id, ''))
+
+    def test_until_id_bounds_stream(self):
+        ids = [invoice.id for invoice in Invoice.query.order_by(Invoice.id)]
+        lines = ''.join(iter_export('invoices', 'ndjson', until_id=ids[1])).splitlines()
+        self.assertEquals([json.loads(line)['id'] for line in lines], ids[:2])
+        self.assertRaises(ExportError, export_watermark, 'contacts')
+        self.assertRaises(ExportError, list, iter_export('invoices', 'xml'))
+
+    def test_route(self):
+        client = app.test_client()
+        response = client.get('/api/export/invoices?format=ndjson&since_id=2')
+        watermark = export_watermark('invoices')
+        self.assertEquals(response.headers['X-Export-Watermark'], str(watermark))
+        ids = [json.loads(line)['id'] for line in response.data.splitlines()]
+        self.assertEquals(ids, [invoice.id for invoice in Invoice.query.filter(Invoice.id > 2).order_by(Invoice.id)])
+
+        response = client.get('/api/export/payments')
+        self.assertEquals(response.mimetype, 'text/csv')
+        self.assertEquals(response.data.splitlines()[0], 'id,policy_id,contact_id,amount_paid,transaction_date')
+
+        self.assertEquals(client.get('/api/export/contacts').status_code, 404)
+        self.assertEquals(client.get('/api/export/invoices?format=xml').status_code, 400)
+        self.assertEquals(client.get('/api/export/invoices?since_date=June').status_code, 400)
+        self.assertEquals(client.get('/api/export/invoices?since_id=x').status_code, 400)
+
+
+class TestPaymentImport(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Import Agent', 'Agent')
+        cls.test_insured = Contact('Import Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Import Policy', date(2015, 1, 1), 1200)
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        cls.policy.billing_schedule = 'Monthly'
+        db.session.add(cls.policy)
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.delete(cls.test_insured)
+        db.session.delete(cls.test_agent)
+        db.session.delete(cls.policy)
+        db.session.commit()
+
+    def setUp(self):
+        PolicyAccounting(self.policy.id)
+        handle, self.path = tempfile.mkstemp(suffix='.csv')
+        os.close(handle)
+        self.rejects_path = self.path + '.rejects'
+
+    def tearDown(self):
+        LedgerEntry.query.filter_by(policy_id=self.policy.id).delete()
+        Payment.query.filter_by(policy_id=self.policy.id).delete()
+        for invoice in self.policy.invoices:
+            db.session.delete(invoice)
+        db.session.commit()
+        os.remove(self.path)
+        if os.path.exists(self.rejects_path):
+            os.remove(self.rejects_path)
+
+    def write_rows(self, rows):
+        with open(self.path, 'wb') as source:
+            writer = csv.writer(source)
+            writer.writerow(['policy_number', 'payer', 'amount', 'date'])
+            writer.writerows(rows)
+
+    def test_import_applies_make_payment_rules(self):
+        self.write_rows([['Import Policy', 'import insured', '100', '2015-01-15'],
+                         ['Import Policy', 'Import Agent', '100', '2015-02-10'],
+                         ['No Such Policy', 'Import Agent', '100', '2015-02-10'],
+                         ['Import Policy', 'Import Agent', 'ten', '2015-02-10'],
+                         ['Import Policy', 'Import Insured', '100', '2015-03-05'],
+                         ['Import Policy', 'Import Agent', '100', '2015-03-05']])
+        report = import_payments(self.path, self.rejects_path, chunk_size=4)
+
+        self.assertEquals((report['rows'], report['accepted'], report['rejected']), (6, 3, 3))
+        with open(self.rejects_path, 'rb') as rejects:
+            rejected = list(csv.DictReader(rejects))
+        self.assertEquals([row['line'] for row in rejected], ['4', '5', '6'])
+        self.assertEquals(rejected[2]['reason'], 'Cancellation pending, payment must come from the agent')
+
+        pa = PolicyAccounting(self.policy.id)
+        self.assertEquals(pa.return_account_balance(date(2015, 3, 5)), 0)
+        self.assertEquals(verify_ledger([self.policy.id]), [])
+        payers = [payment.contact_id for payment in
+                  Payment.query.filter_by(policy_id=self.policy.id).order_by(Payment.id)]
+        self.assertEquals(payers, [self.test_insured.id, self.test_agent.id, self.test_agent.id])
+
+    def test_unknown_payer_is_rejected(self):
+        self.write_rows([['Import Policy', 'Nobody At All', '100', '2015-01-15']])
+        report = import_payments(self.path)
+        self.assertEquals(report['reasons'], {'Unknown payer': 1})
+        self.assertEquals(Payment.query.filter_by(policy_id=self.policy.id).count(), 0)
+
+    def test_unusable_amounts_are_rejected(self):
+        self.write_rows([['Import Policy', 'Import Agent', amount, '2015-01-15']
+                         for amount in ['NaN', 'Infinity', '-5', '0', '0.001', '12.345']]
+                        + [['Import Policy', 'Import Agent', '10.50', '2015-01-15']])
+        report = import_payments(self.path, chunk_size=2)
+        self.assertEquals((report['accepted'], report['reasons']), (1, {'Invalid amount': 6}))
+        self.assertEquals([payment.amount_paid for payment in Payment.query.filter_by(policy_id=self.policy.id)],
+                          [Decimal('10.50')])
+
+    def test_missing_payer_column_rejects_rows(self):
+        with open(self.path, 'wb') as source:
+            writer = csv.writer(source)
+            writer.writerow(['policy_number', 'amount', 'date'])
+            writer.writerow(['Import Policy', '100', '2015-01-15'])
+        report = import_payments(self.path)
+        self.assertEquals((report['accepted'], report['reasons']), (0, {'Unknown payer': 1}))
+
+
+class TestInvoiceArchive(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_agent = Contact('Test Agent', 'Agent')
+        cls.test_insured = Contact('Test Insured', 'Named Insured')
+        db.session.add(cls.test_agent)
+        db.session.add(cls.test_insured)
+        db.session.commit()
+
+        cls.policy = Policy('Test Policy', date(2015, 1, 1), 1200)
+        cls.policy.named_insured = cls.test_insured.id
+        cls.policy.agent = cls.test_agent.id
+        cls.policy.billing_schedule = 'Quarterly'
+        db.session.add(cls.policy)
+        db.session.commit()
+        # the app removes the session after each request, detaching these
+        cls.ids = (cls.policy.id, cls.test_insured.id, cls.test_agent.id)
+
+    @classmethod
+    def tearDownClass(cls):
+        policy_id, insured_id, agent_id = cls.ids
+        Policy.query.filter_by(id=policy_id).delete()
+        Contact.query.filter(Contact.id.in_([insured_id, agent_id])).delete(synchronize_session=False)
+        db.session.commit()
+
+    def setUp(self):
+        statement_cache.clear()
+        self.policy = Policy.query.get(self.ids[0])
+        self.policy.billing_schedule = 'Quarterly'
+        PolicyAccounting(self.policy).change_billing_schedule('Monthly')
+
+    def tearDown(self):
+        policy_id = self.ids[0]
+        LedgerEntry.query.filter_by(policy_id=policy_id).delete()
+        Invoice.query.filter_by(policy_id=policy_id).delete()
+        ArchivedInvoice.query.filter_by(policy_id=policy_id).delete()
+        db.session.commit()
+
+    def test_compaction_moves_deleted_invoices(self):
+        policy_id = self.policy.id
+        balance = PolicyAccounting(policy_id).return_account_balance(date(2015, 6, 2))
+        report = compact_invoices(batch_size=3, samples=5)
+
+        self.assertEquals(report['after']['deleted'], 0)
+        self.assertTrue(report['archived'] >= 4)
+        self.assertEquals(report['after']['archived'] - report['before']['archived'], report['archived'])
+        self.assertEquals(Invoice.query.filter_by(policy_id=policy_id).count(), 12)
+        self.assertEquals(sorted(invoice.bill_date.month for invoice
+                                 in ArchivedInvoice.query.filter_by(policy_id=policy_id)), [1, 4, 7, 10])
+        self.assertEquals(PolicyAccounting(policy_id).return_account_balance(date(2015, 6, 2)), balance)
+        self.assertEquals(compact_invoices(samples=5)['archived'], 0)
+
+    def test_statement_reads_archived_invoices(self):
+        before = load_statement(self.policy.id, date(2015, 12, 31))['deleted_invoices']
+        compact_invoices(samples=5)
+        after = load_statement(self.policy.id, date(2015, 12, 31))['deleted_invoices']
+        self.assertEquals(len(after), 4)
+        self.assertEquals(after, before)
+
+        response = app.test_client().post('/policy/', data={'id': self.ids[0], 'date': '2015-12-31'})
+        self.assertTrue('Previous Invoices' in response.data)
+
+
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        db.metadata.create_all(bind=self.engine)
+        drop_indexes(self.engine)
+
+    def index_names(self):
+        return set(row[0] for row in self.engine.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"))
+
+    def test_migrate_adds_indexes_once(self):
+        self.assertEquals(self.index_names(), set())
+        self.assertEquals(migrate(self.engine), ['add_indexes', 'add_invoice_archive', 'convert_money_to_cents',
+                                                 'fill_ledger'])
+        self.assertTrue('ix_invoices_policy_id_deleted_bill_date' in self.index_names())
+        self.assertTrue('ix_payments_policy_id_transaction_date' in self.index_names())
+        self.assertEquals(schema_version(self.engine), len(MIGRATIONS))
+        self.assertEquals(migrate(self.engine), [])
+
+    def test_balance_query_uses_covering_index(self):
+        migrate(self.engine)
+        plan = ' '.join(row['detail'] for row in self.engine.execute(
+            'EXPLAIN QUERY PLAN SELECT amount_due FROM invoices '
+            'WHERE policy_id = 1 AND deleted = 0 AND bill_date <= ?', '2015-01-01'))
+        self.assertTrue('COVERING INDEX ix_invoices_policy_id_deleted_bill_date' in plan)
+
+    def test_money_converted_to_cents(self):
+        self.engine.execute("INSERT INTO invoices (policy_id, bill_date, due_date, cancel_date, amount_due) "
+                            "VALUES (1, '2015-01-01', '2015-02-01', '2015-02-15', 133.3333333333)")
+        self.engine.execute("INSERT INTO payments (policy_id, contact_id, amount_paid, transaction_date) "
+                            "VALUES (1, 1, 100.005, '2015-01-15')")
+        self.engine.execute("INSERT INTO ledger (policy_id, entry_date, delta, running_balance) "
+                            "VALUES (1, '2015-01-01', 133.3333333333, 133.3333333333), "
+                            "(1, '2015-01-15', -100.005, 33.3283333333)")
+        convert_money_to_cents(self.engine)
+        self.assertEquals(self.engine.execute('SELECT amount_due FROM invoices').scalar(), 13333)
+        self.assertEquals(self.engine.execute('SELECT amount_paid FROM payments').scalar(), 10001)
+        self.assertEquals(self.engine.execute('SELECT delta, running_balance FROM ledger ORDER BY id').fetchall(),
+                          [(13333, 13333), (-10001, 3332)])
+
+    def test_converted_installments_add_up_to_the_premium(self):
+        for month in range(1, 13):
+            self.engine.execute("INSERT INTO invoices (policy_id, bill_date, due_date, cancel_date, amount_due) "
+                                "VALUES (1, ?, ?, ?, ?)", date(2015, month, 1),
+                                date(2015, month, 1) + relativedelta(months=1),
+                                date(2015, month, 15) + relativedelta(months=1), 1600 / 12.0)
+        convert_money_to_cents(self.engine)
+        self.assertEquals([row[0] for row in self.engine.execute(
+            'SELECT amount_due FROM invoices ORDER BY bill_date')], [13334] * 4 + [13333] * 8)
+
+    def test_migrated_ledger_has_balances(self):
+        # a pre-ledger database: dollar amounts and an empty ledger
+        self.engine.execute('PRAGMA user_version = 0')
+        for month in range(1, 13):
+            self.engine.execute("INSERT INTO invoices (policy_id, bill_date, due_date, cancel_date, amount_due) "
+                                "VALUES (1, ?, ?, ?, 100)", date(2015, month, 1),
+                                date(2015, month, 1) + relativedelta(months=1),
+                                date(2015, month, 15) + relativedelta(months=1))
+        self.engine.execute("INSERT INTO invoices (policy_id, bill_date, due_date, cancel_date, amount_due, deleted) "
+                            "VALUES (1, '2015-01-01', '2015-02-01', '2015-02-15', 1200, 1)")
+        self.engine.execute("INSERT INTO invoices (policy_id, bill_date, due_date, cancel_date, amount_due) "
+                            "VALUES (2, '2015-02-01', '2015-03-01', '2015-03-15', 365.5)")
+        self.engine.execute("INSERT INTO payments (policy_id, contact_id, amount_paid, transaction_date) "
+                            "VALUES (1, 1, 150.25, '2015-01-01'), (2, 1, 365.5, '2015-02-01')")
+        migrate(self.engine)
+
+        def balance(policy_id, date_cursor):
+            return self.engine.execute('SELECT running_balance FROM ledger WHERE policy_id = ? '
+                                       'AND entry_date <= ? ORDER BY entry_date DESC, id DESC LIMIT 1',
+                                       policy_id, date_cursor).scalar()
+        self.assertEquals(balance(1, date(2015, 1, 1)), -5025)
+        self.assertEquals(balance(1, date(2016, 1, 1)), 104975)
+        self.assertEquals(balance(2, date(2015, 2, 1)), 0)
+        self.assertEquals(self.engine.execute('SELECT count(*) FROM ledger').scalar(), 15)
+
+
+class TestMoney(unittest.TestCase):
+
+    def test_to_cents_rounds_half_away_from_zero(self):
+        self.assertEquals(to_cents(365), 36500)
+        self.assertEquals(to_cents(Decimal('133.335')), 13334)
+        self.assertEquals(to_cents(Decimal('-133.335')), -13334)
+        self.assertEquals(to_cents(0.1), 10)
+        self.assertEquals(to_cents('19.99'), 1999)
+
+    def test_from_cents_has_two_places(self):
+        self.assertEquals(str(from_cents(36500)), '365.00')
+        self.assertEquals(str(from_cents(-5)), '-0.05')
+
+    def test_split_cents_adds_up(self):
+        self.assertEquals(split_cents(160000, 12), [13334] * 4 + [13333] * 8)
+        self.assertEquals(sum(split_cents(99999, 12)), 99999)
+
+    def test_column_round_trip(self):
+        policy = Policy('Money Policy', date(2015, 1, 1), Decimal('1000.5'))
+        db.session.add(policy)
+        db.session.commit()
+        try:
+            db.session.expire(policy)
+            self.assertEquals(str(policy.annual_premium), '1000.50')
+        finally:
+            Policy.query.filter_by(id=policy.id).delete()
+            db.session.commit()
+
+    def test_column_refuses_fractions_of_a_cent(self):
+        db.session.add(Policy('Money Policy', date(2015, 1, 1), Decimal('1000.005')))
+        try:
+            self.assertRaises(StatementError, db.session.commit)
+        finally:
+            db.session.rollback()
+
+
+class TestAnalytics(unittest.TestCase):
+
+    dates = [date(2014, 3, 1), date(2014, 11, 17), date(2015, 6, 2), date(2016, 1, 1)]
+
+    @classmethod
+    def setUpClass(cls):
+        if numpy is None:
+            raise unittest.SkipTest('NumPy is not installed')
+        # PolicyAccounting reads through the app's session, so the app is
+        # pointed at a generated book for the length of these tests
+        cls.directory = tempfile.mkdtemp()
+        cls.database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+        db.session.remove()
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(cls.directory, 'book.sqlite')
+        reset_database()
+        generate_book(20, 200, 0)
+        contact_resolver.clear()
+        statement_cache.clear()
+        cls.arrays = load_portfolio_arrays()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.remove()
+        app.config['SQLALCHEMY_DATABASE_URI'] = cls.database_uri
+        contact_resolver.clear()
+        statement_cache.clear()
+        shutil.rmtree(cls.directory)
+
+    def test_matches_policy_accounting(self):
+        for date_cursor in self.dates:
+            self.assertEquals(cross_check(date_cursor, arrays=self.arrays), [])
+
+    def test_fixture_covers_every_outcome(self):
+        results = analyze(date(2015, 6, 2), self.arrays)
+        self.assertEquals(len(results['policy_id']), 200)
+        self.assertTrue(results['should_cancel'].any())
+        self.assertTrue(results['pending'].any())
+        self.assertTrue((results['balance'] == 0).any())
+        self.assertTrue((results['balance'] > 0).any())
+
+    def test_aging_matches_report(self):
+        for date_cursor in self.dates:
+            aging = analyze(date_cursor, self.arrays)['aging']
+            expected = dict((row.policy_id, [to_cents(amount) for amount in row[1:-1]])
+                            for row in iter_aging(date_cursor, include_settled=True))
+            for i, policy_id in enumerate(self.arrays.policy_ids.tolist()):
+                self.assertEquals(aging[i].tolist(), expected[policy_id])
+
+
+class TestSnapshot(unittest.TestCase):
+
+    dates = [date(2015, 1, 1), date(2015, 2, 20), date(2015, 4, 1), date(2015, 8, 1), date(2016, 1, 1)]
+
+    def test_matches_policy_accounting(self):
+        snapshots = load_snapshot()
+        self.assertEquals(sorted(snapshots), [policy.id for policy in Policy.query.order_by(Policy.id)])
+        for policy_id, snapshot in snapshots.iteritems():
+            pa = PolicyAccounting(policy_id, read_only=True)
+            for date_cursor in self.dates:
+                self.assertEquals(snapshot.return_account_balance(date_cursor),
+                                  pa.return_account_balance(date_cursor))
+                self.assertEquals(snapshot.evaluate_cancellation_pending_due_to_non_pay(date_cursor),
+                                  pa.evaluate_cancellation_pending_due_to_non_pay(date_cursor))
+                cancel = snapshot.evaluate_cancel(date_cursor)
+                expected = pa.evaluate_cancel(date_cursor)
+                self.assertEquals(cancel.should_cancel, expected.should_cancel)
+                self.assertEquals(cancel.invoice and cancel.invoice.id, expected.invoice and expected.invoice.id)
+
+    def test_only_current_invoices(self):
+        for policy_id, snapshot in load_snapshot().iteritems():
+            self.assertEquals([invoice.id for invoice in snapshot.invoices],
+                              [invoice.id for invoice in Invoice.query.filter_by(policy_id=policy_id,
+                                                                                 deleted=False)
+                                                                      .order_by(Invoice.bill_date, Invoice.id)])
+
+    def test_loads_given_policies(self):
+        policy_ids = [policy.id for policy in Policy.query.order_by(Policy.id)][:2]
+        self.assertEquals(sorted(load_snapshot(policy_ids + policy_ids)), policy_ids)
+
+    def test_records_share_values(self):
+        snapshots = load_snapshot()
+        invoices = [invoice for snapshot in snapshots.itervalues() for invoice in snapshot.invoices]
+        self.assertFalse(hasattr(invoices[0], '__dict__'))
+        self.assertTrue(isinstance(invoices[0], InvoiceRecord))
+        for first in invoices:
+            for second in invoices:
+                if first.due_date == second.due_date:
+                    self.assertTrue(first.due_date is second.due_date)
+
+
+class TestGenerator(unittest.TestCase):
+
+    def build(self, seed):
+        engine = create_engine('sqlite://')
+        reset_database(engine)
+        counts = generate_book(20, 200, seed, bind=engine)
+        return engine, counts
+
+    def test_same_seed_same_book(self):
+        first, first_counts = self.build(3)
+        second, second_counts = self.build(3)
+        self.assertEquals(first_counts, second_counts)
+        for table in ('policies', 'invoices', 'payments'):
+            sql = 'SELECT * FROM ' + table + ' ORDER BY id'
+            self.assertEquals(first.execute(sql).fetchall(), second.execute(sql).fetchall())
+
+    def test_book_shape(self):
+        engine, counts = self.build(0)
+        self.assertEquals(counts['policies'], 200)
+        schedules = set(row[0] for row in engine.execute('SELECT DISTINCT billing_schedule FROM policies'))
+        self.assertEquals(schedules, set(PolicyAccounting.billing_schedules))
+        self.assertTrue(engine.execute('SELECT count(*) FROM invoices WHERE deleted = 1').scalar() > 0)
+        agent_paid = engine.execute('SELECT count(*) FROM payments JOIN policies '
+                                    'ON payments.policy_id = policies.id '
+                                    'WHERE payments.contact_id = policies.agent').scalar()
+        self.assertTrue(0 < agent_paid < counts['payments'])
+
+    def test_ledger_matches_invoices_and_payments(self):
+        engine, counts = self.build(0)
+        cents = Decimal('.01')
+        billed = dict(engine.execute('SELECT policy_id, sum(amount_due) FROM invoices '
+                                     'WHERE deleted = 0 GROUP BY policy_id').fetchall())
+        paid = dict(engine.execute('SELECT policy_id, sum(amount_paid) FROM payments '
+                                   'GROUP BY policy_id').fetchall())
+        closing = engine.execute('SELECT policy_id, running_balance FROM ledger l WHERE id = '
+                                 '(SELECT max(id) FROM ledger WHERE policy_id = l.policy_id)').fetchall()
+        self.assertEquals(len(closing), counts['policies'])
+        for policy_id, running in closing:
+            expected = Decimal(str(billed[policy_id] - paid.get(policy_id, 0)))
+            self.assertEquals(Decimal(str(running)).quantize(cents), expected.quantize(cents))
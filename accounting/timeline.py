@@ -0,0 +1,109 @@
+#!/user/bin/env python2.7
+
+from bisect import bisect_right
+from collections import namedtuple
+from dateutil.relativedelta import relativedelta
+from operator import itemgetter
+
+from money import ZERO
+
+"""
+#######################################################
+In-memory balance calculations for a policy whose
+invoices and payments have already been loaded.
+#######################################################
+"""
+
+CancellationResult = namedtuple('CancellationResult', ['should_cancel', 'invoice', 'balance'])
+
+
+class BalanceTimeline(object):
+
+    """
+     A date-sorted ledger of one policy's invoices (added on their bill
+     date) and payments (subtracted on their transaction date). Each
+     balance lookup is a binary search over the running totals.
+    """
+    def __init__(self, invoices, payments):
+        """
+         Takes the policy's non-deleted invoices and its payments, either
+         as ORM objects or as rows from a core select.
+        """
+        entries = [(invoice.bill_date, invoice.amount_due) for invoice in invoices]
+        entries.extend((payment.transaction_date, -payment.amount_paid) for payment in payments)
+        entries.sort(key=itemgetter(0))
+
+        self.dates = []
+        self.balances = []
+        running = ZERO
+        for entry_date, amount in entries:
+            running += amount
+            if self.dates and self.dates[-1] == entry_date:
+                self.balances[-1] = running
+            else:
+                self.dates.append(entry_date)
+                self.balances.append(running)
+
+    def balance_at(self, date_cursor):
+        """
+         Returns the account balance on the given date. Amounts are read
+         back from Money columns in whole cents, so the sums need no
+         rounding.
+        """
+        index = bisect_right(self.dates, date_cursor)
+        if not index:
+            return ZERO
+        return self.balances[index - 1]
+
+    def balances_at(self, date_cursors):
+        """
+         Returns the balance on each of the given dates, in order.
+        """
+        return [self.balance_at(date_cursor) for date_cursor in date_cursors]
+
+
+def monthly_dates(start_date, end_date):
+    """
+     Returns start_date and the same day of each following month up to
+     and including end_date.
+    """
+    dates = []
+    months = 0
+    while start_date + relativedelta(months=months) <= end_date:
+        dates.append(start_date + relativedelta(months=months))
+        months += 1
+    return dates
+
+
+def evaluate_cancel_from_rows(invoices, payments, date_cursor):
+    """
+     Walks the ledger built from the given rows and returns a
+     CancellationResult for the first invoice whose cancel date has
+     passed with a balance still due. If there is none, should_cancel
+     is False and balance is the balance on date_cursor.
+    """
+    timeline = BalanceTimeline(invoices, payments)
+    past_cancel = [invoice for invoice in invoices if invoice.cancel_date <= date_cursor]
+    past_cancel.sort(key=lambda invoice: invoice.bill_date)
+
+    for invoice in past_cancel:
+        balance = timeline.balance_at(invoice.cancel_date)
+        if balance:
+            return CancellationResult(True, invoice, balance)
+
+    return CancellationResult(False, None, timeline.balance_at(date_cursor))
+
+
+def evaluate_pending_from_rows(invoices, payments, date_cursor):
+    """
+     Returns True if an invoice has passed its due date but not yet its
+     cancel date on date_cursor while a balance is still due. Matches
+     PolicyAccounting.evaluate_cancellation_pending_due_to_non_pay.
+    """
+    for invoice in invoices:
+        if invoice.due_date < date_cursor < invoice.cancel_date:
+            break
+    else:
+        return False
+
+    return bool(BalanceTimeline(invoices, payments).balance_at(date_cursor))
@@ -1,12 +1,18 @@
 #!/user/bin/env python2.7
 
 from datetime import date, datetime
-from decimal import Decimal, ROUND_05UP
-from dateutil.relativedelta import relativedelta
-from sqlalchemy import and_
+from decimal import InvalidOperation
+from sqlalchemy import and_, select
 
 from accounting import db
+from contacts import contact_resolver
+from ledger import ledger_balance, rebuild_ledger, record_entries
+from migrations import stamp_schema_version
 from models import Contact, Invoice, Payment, Policy
+from money import from_cents, is_whole_cents, split_cents, to_cents, to_dollars
+from schedules import billing_schedules, cancel_offset, due_offset, invoice_schedule
+from statements import statement_cache
+from timeline import BalanceTimeline, evaluate_cancel_from_rows
 
 import logging
 logging.basicConfig(level=logging.WARNING)
@@ -23,21 +29,34 @@ If you have any questions, please contact Amanda at:
 
 class PolicyAccounting(object):
 
-    billing_schedules = {'Annual': 1, 'Two-Pay': 2, 'Quarterly': 4, 'Monthly': 12}
+    billing_schedules = billing_schedules
 
     """
      Each policy has its own instance of accounting.
     """
-    def __init__(self, policy_id):
+    def __init__(self, policy_id, read_only=False):
         """
-         Creates a new object tied to a specific policy id. Checks if any
-         invoices have been created and initializes them if necessary. Also
-         allows the user to create a new policy from the console if they
-         attempted to use a policy ID that didn't exist.
+         Creates a new object tied to a specific policy id, or to an
+         already-loaded Policy. Checks if any invoices have been created
+         and initializes them if necessary. Also allows the user to create
+         a new policy from the console if they attempted to use a policy
+         ID that didn't exist.
+
+         With read_only=True this does at most one primary-key lookup and
+         never prompts or writes; self.policy is None if it wasn't found.
         """
-        self.policy = Policy.query.filter_by(id=policy_id)
+        self.read_only = read_only
+        if isinstance(policy_id, Policy):
+            self.policy = policy_id
+        else:
+            self.policy = Policy.query.get(policy_id)
+
+        if read_only:
+            if not self.policy:
+                logging.warning('Policy ' + str(policy_id) + ' not found.')
+            return
 
-        if self.policy.count() == 0:
+        if not self.policy:
             raw = raw_input('Policy not found, do you want to'
                             + 'create a new policy? (yes/no): ')
             answer = raw.lower().strip()
@@ -48,11 +67,6 @@ class PolicyAccounting(object):
                                                                  details['premium'], details['eff_date'])
             else:
                 return
-        elif self.policy.count() > 1:
-            logging.warning('Found more than 1 policy with that ID, exiting.')
-            return
-        else:
-            self.policy = self.policy.first()
 
         if not self.policy.invoices:
             logging.info('No invoices found for policy ' + str(policy_id))
@@ -72,37 +86,8 @@ class PolicyAccounting(object):
         new_policy = Policy(policy_number, effective_date, annual_premium)
         new_policy.billing_schedule = billing_type
 
-        agent_query = Contact.query.filter_by(name=agent_name)\
-                                   .filter(Contact.role == 'Agent')
-        if agent_query.count() == 0:
-            logging.info('Given agent name not found, adding new agent to db.')
-            agent = Contact(agent_name, 'Agent')
-            db.session.add(agent)
-            db.session.commit()
-        elif agent_query.count() > 1:
-            logging.info('Found more than 1 agent with the '
-                         + 'same name, picking the first.')
-            agent = agent_query.first()
-        else:
-            agent = agent_query.first()
-
-        new_policy.agent = agent.id
-
-        insured_query = Contact.query.filter_by(name=named_insured)\
-                                     .filter(Contact.role == 'Named Insured')
-        if insured_query.count() == 0:
-            logging.info('Given named-insured was not found, adding to db.')
-            insured = Contact(named_insured, 'Named Insured')
-            db.session.add(insured)
-            db.session.commit()
-        elif insured_query.count() > 1:
-            logging.info('Found more than 1 insured with the '
-                         + 'same name, picking the first.')
-            insured = insured_query.first()
-        else:
-            insured = insured_query.first()
-
-        new_policy.named_insured = insured.id
+        new_policy.agent = contact_resolver.get_or_create(agent_name, 'Agent')
+        new_policy.named_insured = contact_resolver.get_or_create(named_insured, 'Named Insured')
         db.session.add(new_policy)
         db.session.commit()
 
@@ -127,13 +112,19 @@ class PolicyAccounting(object):
         self.policy.cancel_reason = reason
         self.policy.status = 'Canceled'
         db.session.commit()
+        statement_cache.invalidate(self.policy.id)
         print "This policy has been canceled."
+        return True
 
-    def change_billing_schedule(self, new_billing_schedule):
+    def change_billing_schedule(self, new_billing_schedule, change_date=None):
         """
          This marks all current invoices as deleted and recreates a
          new set using the specified billing schedule. Starts the
          new invoices at the policy effective date.
+
+         Given a change_date, only the invoices billed after it are
+         replaced, and the premium they haven't billed yet is spread over
+         the rest of the new schedule. See reschedule_invoices.
         """
         if self.policy.status in ['Canceled', 'Expired']:
             print "Unable to change billing schedule while policy is inactive."
@@ -145,7 +136,10 @@ class PolicyAccounting(object):
             print "This policy is already on " + new_billing_schedule + " billing."
         else:
             self.policy.billing_schedule = new_billing_schedule
-            self.make_invoices()
+            if change_date:
+                self.reschedule_invoices(change_date)
+            else:
+                self.make_invoices()
             print "Billing updated, you now have an outstanding balance of $" + str(self.return_account_balance())
 
     def get_policy_details_from_console(self):
@@ -185,39 +179,50 @@ class PolicyAccounting(object):
     def return_account_balance(self, date_cursor=None):
         """
          Returns the remaining account balance on a specified date. Defaults
-         to today's date if nothing is specified.
+         to today's date if nothing is specified. Reads the latest ledger
+         row on or before that date.
         """
-        cents = Decimal('.01')
         if not date_cursor:
             date_cursor = datetime.now().date()
 
         logging.debug("Finding balance for " + str(date_cursor))
+        balance = ledger_balance(self.policy.id, date_cursor)
+        logging.info('Account balance: ' + str(balance))
+        return balance
+
+    def return_account_balances(self, date_cursors):
+        """
+         Returns a list of (date, balance) for each of the given dates.
+         Loads the invoices and payments once and answers every date from
+         the same running totals, rounded like return_account_balance.
+        """
+        date_cursors = sorted(date_cursors)
+        if not date_cursors:
+            return []
+
         invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-                                .filter(and_(Invoice.bill_date <= date_cursor, Invoice.deleted == 0))\
-                                .order_by(Invoice.bill_date)\
+                                .filter(and_(Invoice.bill_date <= date_cursors[-1],
+                                             Invoice.deleted == 0))\
                                 .all()
-        due_now = Decimal(0)
-        for invoice in invoices:
-            due_now += invoice.amount_due
-
-        logging.debug('Total due, not counting payments: $' + str(due_now.quantize(cents, ROUND_05UP)))
         payments = Payment.query.filter_by(policy_id=self.policy.id)\
-                                .filter(Payment.transaction_date <= date_cursor)\
+                                .filter(Payment.transaction_date <= date_cursors[-1])\
                                 .all()
-
-        for payment in payments:
-            logging.debug('Payment found - $'
-                          + str(Decimal(payment.amount_paid).quantize(cents, ROUND_05UP)))
-            due_now -= payment.amount_paid
-
-        logging.info('Account balance: ' + str(due_now.quantize(cents, ROUND_05UP)))
-        return due_now.quantize(cents, ROUND_05UP)
+        timeline = BalanceTimeline(invoices, payments)
+        logging.debug('Finding balances for ' + str(len(date_cursors)) + ' dates')
+        return zip(date_cursors, timeline.balances_at(date_cursors))
 
     def make_payment(self, amount=0, contact_id=None, date_cursor=None):
         """
          Adds a new payment to the account with the given information.
         """
-        amount = Decimal(amount)
+        try:
+            whole_cents = is_whole_cents(to_dollars(amount))
+        except InvalidOperation:
+            whole_cents = False
+        if not whole_cents:
+            logging.debug("Payment amount " + str(amount) + " is not a whole number of cents. Exiting.")
+            return False
+        amount = from_cents(to_cents(amount))
         if not date_cursor:
             date_cursor = datetime.now().date()
         logging.debug('Making payment for date ' + str(date_cursor))
@@ -234,7 +239,10 @@ class PolicyAccounting(object):
                 logging.debug("No contact_id, named-insured, or agent could be found. Exiting.")
                 return
 
-        contact = Contact.query.filter_by(id=contact_id).one()
+        contact = contact_resolver.get(contact_id)
+        if not contact:
+            logging.debug("Contact " + str(contact_id) + " not found. Exiting.")
+            return False
         if contact.role != 'Agent' and self.evaluate_cancellation_pending_due_to_non_pay(date_cursor):
             print "Cancellation pending, please contact your agent to make a payment."
             return False
@@ -245,7 +253,9 @@ class PolicyAccounting(object):
                           date_cursor)
         logging.debug("Payment created, adding to db.")
         db.session.add(payment)
+        record_entries(self.policy.id, [(date_cursor, -amount)])
         db.session.commit()
+        statement_cache.invalidate(self.policy.id)
         logging.debug("Payment committed.")
 
         return payment
@@ -260,21 +270,18 @@ class PolicyAccounting(object):
             return False
 
         logging.info('Updating named-insured for policy id ' + str(self.policy.id))
-        contact_query = Contact.query.filter_by(name=new_insured)\
-                                     .filter(Contact.role == 'Named Insured')
-        if contact_query.count() == 0:
+        insured_id = contact_resolver.find(new_insured, 'Named Insured')
+        if insured_id is None:
             logging.info('No current contact with this name, '
                          + 'creating new contact.')
-            insured = Contact(new_insured.title(), 'Named Insured')
-            db.session.add(insured)
-            db.session.commit()
+            insured_id = contact_resolver.create(new_insured.title(), 'Named Insured')
         else:
             logging.info('Named-insured already in the system, '
                          + 'keeping existing id.')
-            insured = contact_query.first()
 
-        self.policy.named_insured = insured.id
+        self.policy.named_insured = insured_id
         db.session.commit()
+        statement_cache.invalidate(self.policy.id)
         return self.policy.named_insured
 
     def evaluate_cancellation_pending_due_to_non_pay(self, date_cursor=None):
@@ -305,63 +312,122 @@ class PolicyAccounting(object):
     def evaluate_cancel(self, date_cursor=None):
         """
          Determines whether the policy should have been cancelled on the
-         given date(or today, if the date was not given).
+         given date(or today, if the date was not given). Loads the
+         invoices and payments once and returns a CancellationResult
+         with the invoice that triggered the cancellation, if any.
         """
         if not date_cursor:
             logging.debug("No date passed, evaluating at the current date.")
             date_cursor = datetime.now().date()
 
-        logging.debug("Querying invoices...")
+        logging.debug("Querying invoices and payments...")
         invoices = Invoice.query.filter_by(policy_id=self.policy.id)\
-                                .filter(and_(Invoice.cancel_date <= date_cursor,
+                                .filter(and_(Invoice.bill_date <= date_cursor,
                                              Invoice.deleted == 0))\
                                 .order_by(Invoice.bill_date)\
                                 .all()
-        logging.debug(str(len(invoices)) + " invoices found...")
+        payments = Payment.query.filter_by(policy_id=self.policy.id)\
+                                .filter(Payment.transaction_date <= date_cursor)\
+                                .all()
+        logging.debug(str(len(invoices)) + " invoices and " + str(len(payments)) + " payments found...")
 
-        for invoice in invoices:
-            if not self.return_account_balance(invoice.cancel_date):
-                logging.debug("Balance on invoice cancel date: "
-                              + str(self.return_account_balance(invoice.cancel_date)))
-                continue
-            else:
-                print "THIS POLICY SHOULD HAVE CANCELED"
-                break
+        result = evaluate_cancel_from_rows(invoices, payments, date_cursor)
+        if result.should_cancel:
+            logging.info('Policy should have canceled on ' + str(result.invoice.cancel_date)
+                         + ' with a balance of $' + str(result.balance))
         else:
-            print "THIS POLICY SHOULD NOT CANCEL"
+            logging.info('Policy should not cancel.')
+        return result
 
     def make_invoices(self):
         """
          Deletes and recreates all invoices for the year,
          starting at the policy effective_date.
         """
-        cents = Decimal('.01')
-
         logging.debug('Marking current invoices as deleted for policy ' + self.policy.policy_number)
+        ledger_entries = []
         for invoice in self.policy.invoices:
+            if not invoice.deleted:
+                ledger_entries.append((invoice.bill_date, -invoice.amount_due))
             invoice.deleted = 1
 
-        required_invoices = self.billing_schedules[self.policy.billing_schedule]
-        bill_amount = Decimal(self.policy.annual_premium) / Decimal(self.billing_schedules.get(self.policy.billing_schedule))
+        # the premium in whole cents, any odd cents going on the first invoices
+        bill_amounts = split_cents(to_cents(self.policy.annual_premium),
+                                   self.billing_schedules.get(self.policy.billing_schedule))
         logging.debug('Creating invoices...')
         invoices = []
 
-        for i in range(required_invoices):
-            months_after_eff_date = i * (12 / required_invoices)
-            bill_date = self.policy.effective_date + relativedelta(months=months_after_eff_date)
+        for (bill_date, due_date, cancel_date), bill_amount in zip(invoice_schedule(self.policy.billing_schedule,
+                                                                                    self.policy.effective_date),
+                                                                   bill_amounts):
+            bill_amount = from_cents(bill_amount)
             invoice = Invoice(self.policy.id,
                               bill_date,
-                              bill_date + relativedelta(months=1),
-                              bill_date + relativedelta(months=1, days=14),
+                              due_date,
+                              cancel_date,
                               bill_amount)
             logging.debug('Created invoice, due: ' + str(invoice.amount_due))
             invoices.append(invoice)
+            ledger_entries.append((bill_date, bill_amount))
 
         for invoice in invoices:
             db.session.add(invoice)
+        record_entries(self.policy.id, ledger_entries)
         logging.debug('Begin db commit for invoices on ' + self.policy.policy_number)
         db.session.commit()
+        statement_cache.invalidate(self.policy.id)
         logging.debug('End db commit')
+        logging.info('Invoices for policy ' + str(self.policy.id) + ': '
+                     + str(len(ledger_entries) - len(invoices)) + ' deleted, '
+                     + str(len(invoices)) + ' created.')
+
+    def reschedule_invoices(self, change_date):
+        """
+         Mid-term version of make_invoices. Invoices already billed as of
+         change_date are kept as they are; the ones billed after it are
+         marked deleted in one update. The premium the kept invoices don't
+         cover is split to the cent over the bill dates of the policy's
+         schedule after change_date, or billed on change_date if the
+         schedule has none left, and inserted in one statement.
+        """
+        invoices = Invoice.__table__
+        current = db.session.execute(select([invoices.c.bill_date, invoices.c.amount_due])
+                                     .where(and_(invoices.c.policy_id == self.policy.id,
+                                                 invoices.c.deleted == False))).fetchall()
+        billed = sum(to_cents(row.amount_due) for row in current if row.bill_date <= change_date)
+        ledger_entries = [(row.bill_date, -row.amount_due) for row in current if row.bill_date > change_date]
+
+        deleted = db.session.execute(invoices.update()
+                                             .where(and_(invoices.c.policy_id == self.policy.id,
+                                                         invoices.c.deleted == False,
+                                                         invoices.c.bill_date > change_date))
+                                             .values(deleted=True)).rowcount
+
+        remaining = to_cents(self.policy.annual_premium) - billed
+        dates = [invoice_dates for invoice_dates in invoice_schedule(self.policy.billing_schedule,
+                                                                     self.policy.effective_date)
+                 if invoice_dates[0] > change_date]
+        if not dates:
+            dates = [(change_date, change_date + due_offset, change_date + cancel_offset)]
+
+        rows = []
+        if remaining > 0:
+            for (bill_date, due_date, cancel_date), bill_amount in zip(dates, split_cents(remaining, len(dates))):
+                bill_amount = from_cents(bill_amount)
+                rows.append({'policy_id': self.policy.id,
+                             'bill_date': bill_date,
+                             'due_date': due_date,
+                             'cancel_date': cancel_date,
+                             'amount_due': bill_amount,
+                             'deleted': False})
+                ledger_entries.append((bill_date, bill_amount))
+            db.session.execute(invoices.insert(), rows)
+
+        record_entries(self.policy.id, ledger_entries)
+        db.session.commit()
+        statement_cache.invalidate(self.policy.id)
+        logging.info('Invoices for policy ' + str(self.policy.id) + ' from ' + str(change_date) + ': '
+                     + str(deleted) + ' deleted, ' + str(len(rows)) + ' created.')
 
 ################################
 # The functions below are for the db and
@@ -372,7 +438,10 @@ class PolicyAccounting(object):
 def build_or_refresh_db():
     db.drop_all()
     db.create_all()
+    contact_resolver.clear()
+    stamp_schema_version()
     insert_data()
+    rebuild_ledger()
     print "DB Ready!"
 
 
@@ -1,18 +1,25 @@
 # You will probably need more methods from flask but this one is a good start.
-from flask import render_template, redirect, request, flash, url_for, jsonify
+from flask import render_template, redirect, request, flash, url_for, jsonify, json, \
+    Response, stream_with_context
 from datetime import date, datetime
-from decimal import Decimal, ROUND_05UP
-from sqlalchemy import and_
 
 # Import things from Flask that we need.
 from accounting import app, db
 
 # Import our models
-from models import Payment, Contact, Invoice, Policy
+from aging import iter_aging_csv
+from contacts import contact_resolver
+from engine import read_only_route
+from export import EXPORT_FORMATS, EXPORT_TABLES, export_watermark, iter_export
+from models import Policy
+from statements import load_statement, statement_cache, statement_etag
+from timeline import monthly_dates
 from tools import PolicyAccounting
 
 app.secret_key = 'super secret'
 
+MAX_BALANCE_DATES = 1000
+
 
 # Routing for the server.
 @app.route('/')
@@ -24,9 +31,8 @@ def index():
 
 
 @app.route('/policy/', methods=['POST'])
+@read_only_route
 def policy():
-    cents = Decimal('.01')
-
     if not request.form['date']:
         date_cursor = datetime.now().date()
     else:
@@ -37,59 +43,148 @@ def policy():
             date_cursor = datetime.now().date()
             flash("Entered date was not valid, showing information for today's date.")
 
-    policies = Policy.query.filter_by(id=request.form['id']).all()
-    if not policies:
+    try:
+        data = load_statement(int(request.form['id']), date_cursor)
+    except ValueError:
+        data = None
+    if not data:
         flash("Entered policy id not found, please try a different policy ID.")
         return redirect(url_for('index'))
+    return render_template('policy.html', passed_data=data)
 
-    current = policies[0]
-    pa = PolicyAccounting(current.id)
-    balance = pa.return_account_balance(date_cursor)
-    current_invoices = Invoice.query.filter_by(policy_id=request.form['id'])\
-                                    .filter(and_(Invoice.deleted == 0, Invoice.bill_date <= date_cursor))\
-                                    .all()
-    deleted_invoices = Invoice.query.filter_by(policy_id=request.form['id'])\
-                                    .filter(and_(Invoice.deleted == 1, Invoice.bill_date <= date_cursor))\
-                                    .all()
-    payments = Payment.query.filter_by(policy_id=request.form['id']).all()
-
-    # map ids to names, and currency to strings for use in the template
-    for payment in payments:
-        contact = Contact.query.filter_by(id=payment.contact_id).one()
-        payment.contact_name = contact.name
-        payment.amount_text = str(Decimal(payment.amount_paid).quantize(cents, ROUND_05UP))
-    for invoice in current_invoices:
-        invoice.amount_text = str(Decimal(invoice.amount_due).quantize(cents, ROUND_05UP))
-    for invoice in deleted_invoices:
-        invoice.amount_text = str(Decimal(invoice.amount_due).quantize(cents, ROUND_05UP))
-
-    insured = Contact.query.filter_by(id=current.named_insured).one()
-    agent = Contact.query.filter_by(id=current.agent).one()
-
-    data = {'policy_id': request.form['id'],
-            'date': str(date_cursor),
-            'balance': balance,
-            'current_invoices': current_invoices,
-            'deleted_invoices': deleted_invoices,
-            'payments': payments,
-            'policy_name': current.policy_number,
-            'billing': current.billing_schedule,
-            'effective_date': current.effective_date,
-            'status': current.status,
-            'annual_premium': Decimal(current.annual_premium).quantize(cents, ROUND_05UP),
-            'named_insured': insured.name,
-            'agent_name': agent.name,
-            'canceled_date': current.canceled_date,
-            'cancel_reason': current.cancel_reason}
 
-    return render_template('policy.html', passed_data=data)
+@app.route('/api/policies/<int:policy_id>/statement')
+@read_only_route
+def policy_statement(policy_id):
+    """
+     The policy page's data as JSON, for the portal and integrations.
+     Clients that send back the ETag get a 304 while nothing on the
+     policy has changed, without the statement being rebuilt.
+    """
+    if not request.args.get('date'):
+        date_cursor = datetime.now().date()
+    else:
+        try:
+            date_cursor = datetime.strptime(request.args['date'], '%Y-%m-%d').date()
+        except ValueError:
+            return api_error('Dates must be formatted yyyy-mm-dd.', 400)
+
+    etag = statement_etag(policy_id, date_cursor)
+    if etag is None:
+        return api_error('Policy not found.', 404)
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        data = load_statement(policy_id, date_cursor)
+        response = app.response_class(json.dumps(data), mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/api/policies/<int:policy_id>/balances')
+@read_only_route
+def policy_balances(policy_id):
+    """
+     Balances at each of ?dates=yyyy-mm-dd,yyyy-mm-dd,... or, without
+     dates, on the same day of every month from ?start= (the effective
+     date) to ?end= (today).
+    """
+    pa = PolicyAccounting(policy_id, read_only=True)
+    if not pa.policy:
+        return api_error('Policy not found.', 404)
+
+    try:
+        if request.args.get('dates'):
+            date_cursors = [datetime.strptime(raw.strip(), '%Y-%m-%d').date()
+                            for raw in request.args['dates'].split(',')]
+        else:
+            start = pa.policy.effective_date
+            end = datetime.now().date()
+            if request.args.get('start'):
+                start = datetime.strptime(request.args['start'], '%Y-%m-%d').date()
+            if request.args.get('end'):
+                end = datetime.strptime(request.args['end'], '%Y-%m-%d').date()
+            date_cursors = monthly_dates(start, end)
+    except ValueError:
+        return api_error('Dates must be formatted yyyy-mm-dd.', 400)
+    if len(date_cursors) > MAX_BALANCE_DATES:
+        return api_error('At most ' + str(MAX_BALANCE_DATES) + ' dates per request.', 400)
+
+    balances = [{'date': str(date_cursor), 'balance': str(balance)}
+                for date_cursor, balance in pa.return_account_balances(date_cursors)]
+    return app.response_class(json.dumps({'policy_id': policy_id, 'balances': balances}),
+                              mimetype='application/json')
+
+
+@app.route('/api/statement-cache')
+def statement_cache_stats():
+    return app.response_class(json.dumps(statement_cache.stats()), mimetype='application/json')
+
+
+@app.route('/reports/aging')
+@read_only_route
+def aging_report():
+    """
+     Streams the aging report for ?date=yyyy-mm-dd, or today, as CSV.
+    """
+    if not request.args.get('date'):
+        as_of = datetime.now().date()
+    else:
+        try:
+            as_of = datetime.strptime(request.args['date'], '%Y-%m-%d').date()
+        except ValueError:
+            return api_error('Dates must be formatted yyyy-mm-dd.', 400)
+
+    response = Response(stream_with_context(iter_aging_csv(as_of)), mimetype='text/csv')
+    response.headers['Content-Disposition'] = 'attachment; filename=aging-' + str(as_of) + '.csv'
+    return response
+
+
+@app.route('/api/export/<table>')
+@read_only_route
+def export_table(table):
+    """
+     Streams the invoices or payments table as ?format=csv (the default)
+     or ndjson, optionally only rows with ids above ?since_id= or dated on
+     or after ?since_date=yyyy-mm-dd. The X-Export-Watermark header is the
+     last id included, to pass as since_id next time.
+    """
+    if table not in EXPORT_TABLES:
+        return api_error('Table not found.', 404)
+    format = request.args.get('format', 'csv')
+    if format not in EXPORT_FORMATS:
+        return api_error('Format must be one of ' + ', '.join(EXPORT_FORMATS) + '.', 400)
+    try:
+        since_id = request.args.get('since_id') and int(request.args['since_id']) or None
+    except ValueError:
+        return api_error('since_id must be a whole number.', 400)
+    try:
+        since_date = request.args.get('since_date') \
+            and datetime.strptime(request.args['since_date'], '%Y-%m-%d').date() or None
+    except ValueError:
+        return api_error('Dates must be formatted yyyy-mm-dd.', 400)
+
+    watermark = export_watermark(table, since_id, since_date)
+    rows = iter_export(table, format, since_id, since_date, watermark)
+    mimetype = format == 'csv' and 'text/csv' or 'application/x-ndjson'
+    response = Response(stream_with_context(rows), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=' + table + '-' + str(watermark) + '.' + format
+    response.headers['X-Export-Watermark'] = str(watermark)
+    return response
+
+
+def api_error(message, status):
+    return app.response_class(json.dumps({'error': message}), status=status,
+                              mimetype='application/json')
 
 
 @app.route('/maintenance/', methods=['POST'])
+@read_only_route
 def maintenance():
     policy = Policy.query.filter_by(id=request.form['id']).one()
-    insured = Contact.query.filter_by(id=policy.named_insured).one()
-    agent = Contact.query.filter_by(id=policy.agent).one()
+    insured = contact_resolver.get(policy.named_insured)
+    agent = contact_resolver.get(policy.agent)
     current_billing = policy.billing_schedule
 
     # returns a list of all schedules without the current included
@@ -112,14 +207,21 @@ def maintenance():
 @app.route('/payment/', methods=['POST'])
 def payment():
     pa = PolicyAccounting(request.form['id'])
-    pa.make_payment(request.form['payment_amount'], pa.policy.agent)
+    if not pa.make_payment(request.form['payment_amount'], pa.policy.agent):
+        return 'Payment could not be made.', 400
     return 'Payment successful!'
 
 
 @app.route('/billing/', methods=['POST'])
 def billing():
     pa = PolicyAccounting(request.form['id'])
-    pa.change_billing_schedule(request.form['new_billing'])
+    change_date = request.form.get('change_date')
+    if change_date:
+        try:
+            change_date = datetime.strptime(change_date, '%Y-%m-%d').date()
+        except ValueError:
+            return 'Invalid change date, expected YYYY-MM-DD.', 400
+    pa.change_billing_schedule(request.form['new_billing'], change_date)
     return 'Billing updated successfully!'
 
 
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+import argparse
+import csv
+import json
+import os
+import sys
+from datetime import datetime
+
+
+def parse_date(raw):
+    return datetime.strptime(raw, '%Y-%m-%d').date()
+
+
+def sweep(args):
+    from accounting.sweep import run_sweep
+    report = run_sweep(args.date, args.workers, args.apply)
+    print json.dumps(report, indent=2)
+
+
+def rebuild_ledger(args):
+    from accounting.ledger import rebuild_ledger, verify_ledger
+    if not args.verify_only:
+        print "Wrote " + str(rebuild_ledger()) + " ledger rows."
+    mismatches = verify_ledger()
+    for mismatch in mismatches:
+        print "Policy %s on %s: ledger $%s, expected $%s" % mismatch
+    print "Ledger verified with " + str(len(mismatches)) + " mismatches."
+
+
+def migrate(args):
+    from accounting.migrations import migrate
+    ran = migrate()
+    print "Ran migrations: " + (', '.join(ran) or 'none, already up to date')
+
+
+def benchmark_indexes(args):
+    from accounting.benchmarks import benchmark_indexes
+    write_results(benchmark_indexes(args.path, args.invoices, args.repeat, args.seed), args.output)
+
+
+def benchmark_money(args):
+    from accounting.benchmarks import benchmark_money
+    write_results(benchmark_money(args.rows, args.repeat, args.seed), args.output)
+
+
+def aging(args):
+    from accounting.aging import write_aging_csv
+    date_cursor = args.date or datetime.now().date()
+    if args.output:
+        with open(args.output, 'wb') as output:
+            totals = write_aging_csv(date_cursor, output)
+        print json.dumps(totals, indent=2, sort_keys=True, default=str)
+    else:
+        write_aging_csv(date_cursor, sys.stdout)
+
+
+def export(args):
+    from accounting.export import write_export
+    if args.output:
+        with open(args.output, 'wb') as output:
+            report = write_export(args.table, output, args.format, args.since_id, args.since_date)
+        print json.dumps(report, indent=2, sort_keys=True)
+    else:
+        write_export(args.table, sys.stdout, args.format, args.since_id, args.since_date)
+
+
+def analytics(args):
+    from accounting.analytics import cross_check, write_analytics_csv
+    date_cursor = args.date or datetime.now().date()
+    if args.check:
+        mismatches = cross_check(date_cursor)
+        for mismatch in mismatches:
+            print "Policy %s %s: kernel %s, PolicyAccounting %s" % mismatch
+        print "Cross-checked with " + str(len(mismatches)) + " mismatches."
+    elif args.output:
+        with open(args.output, 'wb') as output:
+            print "Wrote " + str(write_analytics_csv(date_cursor, output)) + " policies."
+    else:
+        write_analytics_csv(date_cursor, sys.stdout)
+
+
+def import_payments(args):
+    from accounting.payment_import import import_payments
+    write_results(import_payments(args.path, args.rejects, args.chunk_size), None)
+
+
+def onboard(args):
+    from accounting.onboarding import PolicySpec, onboard_policies
+
+    def read_specs(source):
+        # the effective date is parsed when each spec is checked, so a bad
+        # one rejects its row instead of stopping the run
+        for row in csv.DictReader(source):
+            yield PolicySpec(row['policy_number'], row['billing_schedule'], row['named_insured'],
+                             row['agent'], row['annual_premium'], row['effective_date'])
+
+    with open(args.path, 'rb') as source:
+        for progress in onboard_policies(read_specs(source), args.chunk_size):
+            print json.dumps(progress)
+
+
+def compact_invoices(args):
+    from accounting.archive import compact_invoices
+    write_results(compact_invoices(args.batch_size, args.samples, args.vacuum), None)
+
+
+def generate_book(args):
+    use_database(args.database)
+    from accounting.generator import generate_book, reset_database
+    reset_database()
+    write_results(generate_book(args.contacts, args.policies, args.seed), None)
+
+
+def benchmark(args):
+    use_database(args.database)
+    from accounting.benchmarks import run_benchmarks
+    scales = None
+    if args.policies:
+        scales = [(max(2, policies / 10), policies) for policies in args.policies]
+    write_results(run_benchmarks(scales, args.samples, args.seed), args.output)
+
+
+def benchmark_snapshot(args):
+    if args.database:
+        use_database(args.database)
+    from accounting.benchmarks import benchmark_snapshot
+    write_results(benchmark_snapshot(), args.output)
+
+
+def benchmark_export(args):
+    if args.database:
+        use_database(args.database)
+    from accounting.benchmarks import benchmark_export
+    write_results(benchmark_export(args.table), args.output)
+
+
+def benchmark_concurrency(args):
+    if args.database:
+        use_database(args.database)
+    from accounting.benchmarks import benchmark_concurrency
+    write_results(benchmark_concurrency(args.writers, args.readers, args.payments, args.reads,
+                                        policy_count=args.policies), args.output)
+
+
+def use_database(path):
+    # must run before the accounting package is first imported
+    os.environ['ACCOUNTING_DATABASE_URI'] = 'sqlite:///' + os.path.abspath(path)
+
+
+def write_results(results, output):
+    text = json.dumps(results, indent=2, sort_keys=True, default=str)
+    if output:
+        with open(output, 'w') as results_file:
+            results_file.write(text)
+    print text
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch jobs for the accounting app.')
+    commands = parser.add_subparsers()
+
+    command = commands.add_parser('sweep', help='Find (and optionally cancel) policies '
+                                                + 'that should cancel or are pending cancellation.')
+    command.add_argument('--date', type=parse_date, help='yyyy-mm-dd, defaults to today')
+    command.add_argument('--workers', type=int, help='defaults to the number of cores')
+    command.add_argument('--apply', action='store_true', help='cancel the policies that should cancel')
+    command.set_defaults(func=sweep)
+
+    command = commands.add_parser('rebuild-ledger', help='Regenerate the running-balance ledger '
+                                                         + 'from invoices and payments and verify it.')
+    command.add_argument('--verify-only', action='store_true', help="check the ledger but don't rebuild it")
+    command.set_defaults(func=rebuild_ledger)
+
+    command = commands.add_parser('migrate', help='Bring an existing accounting.sqlite up to date, '
+                                                  + 'adding missing tables and indexes in place.')
+    command.set_defaults(func=migrate)
+
+    command = commands.add_parser('benchmark-indexes', help='Compare query plans and timings of the hot '
+                                                            + 'queries with and without the model indexes.')
+    command.add_argument('--path', default='benchmark.sqlite', help='generated database file')
+    command.add_argument('--invoices', type=int, default=1000000)
+    command.add_argument('--repeat', type=int, default=200, help='runs of each query')
+    command.add_argument('--seed', type=int, default=0)
+    command.add_argument('--output', help='also write the JSON results to this file')
+    command.set_defaults(func=benchmark_indexes)
+
+    command = commands.add_parser('benchmark-money', help='Compare summing NUMERIC dollar amounts '
+                                                          + 'with summing integer cents.')
+    command.add_argument('--rows', type=int, default=100000)
+    command.add_argument('--repeat', type=int, default=5, help='runs of each sum')
+    command.add_argument('--seed', type=int, default=0)
+    command.add_argument('--output', help='also write the JSON results to this file')
+    command.set_defaults(func=benchmark_money)
+
+    command = commands.add_parser('aging', help='Export the 30/60/90 day aging report as CSV.')
+    command.add_argument('--date', type=parse_date, help='yyyy-mm-dd, defaults to today')
+    command.add_argument('--output', help='CSV file to write, defaults to stdout')
+    command.set_defaults(func=aging)
+
+    command = commands.add_parser('export', help='Stream the invoices or payments table as CSV or '
+                                                 + 'newline-delimited JSON for the warehouse.')
+    command.add_argument('table', choices=['invoices', 'payments'])
+    command.add_argument('--format', choices=['csv', 'ndjson'], default='csv')
+    command.add_argument('--since-id', type=int, help='only rows with higher ids, e.g. the last watermark')
+    command.add_argument('--since-date', type=parse_date, help='only rows dated on or after yyyy-mm-dd')
+    command.add_argument('--output', help='file to write, defaults to stdout; prints the watermark')
+    command.set_defaults(func=export)
+
+    command = commands.add_parser('analytics', help='Export every policy\'s balance, cancellation, pending '
+                                                    + 'cancellation and aging as CSV. Needs NumPy.')
+    command.add_argument('--date', type=parse_date, help='yyyy-mm-dd, defaults to today')
+    command.add_argument('--output', help='CSV file to write, defaults to stdout')
+    command.add_argument('--check', action='store_true', help='compare every policy with PolicyAccounting instead')
+    command.set_defaults(func=analytics)
+
+    command = commands.add_parser('import-payments', help='Load a lockbox CSV of policy_number, payer, '
+                                                          + 'amount and date rows as payments.')
+    command.add_argument('path')
+    command.add_argument('--rejects', help='write rejected rows and the reasons to this CSV')
+    command.add_argument('--chunk-size', type=int, default=1000, help='rows per transaction')
+    command.set_defaults(func=import_payments)
+
+    command = commands.add_parser('onboard', help='Create policies, their contacts and invoices from a CSV '
+                                                  + 'with a column for each PolicySpec field.')
+    command.add_argument('path')
+    command.add_argument('--chunk-size', type=int, default=1000, help='policies per transaction')
+    command.set_defaults(func=onboard)
+
+    command = commands.add_parser('compact-invoices', help='Move deleted invoices to invoices_archive in '
+                                                           + 'batches and report the table before and after.')
+    command.add_argument('--batch-size', type=int, default=500, help='invoices per transaction')
+    command.add_argument('--samples', type=int, default=200, help='policies the lookup timings run over')
+    command.add_argument('--vacuum', action='store_true', help='return the freed space to the filesystem')
+    command.set_defaults(func=compact_invoices)
+
+    command = commands.add_parser('generate-book', help='Fill a scratch database with a seeded '
+                                                        + 'synthetic book of business.')
+    command.add_argument('--database', default='benchmark.sqlite', help='database file to overwrite')
+    command.add_argument('--contacts', type=int, default=10000)
+    command.add_argument('--policies', type=int, default=100000)
+    command.add_argument('--seed', type=int, default=0)
+    command.set_defaults(func=generate_book)
+
+    command = commands.add_parser('benchmark', help='Time the PolicyAccounting operations and routes '
+                                                    + 'against generated books of several sizes.')
+    command.add_argument('--database', default='benchmark.sqlite', help='database file to overwrite')
+    command.add_argument('--policies', type=int, nargs='+', help='scales to run, defaults to 1k, 10k and 100k')
+    command.add_argument('--samples', type=int, default=50, help='policies timed at each scale')
+    command.add_argument('--seed', type=int, default=0)
+    command.add_argument('--output', help='also write the JSON results to this file')
+    command.set_defaults(func=benchmark)
+
+    command = commands.add_parser('benchmark-snapshot', help='Compare the memory per policy of loading the '
+                                                             + 'book as ORM instances and as a snapshot.')
+    command.add_argument('--database', help='database file to read, e.g. one made by generate-book')
+    command.add_argument('--output', help='also write the JSON results to this file')
+    command.set_defaults(func=benchmark_snapshot)
+
+    command = commands.add_parser('benchmark-export', help='Compare the peak memory of exporting a table '
+                                                           + 'from ORM instances and by streaming it.')
+    command.add_argument('table', nargs='?', choices=['invoices', 'payments'], default='invoices')
+    command.add_argument('--database', help='database file to read, e.g. one made by generate-book')
+    command.add_argument('--output', help='also write the JSON results to this file')
+    command.set_defaults(func=benchmark_export)
+
+    command = commands.add_parser('benchmark-concurrency', help='Compare payment throughput and read latency '
+                                                                + 'under concurrent load with SQLite\'s '
+                                                                + 'defaults and with the app\'s settings.')
+    command.add_argument('--database', required=True, help='scratch database file to generate and load')
+    command.add_argument('--writers', type=int, default=4, help='processes posting payments')
+    command.add_argument('--readers', type=int, default=4, help='processes reading balances')
+    command.add_argument('--payments', type=int, default=200, help='payments per writer')
+    command.add_argument('--reads', type=int, default=200, help='reads per reader')
+    command.add_argument('--policies', type=int, default=10000, help='policies in the generated book')
+    command.add_argument('--output', help='also write the JSON results to this file')
+    command.set_defaults(func=benchmark_concurrency)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()